@@ -0,0 +1,267 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from manager.models import Email, Instance, Recipient, URL
+from manager.utilities.email_message import MessageFactory
+from manager.utilities.email_template import EmailTemplate
+from manager.utilities.render_pool import RenderPool, build_message
+from manager.utilities.tracking_app import TrackingApplication
+from manager.utilities.tracking_links import TrackingLinkFactory
+from util import calc_open_mac, calc_url_mac
+
+from collections import deque
+from datetime import datetime
+import io
+import os
+import tempfile
+import time
+import urllib.parse
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks parts of the sending pipeline without touching the database or Amazon'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            type=str,
+            choices=['render', 'links', 'tracking'],
+            help='What to benchmark. render: message rendering throughput per number of render processes. '
+                 'links: tracking link generation, per recipient reverse() and HMAC versus TrackingLinkFactory. '
+                 'tracking: open pixel requests per second, Django views versus tracking_wsgi.py, with opens spooled'
+        )
+
+        parser.add_argument(
+            '--recipients',
+            dest='recipients',
+            type=int,
+            help='The number of recipients to benchmark with',
+            default=2000
+        )
+
+        parser.add_argument(
+            '--html-kb',
+            dest='html_kb',
+            type=int,
+            help='The approximate size of the email html in KB',
+            default=100
+        )
+
+        parser.add_argument(
+            '--links',
+            dest='links',
+            type=int,
+            help='The number of tracked links in the email html',
+            default=50
+        )
+
+        parser.add_argument(
+            '--processes',
+            dest='processes',
+            type=str,
+            help='Comma separated numbers of render processes to try. 0 renders in this process. Defaults to powers of 2 up to the number of cores',
+            default=None
+        )
+
+    def handle(self, *args, **options):
+        self.recipient_count = options['recipients']
+        self.html_kb = options['html_kb']
+        self.link_count = options['links']
+
+        if options['processes']:
+            try:
+                self.process_counts = [int(p) for p in options['processes'].split(',')]
+            except ValueError:
+                raise CommandError('--processes must be a comma separated list of integers')
+        else:
+            cores = os.cpu_count() or 1
+            self.process_counts = [0]
+            processes = 1
+            while processes <= cores:
+                self.process_counts.append(processes)
+                processes *= 2
+
+        getattr(self, 'benchmark_%s' % options['target'])()
+
+    def sample_html(self):
+        '''
+        Returns newsletter-like html of roughly html_kb KB with link_count
+        tracked links, a placeholder per paragraph and an unsubscribe link.
+        '''
+        paragraph = '<p>Dear !@!first_name!@!, ' + 'lorem ipsum dolor sit amet &amp; consectetur &ndash; adipiscing elit. ' * 8 + '</p>\n'
+        paragraphs = max(1, self.html_kb * 1024 // len(paragraph))
+
+        body = []
+        for i in range(paragraphs):
+            body.append(paragraph)
+            if i < self.link_count:
+                body.append('<a href="https://www.ucf.edu/news/story-%d/">Story %d</a>\n' % (i, i))
+        for i in range(paragraphs, self.link_count):
+            body.append('<a href="https://www.ucf.edu/news/story-%d/">Story %d</a>\n' % (i, i))
+
+        return '<html><head><title>Benchmark</title></head><body>\n%s<p>!@!UNSUBSCRIBE!@!</p>\n</body></html>' % ''.join(body)
+
+    def sample_template(self):
+        email = Email(
+            pk=1,
+            subject='Benchmark',
+            replace_delimiter='!@!',
+            from_email_address='webcom@ucf.edu',
+            from_friendly_name='Web Communications'
+        )
+        instance = Instance(
+            pk=1,
+            email=email,
+            subject=email.subject,
+            sent_html=self.sample_html(),
+            requested_start=datetime.now(),
+            opens_tracked=True,
+            urls_tracked=True
+        )
+
+        # Build the URLs in memory, Instance.tracking_urls would create them
+        urls = []
+        for i in range(self.link_count):
+            urls.append(URL(pk=i + 1, instance=instance, name='https://www.ucf.edu/news/story-%d/' % i, position=0))
+
+        return email, EmailTemplate(instance, instance.placeholders, urls)
+
+    def sample_recipients(self):
+        recipients = [
+            Recipient(pk=i + 1, email_address='recipient-%d@ucf.edu' % i)
+            for i in range(self.recipient_count)
+        ]
+        attributes = {r.pk: {'first_name': 'Recipient %d' % r.pk} for r in recipients}
+        return recipients, attributes
+
+    def benchmark_render(self):
+        email, template = self.sample_template()
+        factory = MessageFactory(email.subject, email.from_friendly_name, email.from_email_address)
+        recipients, attributes = self.sample_recipients()
+
+        batch_size = getattr(settings, 'SEND_BATCH_SIZE', 500)
+
+        self.stdout.write('Rendering %d messages of %d KB html with %d tracked links on %d core(s)' % (
+            len(recipients), len(template.sent_html) // 1024, self.link_count, os.cpu_count() or 1))
+
+        baseline = None
+        for processes in self.process_counts:
+            start = time.perf_counter()
+            if processes == 0:
+                for recipient in recipients:
+                    build_message(template, factory, recipient, attributes[recipient.pk])
+            else:
+                pool = RenderPool(processes, template, factory)
+                # Exclude worker start up from the measurement
+                pool.render(recipients[:processes], attributes)
+                start = time.perf_counter()
+                # Batches are submitted ahead and collected in order, like
+                # Email.send does
+                rendering = deque()
+                for i in range(0, len(recipients), batch_size):
+                    rendering.append(pool.submit(recipients[i:i + batch_size], attributes))
+                    if len(rendering) > 2:
+                        RenderPool.results(rendering.popleft())
+                while rendering:
+                    RenderPool.results(rendering.popleft())
+                pool.shutdown()
+            elapsed = time.perf_counter() - start
+
+            rate = len(recipients) / elapsed
+            baseline = baseline or rate
+            self.stdout.write('%-20s %10.1f messages/s %6.2fx' % (
+                '%d process(es)' % processes if processes else 'in process',
+                rate,
+                rate / baseline))
+
+    def benchmark_links(self):
+        email, template = self.sample_template()
+        recipients, attributes = self.sample_recipients()
+        links = template.links
+
+        self.stdout.write('Generating %d tracked links, an open pixel and an unsubscribe link for %d recipients' % (
+            self.link_count, len(recipients)))
+
+        # The per recipient work done before TrackingLinkFactory, with the
+        # query strings built as they were then rather than by the
+        # template, whose links may now be compact
+        start = time.perf_counter()
+        for recipient in recipients:
+            for url in template.tracking_urls:
+                '?'.join([settings.PROJECT_URL + reverse('manager-email-redirect'), urllib.parse.urlencode({
+                    'instance'  :template.instance.pk,
+                    'recipient' :recipient.pk,
+                    'url'       :urllib.parse.quote(url.name),
+                    'position'  :url.position,
+                    'mac'       :calc_url_mac(url.name, url.position, recipient.pk, template.instance.pk)
+                })])
+            '?'.join([settings.PROJECT_URL + reverse('manager-email-open'), urllib.parse.urlencode({
+                'recipient':recipient.pk,
+                'instance' :template.instance.pk,
+                'mac'      :calc_open_mac(recipient.pk, template.instance.pk)
+            })])
+            recipient.unsubscribe_url
+        baseline = len(recipients) / (time.perf_counter() - start)
+        self.stdout.write('%-20s %10.1f recipients/s %6.2fx' % ('reverse and hmac', baseline, 1))
+
+        # The same links from the factory, then as sent with compact links
+        with override_settings(TRACKING_COMPACT_LINKS=False):
+            factories = [('link factory', TrackingLinkFactory(template.instance, template.tracking_urls))]
+        if links.compact:
+            factories.append(('compact links', links))
+        for name, factory in factories:
+            start = time.perf_counter()
+            for recipient in recipients:
+                for index in range(len(template.tracking_urls)):
+                    factory.url(recipient.pk, index)
+                factory.open_url(recipient.pk)
+                factory.unsubscribe_url(recipient)
+            rate = len(recipients) / (time.perf_counter() - start)
+            self.stdout.write('%-20s %10.1f recipients/s %6.2fx' % (name, rate, rate / baseline))
+
+    def benchmark_tracking(self):
+        recipients, attributes = self.sample_recipients()
+        host = urllib.parse.urlparse(settings.PROJECT_URL).hostname or 'localhost'
+
+        def environ(recipient):
+            return {
+                'REQUEST_METHOD' : 'GET',
+                'PATH_INFO'      : reverse('manager-email-open'),
+                'QUERY_STRING'   : urllib.parse.urlencode({
+                    'recipient':recipient.pk,
+                    'instance' :1,
+                    'mac'      :calc_open_mac(recipient.pk, 1)
+                }),
+                'SERVER_NAME'    : host,
+                'SERVER_PORT'    : '80',
+                'HTTP_HOST'      : host,
+                'wsgi.input'     : io.BytesIO(),
+                'wsgi.url_scheme': 'http'
+            }
+
+        def start_response(status, headers):
+            if not status.startswith('200'):
+                raise CommandError('Open pixel request failed: %s' % status)
+
+        self.stdout.write('Requesting the open pixel %d times, with opens spooled to a temporary directory' % len(recipients))
+
+        # Spooling keeps the database out of the measurement
+        with tempfile.TemporaryDirectory() as spool_dir, \
+             override_settings(TRACKING_SPOOL_DIR=spool_dir, ALLOWED_HOSTS=[host]):
+            baseline = None
+            for name, application in [('django views', get_wsgi_application()), ('tracking app', TrackingApplication())]:
+                environs = [environ(recipient) for recipient in recipients]
+                start = time.perf_counter()
+                for request in environs:
+                    response = application(request, start_response)
+                    b''.join(response)
+                    # Django finishes the request when the response is closed
+                    if hasattr(response, 'close'):
+                        response.close()
+                rate = len(environs) / (time.perf_counter() - start)
+
+                baseline = baseline or rate
+                self.stdout.write('%-20s %10.1f requests/s %6.2fx' % (name, rate, rate / baseline))
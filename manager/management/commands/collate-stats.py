@@ -1,20 +1,24 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from threading import Thread, Lock
-from queue import Queue
+from datetime import datetime, timedelta
 
-from manager.models import Campaign, CampaignInstanceStat
+from manager.models import Campaign, CampaignInstanceStat, Instance, InstanceOpen, InstanceRecipientDetails, Setting, URLClick
 from progress.bar import ChargingBar
 
 class Command(BaseCommand):
     help = 'Collates campaign stats in the stats tables'
 
+    # Name of the Setting holding the time the last run started
+    WATERMARK = 'collate_stats_watermark'
+    LAST_RUN = 'last-run'
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--thread-count',
             dest='thread_count',
             type=int,
-            help='The number of threads to use while updating stats',
+            help='Unused, stats are collated with a few aggregate queries. Kept for existing schedules',
             default=10
         )
 
@@ -26,123 +30,91 @@ class Command(BaseCommand):
             default=False
         )
 
-    def __init__(self):
-        super().__init__()
-
-        self.instance_queue_lock = Lock()
-        self.campaign_queue_lock = Lock()
-        self.instance_queue = Queue()
-        self.campaign_queue = Queue()
-
-        self.instance_count = 0
-        self.campaign_count = 0
-        self.instance_count_lock = Lock()
-        self.campaign_count_lock = Lock()
+        parser.add_argument(
+            '--since',
+            dest='since',
+            nargs='?',
+            const=self.LAST_RUN,
+            help='Only collates instances sent, opened or clicked since the given ISO 8601 time, or since the last run when no time is given',
+            default=None
+        )
 
-        self.pb_lock = Lock()
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            help='The number of instances collated per set of queries',
+            default=1000
+        )
 
-    def update_instances(self, q):
-        while True:
+    def since(self, value):
+        if value == self.LAST_RUN:
             try:
-                with self.instance_queue_lock:
-                    obj = q.get()
-                    instance = obj['instance']
-                    campaign = obj['campaign']
-
-                if campaign and instance:
-                    try:
-                        instance_stat = CampaignInstanceStat.objects.get(campaign=campaign, instance=instance)
-                    except CampaignInstanceStat.DoesNotExist:
-                        instance_stat = CampaignInstanceStat(campaign=campaign, instance=instance)
-                        instance_stat.save()
-
-                    instance_stat.open_rate = instance.open_rate
-                    instance_stat.click_rate = instance.click_rate
-                    instance_stat.recipient_count = instance.recipients.count()
-                    instance_stat.click_to_open_rate = instance.click_to_open_rate
-
-                    instance_stat.save()
-
-                    with self.instance_count_lock:
-                        self.instance_count += 1
-
-            finally:
-                q.task_done()
-                if self.instance_bar:
-                    with self.pb_lock:
-                        self.instance_bar.next()
-
-    def update_campaigns(self, q):
-        while True:
-            try:
-                with self.campaign_queue_lock:
-                    campaign = q.get()
-
-                if campaign:
-                    campaign.avg_open_rate = campaign.calc_avg_open_rate()
-                    campaign.avg_click_rate = campaign.calc_avg_click_rate()
-                    campaign.avg_recipient_count = campaign.calc_avg_recipient_count()
-                    campaign.avg_click_to_open_rate = campaign.calc_avg_click_to_open_rate()
-                    campaign.save()
-
-                    with self.campaign_count_lock:
-                        self.campaign_count += 1
-            finally:
-                q.task_done()
-                if self.campaign_bar:
-                    with self.pb_lock:
-                        self.campaign_bar.next()
-
-    def print_stats(self):
+                value = Setting.objects.get(name=self.WATERMARK).value
+            except Setting.DoesNotExist:
+                # Never run before, collate everything
+                return None
+            since = datetime.fromisoformat(value)
+            # Spooled tracking events are inserted after they happen, with
+            # the time they happened
+            return since - timedelta(seconds=getattr(settings, 'COLLATE_STATS_OVERLAP', 900))
+
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise CommandError('--since must be an ISO 8601 date or time, e.g. 2020-01-31T08:00')
+
+    def engaged_instances(self, since):
+        '''
+        Returns the pks of instances started, sent to, opened or clicked at
+        or after since.
+        '''
+        pks = set(Instance.objects.filter(start__gte=since).values_list('pk', flat=True))
+        pks.update(InstanceRecipientDetails.objects.filter(when__gte=since).order_by().values_list('instance_id', flat=True).distinct())
+        pks.update(InstanceOpen.objects.filter(when__gte=since).order_by().values_list('instance_id', flat=True).distinct())
+        pks.update(URLClick.objects.filter(when__gte=since).order_by().values_list('url__instance_id', flat=True).distinct())
+        return sorted(pks)
+
+    def print_stats(self, instance_count, campaign_count):
         self.stdout.write(f"""
 Completed Collating Stats!
 
-Instances Updated: {self.style.SUCCESS(self.instance_count)}
-Campaigns Updated: {self.style.SUCCESS(self.campaign_count)}
+Instances Updated: {self.style.SUCCESS(instance_count)}
+Campaigns Updated: {self.style.SUCCESS(campaign_count)}
         """)
 
 
     def handle(self, *args, **options):
-        instance_threads = []
-        campaign_threads = []
-
-        thread_count = options['thread_count']
         show_progress = options['show_progress']
+        chunk_size = options['chunk_size']
+        started = datetime.now()
 
-        self.instance_bar = (ChargingBar('Processing instances...')
-            if show_progress
-            else None)
+        since = self.since(options['since']) if options['since'] else None
+        if since is None:
+            instance_pks = list(Instance.objects.exclude(campaign=None).order_by('pk').values_list('pk', flat=True))
+        else:
+            instance_pks = self.engaged_instances(since)
 
-        self.campaign_bar = (ChargingBar('Processing campaigns...')
+        instance_bar = (ChargingBar('Processing instances...', max=len(instance_pks))
             if show_progress
             else None)
 
-        for _ in range(0, thread_count):
-            t = Thread(target=self.update_instances, args=[self.instance_queue], daemon=True).start()
-            instance_threads.append(t)
-
-        # Fill up our queues
-        for campaign in Campaign.objects.all():
-            self.campaign_queue.put(campaign)
-
-            for instance in campaign.instances.all():
-                self.instance_queue.put({
-                    'campaign': campaign,
-                    'instance': instance
-                })
-
-        if self.instance_bar:
-            self.instance_bar.max = self.instance_queue.qsize()
-
-        self.instance_queue.join()
+        instance_count = 0
+        campaign_pks = set()
+        for i in range(0, len(instance_pks), chunk_size):
+            chunk = instance_pks[i:i + chunk_size]
+            count, chunk_campaign_pks = CampaignInstanceStat.objects.collate(chunk)
+            instance_count += count
+            campaign_pks.update(chunk_campaign_pks)
+            if instance_bar:
+                instance_bar.next(len(chunk))
 
-        for _ in range(0, thread_count):
-            t = Thread(target=self.update_campaigns, args=[self.campaign_queue], daemon=True).start()
-            campaign_threads.append(t)
+        if instance_bar:
+            instance_bar.finish()
 
-        if self.campaign_bar:
-            self.campaign_bar.max = self.campaign_queue.qsize()
+        # Campaigns without instances are averaged to 0 on full runs
+        campaign_count = Campaign.objects.update_averages(None if since is None else campaign_pks)
 
-        self.campaign_queue.join()
+        Setting.objects.update_or_create(name=self.WATERMARK, defaults={'value': started.isoformat()})
 
-        self.print_stats()
+        self.print_stats(instance_count, campaign_count)
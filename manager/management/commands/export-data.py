@@ -3,6 +3,7 @@ from django.core.management import call_command
 from django.template import loader
 from django.db.models import Count
 from manager.models import Email, Instance, StaleRecord
+from manager.utilities.smtp_pool import amazon_smtp_pool
 
 import unicodecsv as csv
 from datetime import datetime
@@ -134,7 +135,7 @@ class Command(BaseCommand):
             email_writer = csv.DictWriter(email_handler, fieldnames=fieldnames)
             email_writer.writeheader()
 
-        instances = Instance.objects.filter(email__in=records)
+        instances = Instance.objects.filter(email__in=records).select_related('email')
 
         if self.before:
             instances = instances.filter(end__lt=self.before)
@@ -151,7 +152,7 @@ class Command(BaseCommand):
                     'Friendly': instance.email.from_friendly_name,
                     'Start': instance.start,
                     'End': instance.end,
-                    'Recipients': instance.recipients.count(),
+                    'Recipients': instance.recipient_details_count,
                     'Sent': instance.sent_count,
                     'Opens': instance.initial_opens,
                     'Open Rate': instance.open_rate,
@@ -206,9 +207,9 @@ class Command(BaseCommand):
 
         text = template.render(context)
 
+        pool = amazon_smtp_pool()
         try:
-            amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'], settings.AMAZON_SMTP['port'])
-            amazon.login(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
+            amazon = pool.acquire()
         except:
             raise Exception("Unable to connect to amazon")
         else:
@@ -239,9 +240,10 @@ class Command(BaseCommand):
             try:
                 amazon.sendmail('webcom@ucf.edu', self.email, msg.as_string())
             except:
+                pool.discard(amazon)
                 raise Exception('Unable to send email')
 
-            amazon.quit()
+            pool.release(amazon)
 
     def prepare_stale_record(self):
         """
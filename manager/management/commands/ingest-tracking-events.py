@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from manager.utilities.tracking_spool import tracking_spool
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Inserts the open and click events spooled by the tracking views into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            help='The number of events inserted per INSERT statement',
+            default=1000
+        )
+
+    def handle(self, *args, **options):
+        spool = tracking_spool()
+        if spool is None:
+            raise CommandError('TRACKING_SPOOL_DIR is not set, tracking events are written as they happen')
+
+        files = opens = clicks = 0
+        for path in spool.closed_files():
+            try:
+                file_opens, file_clicks = spool.ingest(path, batch_size=options['batch_size'])
+            except Exception as e:
+                # Leave the file for the next run
+                log.exception('Unable to ingest tracking events from %s' % path)
+                raise CommandError('Unable to ingest tracking events from %s: %s' % (path, e))
+            files += 1
+            opens += file_opens
+            clicks += file_clicks
+
+        self.stdout.write('Ingested %d opens and %d clicks from %d spool files' % (opens, clicks, files))
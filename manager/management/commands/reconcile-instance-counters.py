@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from manager.models import Instance
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the engagement counters of instances from the recipient details, opens and clicks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--instance',
+            dest='instances',
+            type=int,
+            action='append',
+            help='The primary key of an instance to reconcile. Can be given more than once. Defaults to every instance.',
+            default=None
+        )
+
+    def handle(self, *args, **options):
+        instance_pks = options['instances']
+        if instance_pks is not None:
+            missing = set(instance_pks) - set(Instance.objects.filter(pk__in=instance_pks).values_list('pk', flat=True))
+            if missing:
+                raise CommandError('Instances %s do not exist' % ', '.join(str(pk) for pk in sorted(missing)))
+
+        count = Instance.objects.reconcile_counters(instance_pks)
+        self.stdout.write('Reconciled the counters of %d instances' % count)
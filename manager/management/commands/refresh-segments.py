@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from manager.models import Segment, SegmentMembership
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the materialized recipient membership of segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--segment',
+            dest='segments',
+            type=int,
+            action='append',
+            help='The primary key of a segment to refresh. Can be given more than once. Defaults to every segment that isn\'t archived.',
+            default=None
+        )
+
+        parser.add_argument(
+            '--full',
+            dest='full',
+            action='store_true',
+            help='Re-evaluates every recipient instead of only those with new opens, clicks or sends',
+            default=False
+        )
+
+    def handle(self, *args, **options):
+        if options['segments'] is not None:
+            segments = Segment.objects.filter(pk__in=options['segments'])
+            missing = set(options['segments']) - set(segment.pk for segment in segments)
+            if missing:
+                raise CommandError('Segments %s do not exist' % ', '.join(str(pk) for pk in sorted(missing)))
+        else:
+            segments = Segment.objects.filter(archived=False)
+
+        for segment in segments:
+            removed, added = SegmentMembership.objects.refresh(segment, full=options['full'])
+            self.stdout.write('%s: %d recipients added, %d removed' % (segment.name, added, removed))
+
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0035_auto_20220422_1307'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='instanceopen',
+            name='when',
+            field=models.DateTimeField(default=datetime.datetime.now),
+        ),
+        migrations.AlterField(
+            model_name='urlclick',
+            name='when',
+            field=models.DateTimeField(default=datetime.datetime.now),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0036_tracking_event_when'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='click_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='clicker_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='counters_current',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='opener_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='recipient_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='reopen_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='sent_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
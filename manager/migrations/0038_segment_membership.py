@@ -0,0 +1,55 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0037_instance_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='refreshed_click_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='refreshed_detail_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='refreshed_open_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='refreshed_recipient_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='refreshed_rules',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.CreateModel(
+            name='SegmentMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segment_memberships', to='manager.recipient')),
+                ('segment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='manager.segment')),
+            ],
+            options={
+                'unique_together': {('segment', 'recipient')},
+            },
+        ),
+    ]
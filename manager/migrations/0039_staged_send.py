@@ -0,0 +1,33 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0038_segment_membership'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedSend',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested_start', models.DateTimeField()),
+                ('staged_at', models.DateTimeField(auto_now_add=True)),
+                ('signature', models.CharField(max_length=40)),
+                ('content_hash', models.CharField(max_length=40)),
+                ('recipient_data', models.BinaryField()),
+                ('placeholder_data', models.TextField()),
+                ('url_data', models.TextField()),
+                ('attribute_data', models.BinaryField()),
+                ('template_data', models.BinaryField(default=b'')),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staged_sends', to='manager.email')),
+            ],
+            options={
+                'unique_together': {('email', 'requested_start')},
+            },
+        ),
+    ]
@@ -1,30 +1,41 @@
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.conf import settings
 from datetime import datetime, timedelta, date
-from django.db.models import Q
-from util import calc_url_mac, calc_open_mac, calc_unsubscribe_mac, create_hash
+from django.db.models import Avg, Case, Count, Exists, F, OuterRef, Q, Value, When
+from util import calc_unsubscribe_mac, create_hash
 from django.urls import reverse
 from django.http import HttpResponseRedirect
 from django.core.exceptions import SuspiciousOperation
 from django.contrib.auth.models import User
 from django.utils.safestring import mark_safe
 from itertools import chain
+import hashlib
+import json
 import logging
 import smtplib
 import re
 import urllib.request, urllib.parse, urllib.error
 import time
 from functools import lru_cache
-from queue import Queue
+from queue import Queue, Empty
 import threading
 import requests
 import random
-from collections import OrderedDict
+import zlib
+from collections import Counter, OrderedDict, deque
 from bs4 import BeautifulSoup
 
-from manager.utilities.email_message import EmailMessage
+from manager.utilities.async_sender import AsyncEmailSender
+from manager.utilities.content_fetcher import content_fetcher
+from manager.utilities.email_message import EmailMessage, MessageFactory
+from manager.utilities.email_template import EmailTemplate
+from manager.utilities.rate_limiter import amazon_rate_limiter
+from manager.utilities.recipient_bitmap import RecipientBitmap, email_audience, email_recipients
+from manager.utilities.render_pool import RenderPool, build_message
+from manager.utilities.result_recorder import ResultRecorder
+from manager.utilities.smtp_pool import amazon_smtp_pool
 
 
 log = logging.getLogger(__name__)
@@ -57,6 +68,32 @@ class Recipient(models.Model):
         else:
             return attribute.value
 
+    @classmethod
+    def attributes_for(cls, recipients, names):
+        '''
+            Bulk equivalent of getattr(recipient, name) for every recipient
+            and name. Names of regular model attributes (e.g. email_address)
+            are read from the recipient, all others are loaded from
+            RecipientAttribute in chunked queries. Returns a dictionary of
+            recipient pk to a dictionary of name to value; attributes the
+            recipient does not have are left out.
+        '''
+        names = list(set(names))
+        model_names = [n for n in names if hasattr(cls, n)]
+        attribute_names = [n for n in names if n not in model_names]
+
+        retval = RecipientAttribute.objects.pivot(
+            [r.pk for r in recipients],
+            attribute_names
+        )
+
+        if model_names:
+            for recipient in recipients:
+                for name in model_names:
+                    retval[recipient.pk][name] = getattr(recipient, name, None)
+
+        return retval
+
     @property
     def hmac_hash(self):
         return calc_unsubscribe_mac(self.pk)
@@ -98,6 +135,43 @@ class Recipient(models.Model):
         return self.email_address
 
 
+class RecipientAttributeManager(models.Manager):
+    '''
+    A custom manager for looking up the attributes of many recipients at
+    once, instead of one query per recipient and attribute through
+    Recipient.__getattr__.
+    '''
+    # Number of recipient ids per IN query
+    chunk_size = 500
+
+    def pivot(self, recipient_pks, names):
+        """Returns the requested attributes for a set of recipients
+
+        :param recipient_pks: An iterable of recipient primary keys
+        :param names: The attribute names to look up
+        :return: Dictionary of recipient pk to a dictionary of attribute
+                 name to value. Every requested recipient has an entry;
+                 missing attributes are absent from its dictionary.
+        """
+        recipient_pks = list(recipient_pks)
+        names = list(set(names))
+        retval = {pk: {} for pk in recipient_pks}
+
+        if not names:
+            return retval
+
+        for i in range(0, len(recipient_pks), self.chunk_size):
+            attributes = self.filter(
+                recipient__in=recipient_pks[i:i + self.chunk_size],
+                name__in=names
+            ).values_list('recipient_id', 'name', 'value')
+
+            for recipient_pk, name, value in attributes:
+                retval[recipient_pk][name] = value
+
+        return retval
+
+
 class RecipientAttribute(models.Model):
     '''
         Describes an attribute of a recipient. The purpose of this class is
@@ -107,6 +181,8 @@ class RecipientAttribute(models.Model):
         it's value. This table is populated by the custom import script for each
         data source.
     '''
+    objects = RecipientAttributeManager()
+
     recipient = models.ForeignKey(Recipient, related_name='attributes', on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     value = models.CharField(max_length=1000,blank=True)
@@ -150,9 +226,60 @@ class Segment(models.Model):
         help_text='Specify whether this group should be used for organizing recipients of preview emails. Leave unchecked if this group contains/will contain recipients for live emails.',
     )
 
+    # Membership as of the last refresh, see SegmentMembershipManager.
+    # The rules it was computed with and the last ids of the tracked
+    # tables it covers
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+    refreshed_rules = models.CharField(max_length=40, null=True, blank=True)
+    refreshed_recipient_id = models.PositiveIntegerField(default=0)
+    refreshed_detail_id = models.PositiveIntegerField(default=0)
+    refreshed_open_id = models.PositiveIntegerField(default=0)
+    refreshed_click_id = models.PositiveIntegerField(default=0)
+
     def __str__(self):
         return self.name
 
+    @property
+    def rules_signature(self):
+        """
+        A hash of the segment's rules, which changes whenever they do.
+        """
+        rules = self.rules.order_by('index', 'pk').values_list(
+            'rule_type', 'field', 'conditional', 'key', 'value', 'index')
+        return hashlib.sha1(repr(list(rules)).encode()).hexdigest()
+
+    @property
+    def members_fresh(self):
+        """
+        Whether the materialized membership was refreshed, with the current
+        rules, within the last SEGMENT_MEMBERSHIP_MAX_AGE seconds.
+        """
+        max_age = getattr(settings, 'SEGMENT_MEMBERSHIP_MAX_AGE', 900)
+        if not max_age or self.refreshed_at is None:
+            return False
+        if self.refreshed_at < datetime.now() - timedelta(seconds=max_age):
+            return False
+        return self.refreshed_rules == self.rules_signature
+
+    @property
+    def members(self):
+        """
+        The recipients in the segment's materialized membership.
+        """
+        return Recipient.objects.filter(Exists(SegmentMembership.objects.filter(
+            segment=self,
+            recipient=OuterRef('pk')))).distinct()
+
+    @property
+    def current_recipients(self):
+        """
+        The segment's recipients, read from the materialized membership
+        when it is fresh and from the rules otherwise.
+        """
+        if self.members_fresh:
+            return self.members
+        return self.recipients
+
     @property
     def include_rules(self):
         return self.rules.filter(rule_type='include').order_by('index')
@@ -161,32 +288,48 @@ class Segment(models.Model):
     def exclude_rules(self):
         return self.rules.filter(rule_type='exclude').order_by('index')
 
-    @property
-    def recipients(self):
-        include_filter = Q()
-        for rule in self.include_rules.all():
+    def _combine(self, rules, query):
+        # Rules are combined left to right, in index order
+        combined = Q()
+        for rule in rules:
             if rule.conditional in ['AND', None]:
-                include_filter &= rule.get_query()
+                combined &= query(rule)
             elif rule.conditional == 'OR':
-                include_filter |= rule.get_query()
+                combined |= query(rule)
+        return combined
 
-        exclude_filter = None
+    @property
+    def recipients(self):
+        """
+        The recipients matching the segment's rules.
 
-        if self.exclude_rules.count() > 0:
-            exclude_filter = Q()
-            for rule in self.exclude_rules.all():
-                if rule.conditional in ['AND', None]:
-                    exclude_filter &= rule.get_query()
-                elif rule.conditional == 'OR':
-                    exclude_filter |= rule.get_query()
+        Each rule is compiled to an EXISTS subquery against the recipient
+        row, so the query neither joins the (multi-valued) related tables
+        nor materializes any recipient pks in Python. Rules therefore
+        match independently: two rules on the same relation, such as two
+        attributes, can both hold for a recipient.
+        """
+        rules = list(self.rules.order_by('index'))
+        include_rules = [rule for rule in rules if rule.rule_type == 'include']
+        exclude_rules = [rule for rule in rules if rule.rule_type == 'exclude']
 
-        retval = Recipient.objects.filter(include_filter)
+        retval = Recipient.objects.filter(self._combine(include_rules, SegmentRule.get_query))
 
-        if exclude_filter is not None:
-            retval = retval.exclude(exclude_filter)
+        if exclude_rules:
+            retval = retval.exclude(self._combine(exclude_rules, SegmentRule.get_query))
 
+        # Without joins every recipient appears once. distinct() is kept
+        # so the queryset can still be combined with other distinct ones,
+        # see Email.recipients
         return retval.distinct()
 
+    def explain(self, **options):
+        """
+        Returns the database's execution plan for the recipients query.
+        Options are passed on to QuerySet.explain.
+        """
+        return self.recipients.explain(**options)
+
 class SegmentRule(models.Model):
     rule_types = (
         ('include', 'Include'),
@@ -263,54 +406,191 @@ class SegmentRule(models.Model):
         return self.key
 
     def get_query(self):
+        """
+        Returns a Q object, for filtering Recipient, that holds for the
+        recipients matching this rule.
+        """
+        recipient = OuterRef('pk')
+
         if self.field == 'in_recipient_group':
             # If recipient is in the recipient group. Pass recipient group ID.
-            return Q(groups=int(self.value))
+            return Q(Exists(RecipientGroup.recipients.through.objects.filter(
+                recipient=recipient,
+                recipientgroup=int(self.value))))
         elif self.field == 'has_attribute':
             # If the recipient has an attribute with a specific value. Pass
             # attribute name as key, and desired value as value.
-            return Q(attributes__name=self.key, attributes__value=self.value)
+            return Q(Exists(RecipientAttribute.objects.filter(
+                recipient=recipient,
+                name=self.key,
+                value=self.value)))
         elif self.field == 'received_instance':
             # If the recipient received a particular instance
-            return Q(instance=int(self.value))
+            return Q(Exists(InstanceRecipientDetails.objects.filter(
+                recipient=recipient,
+                instance=int(self.value))))
         elif self.field == 'opened_email':
             # If the recipient opened any instance of a specific email
             # (includes clicks--matches logic in Instance.open_recipients)
-            recipient_opens = Recipient.objects.filter(
-                instances_opened__instance__email=int(self.value)
-            )
-            recipient_clicks = Recipient.objects.filter(
-                urls_clicked__url__instance__email=int(self.value)
-            )
-
-            recipient_pks = list(recipient_opens.union(recipient_clicks).values_list('pk', flat=True))
-
-            return Q(pk__in=recipient_pks)
+            return Q(Exists(InstanceOpen.objects.filter(
+                recipient=recipient,
+                instance__email=int(self.value)))) | Q(Exists(URLClick.objects.filter(
+                recipient=recipient,
+                url__instance__email=int(self.value))))
         elif self.field == 'opened_instance':
             # If the recipient opened a particular instance
             # (includes clicks--matches logic in Instance.open_recipients)
-            recipient_opens = Recipient.objects.filter(
-                instances_opened__instance=int(self.value)
-            )
-            recipient_clicks = Recipient.objects.filter(
-                urls_clicked__url__instance=int(self.value)
-            )
-
-            recipient_pks = list(recipient_opens.union(recipient_clicks).values_list('pk', flat=True))
-
-            return Q(pk__in=recipient_pks)
+            return Q(Exists(InstanceOpen.objects.filter(
+                recipient=recipient,
+                instance=int(self.value)))) | Q(Exists(URLClick.objects.filter(
+                recipient=recipient,
+                url__instance=int(self.value))))
         elif self.field == 'clicked_link':
             # If the recipient clicked on a particular URL
-            return Q(urls_clicked__url__name=self.value)
+            return Q(Exists(URLClick.objects.filter(
+                recipient=recipient,
+                url__name=self.value)))
         elif self.field =='clicked_any_url_in_email':
             # If the recipient clicked on any URL in a particular instance
-            return Q(urls_clicked__url__instance=int(self.value))
+            return Q(Exists(URLClick.objects.filter(
+                recipient=recipient,
+                url__instance=int(self.value))))
         elif self.field == 'clicked_url_in_instance':
             # If the recipient clicked on a specific URL string in a particular instance
-            return Q(urls_clicked__url__name=self.key, urls_clicked__url__instance=int(self.value))
+            return Q(Exists(URLClick.objects.filter(
+                recipient=recipient,
+                url__name=self.key,
+                url__instance=int(self.value))))
 
         return Q()
 
+class SegmentMembershipManager(models.Manager):
+    '''
+    A custom manager for refreshing the materialized membership of segments.
+    '''
+    # Number of recipient ids per IN query
+    chunk_size = 1000
+
+    # Rules whose matches can only change through the tracked tables, and
+    # the Segment watermarks of the tables they depend on. Group membership
+    # isn't one of them, the recipient importers rewrite it with raw SQL
+    INCREMENTAL_FIELDS = {
+        'received_instance': ['refreshed_detail_id'],
+        'opened_email': ['refreshed_open_id', 'refreshed_click_id'],
+        'opened_instance': ['refreshed_open_id', 'refreshed_click_id'],
+        'clicked_link': ['refreshed_click_id'],
+        'clicked_any_url_in_email': ['refreshed_click_id'],
+        'clicked_url_in_instance': ['refreshed_click_id']
+    }
+
+    def _last_ids(self):
+        def last_id(model):
+            return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+        return {
+            'refreshed_recipient_id': last_id(Recipient),
+            'refreshed_detail_id': last_id(InstanceRecipientDetails),
+            'refreshed_open_id': last_id(InstanceOpen),
+            'refreshed_click_id': last_id(URLClick)
+        }
+
+    def _changed_recipients(self, segment, rules):
+        """Returns the pks of recipients whose membership may have changed
+        since the segment's last refresh
+        """
+        watermarks = set()
+        for rule in rules:
+            watermarks.update(self.INCREMENTAL_FIELDS[rule.field])
+
+        def recipient_ids(queryset):
+            return queryset.order_by().values_list('recipient_id', flat=True).distinct()
+
+        # New recipients match exclude only segments, for one
+        changed = set(Recipient.objects.filter(pk__gt=segment.refreshed_recipient_id).values_list('pk', flat=True))
+        if 'refreshed_detail_id' in watermarks:
+            changed.update(recipient_ids(InstanceRecipientDetails.objects.filter(pk__gt=segment.refreshed_detail_id)))
+        if 'refreshed_open_id' in watermarks:
+            changed.update(recipient_ids(InstanceOpen.objects.filter(pk__gt=segment.refreshed_open_id)))
+        if 'refreshed_click_id' in watermarks:
+            changed.update(recipient_ids(URLClick.objects.filter(pk__gt=segment.refreshed_click_id)))
+        return changed
+
+    def _apply(self, segment, recipient_pks, matching):
+        current = set(self.filter(segment=segment, recipient__in=recipient_pks).values_list('recipient_id', flat=True))
+        removed = list(current - matching)
+        for i in range(0, len(removed), self.chunk_size):
+            self.filter(segment=segment, recipient__in=removed[i:i + self.chunk_size]).delete()
+        self.bulk_create(
+            [self.model(segment=segment, recipient_id=pk) for pk in matching - current],
+            batch_size=self.chunk_size)
+        return len(removed), len(matching - current)
+
+    def refresh(self, segment, full=False):
+        """Brings a segment's materialized membership up to date
+
+        Only the recipients with new opens, clicks or recipient details
+        since the last refresh are re-evaluated, unless full is set, the
+        segment was never refreshed, its rules changed or it has rules that
+        depend on untracked changes (attributes and group membership).
+        Deleted opens, clicks and details are only picked up by full
+        refreshes.
+
+        :param segment: The segment to refresh
+        :param full: Re-evaluates every recipient when True
+        :return: The number of memberships removed and added
+        """
+        rules = list(segment.rules.all())
+        signature = segment.rules_signature
+        full = full \
+            or segment.refreshed_at is None \
+            or segment.refreshed_rules != signature \
+            or any(rule.field not in self.INCREMENTAL_FIELDS for rule in rules)
+
+        # Taken first, so rows inserted while refreshing are seen next time
+        refreshed_at = datetime.now()
+        last_ids = self._last_ids()
+
+        with transaction.atomic():
+            if full:
+                matching = set(segment.recipients.values_list('pk', flat=True))
+                current = set(self.filter(segment=segment).values_list('recipient_id', flat=True))
+                removed, added = self._apply(segment, list(current | matching), matching)
+            else:
+                removed = added = 0
+                changed = list(self._changed_recipients(segment, rules))
+                for i in range(0, len(changed), self.chunk_size):
+                    chunk = changed[i:i + self.chunk_size]
+                    matching = set(segment.recipients.filter(pk__in=chunk).values_list('pk', flat=True))
+                    chunk_removed, chunk_added = self._apply(segment, chunk, matching)
+                    removed += chunk_removed
+                    added += chunk_added
+
+            # update() leaves updated_at alone, it tracks edits
+            Segment.objects.filter(pk=segment.pk).update(
+                refreshed_at=refreshed_at,
+                refreshed_rules=signature,
+                **last_ids)
+
+        segment.refreshed_at = refreshed_at
+        segment.refreshed_rules = signature
+        for name, value in last_ids.items():
+            setattr(segment, name, value)
+        return removed, added
+
+
+class SegmentMembership(models.Model):
+    '''
+        A recipient in a segment as of the segment's last refresh.
+    '''
+    objects = SegmentMembershipManager()
+
+    segment = models.ForeignKey(Segment, related_name='memberships', on_delete=models.CASCADE)
+    recipient = models.ForeignKey(Recipient, related_name='segment_memberships', on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = (('segment', 'recipient'))
+
+
 class SubscriptionCategory(models.Model):
     """
         Describes a category of email for subscription purposes.
@@ -342,11 +622,70 @@ class SubscriptionCategory(models.Model):
 
         return False
 
+class CampaignManager(models.Manager):
+    '''
+    A custom manager for updating the average stats of campaigns.
+    '''
+    # Average fields, the CampaignInstanceStat field they average and
+    # the number of digits they are rounded to
+    AVERAGES = (
+        ('avg_open_rate', 'open_rate', 2),
+        ('avg_click_rate', 'click_rate', 2),
+        ('avg_recipient_count', 'recipient_count', None),
+        ('avg_click_to_open_rate', 'click_to_open_rate', None)
+    )
+
+    def _rounded(self, row):
+        return {
+            name: round(row.get(name) or 0, digits)
+            for name, field, digits in self.AVERAGES
+        }
+
+    def _aggregates(self):
+        return {name: Avg(field) for name, field, digits in self.AVERAGES}
+
+    def averages(self, instance_stats):
+        """Averages instance stats with a single aggregate query
+
+        :param instance_stats: A CampaignInstanceStat queryset
+        :return: A dict of the rounded averages by Campaign field name,
+                 all 0 when there are no stats
+        """
+        return self._rounded(instance_stats.aggregate(**self._aggregates()))
+
+    def update_averages(self, campaign_pks=None):
+        """Recomputes the average stats of campaigns with one grouped query
+
+        :param campaign_pks: The campaigns to update, or None for all
+        :return: The number of campaigns updated
+        """
+        stats = CampaignInstanceStat.objects.all()
+        campaigns = self.all()
+        if campaign_pks is not None:
+            stats = stats.filter(campaign__in=campaign_pks)
+            campaigns = campaigns.filter(pk__in=campaign_pks)
+
+        averages = {
+            row['campaign']: self._rounded(row)
+            for row in stats.order_by().values('campaign').annotate(**self._aggregates())
+        }
+        none = self._rounded({})
+
+        updated = [
+            self.model(pk=pk, **averages.get(pk, none))
+            for pk in campaigns.values_list('pk', flat=True)
+        ]
+        self.bulk_update(updated, [name for name, field, digits in self.AVERAGES], batch_size=500)
+        return len(updated)
+
+
 class Campaign(models.Model):
     '''
     Object for defining a campaign. Primarily taxonomical in nature
     this should allow emails and instances to be grouped together logically.
     '''
+    objects = CampaignManager()
+
     name = models.CharField(max_length=300, blank=False, null=False)
     description = models.TextField(blank=True, null=True)
     open_rate_target = models.FloatField(default=25, null=False, blank=False)
@@ -363,40 +702,16 @@ class Campaign(models.Model):
         return self.name
 
     def calc_avg_open_rate(self):
-        aggr = 0
-        for instance in self.instance_stats.all():
-            aggr += instance.open_rate
-
-        return round(aggr / self.instance_stats.count()
-            if self.instance_stats.count() != 0
-            else 0, 2)
+        return Campaign.objects.averages(self.instance_stats.all())['avg_open_rate']
 
     def calc_avg_click_rate(self):
-        aggr = 0
-        for instance in self.instance_stats.all():
-            aggr += instance.click_rate
-
-        return round(aggr / self.instance_stats.count()
-            if self.instance_stats.count() != 0
-            else 0, 2)
+        return Campaign.objects.averages(self.instance_stats.all())['avg_click_rate']
 
     def calc_avg_recipient_count(self):
-        aggr = 0
-        for instance in self.instance_stats.all():
-            aggr += instance.recipient_count
-
-        return round(aggr / self.instance_stats.count()
-            if self.instance_stats.count() != 0
-            else 0)
+        return Campaign.objects.averages(self.instance_stats.all())['avg_recipient_count']
 
     def calc_avg_click_to_open_rate(self):
-        aggr = 0
-        for instance in self.instance_stats.all():
-            aggr += instance.click_to_open_rate
-
-        return round(aggr / self.instance_stats.count()
-            if self.instance_stats.count() != 0
-            else 0)
+        return Campaign.objects.averages(self.instance_stats.all())['avg_click_to_open_rate']
 
     @property
     def mailing_score(self):
@@ -523,29 +838,169 @@ class EmailManager(models.Manager):
             )
         )
 
+    def clear_estimates(self, now=None):
+        """Clears the preview and live estimates of emails that aren't sending
+        today, and of emails sending today whose estimates are from another
+        day (primarily daily emails from yesterday), with two UPDATEs
+
+        :param now: The datetime to clear the estimates as of
+        """
+        if now is None:
+            now = datetime.now()
+
+        self.not_sending_today(today=now.date()).update(preview_est_time=None, live_est_time=None)
+        self.sending_today_old_est(now=now).update(preview_est_time=None, live_est_time=None)
+
+    def estimated_time(self, send_time, send_override, start, offset, exclude=None):
+        """Returns the first processing run, from start until midnight, that
+        sends an email with send_time, or None
+
+        Runs are start + k * PROCESSING_INTERVAL_DURATION, truncated to the
+        minute. A run sends the email if send_time is before the run plus
+        offset and, unless send_override is set, not before the run. Those
+        runs make up at most two intervals of k, before and after the run
+        plus offset passes midnight, plus midnight itself. So the first one
+        is found from where each interval starts (or the run after exclude)
+        instead of by trying every run.
+
+        :param send_time: The time of day the email is sent at
+        :param send_override: Whether the email is sent even if send_time passed
+        :param start: The datetime of the first run
+        :param offset: A timedelta of how far ahead of a run it sends emails
+        :param exclude: A run that can't send the email
+        :return: The datetime of the run, truncated to the minute, or None
+        """
+        interval = self.processing_interval_duration.total_seconds()
+        end = (start + timedelta(days=1)).replace(hour=0, minute=0, second=0)
+        midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        base = start.replace(second=0, microsecond=0)
+        # How far into its minute the first run starts
+        lag = (start - base).total_seconds()
+        last = int((end - start).total_seconds() // interval)
+
+        def run(k):
+            return base + timedelta(minutes=int((lag + k * interval) // 60))
+
+        def first_run(seconds):
+            # The first k whose run is at or after midnight + seconds
+            minutes = -(((base - midnight).total_seconds() - seconds) // 60)
+            return max(0, int(-((lag - minutes * 60) // interval)))
+
+        def sends(k):
+            if not 0 <= k <= last:
+                return False
+            when = run(k)
+            return send_time <= (when + offset).time() and \
+                (when.time() <= send_time or send_override) and \
+                when != exclude
+
+        seconds = send_time.hour * 3600 + send_time.minute * 60 + send_time.second + send_time.microsecond / 1e6
+        candidates = set([
+            first_run(seconds - offset.total_seconds()),
+            first_run(seconds + 86400 - offset.total_seconds()),
+            last
+        ])
+        if exclude is not None:
+            # The run after it, if exclude starts an interval
+            candidates.add(first_run((exclude - midnight).total_seconds() + 1))
+        candidates = sorted(candidates)
+        for k in candidates:
+            if sends(k):
+                return run(k)
+        return None
+
+    def estimate_times(self, now=None):
+        """Sets the preview and live estimates of the emails sending today
+        that don't have them, with one UPDATE each
+
+        :param now: The datetime of the current processing run
+        """
+        if now is None:
+            now = datetime.now()
+
+        def update(field, estimates):
+            estimates = [(pk, estimate) for pk, estimate in estimates if estimate is not None]
+            if estimates:
+                self.filter(pk__in=[pk for pk, estimate in estimates]).update(**{field: Case(
+                    *[When(pk=pk, then=Value(estimate)) for pk, estimate in estimates],
+                    output_field=models.DateTimeField()
+                )})
+
+        preview_offset = timedelta(seconds=settings.PREVIEW_LEAD_TIME) + self.processing_interval_duration
+        update('preview_est_time', [
+            (pk, self.estimated_time(send_time, send_override, now, preview_offset))
+            for pk, send_time, send_override in self.sending_today_no_pre_est(now).values_list(
+                'pk', 'send_time', 'send_override')
+        ])
+
+        # Live emails are not sent by the run that sends their preview
+        update('live_est_time', [
+            (pk, self.estimated_time(send_time, send_override, now, self.processing_interval_duration, preview_est_time))
+            for pk, send_time, send_override, preview_est_time in self.sending_today_no_live_est(now).values_list(
+                'pk', 'send_time', 'send_override', 'preview_est_time')
+        ])
+
+    def _requested_today(self, model, now):
+        """Returns whether a model, Instance or PreviewInstance, exists for
+        the email with a requested_start of today at its send_time
+
+        :param model: The Instance or PreviewInstance model
+        :param now: The datetime of the current processing run
+        :return: An Exists expression for Email querysets
+        """
+        midnight = datetime.combine(now.date(), datetime.min.time())
+        return Exists(model.objects.filter(
+            email=OuterRef('pk'),
+            requested_start__gte=midnight,
+            requested_start__lt=midnight + timedelta(days=1),
+            requested_start__time=OuterRef('send_time')))
+
+    def _in_interval(self, interval_start, interval_end):
+        """Returns the emails whose send_time is in the interval, or before
+        its end if send_override is set
+        """
+        return Q(send_time__gte=interval_start, send_time__lte=interval_end) | \
+            Q(send_time__lte=interval_end, send_override=True)
+
     def sending_now(self, now=None):
         if now is None:
             now = datetime.now()
         send_interval_start = now.time()
         send_interval_end = (now + self.processing_interval_duration).time()
 
-        # Exclude emails outside this sending interval
-        # Exclude emails with instances that have the same requested_start or
-        # or are in progress (end=None)
-        email_pks = []
-        for candidate in Email.objects.sending_today(now=now):
-            requested_start = datetime.combine(now.date(), candidate.send_time)
-            # check if preview has been sent (or no preview requested) and if a send override is set
-            if ((send_interval_start <= candidate.send_time <= send_interval_end) or
-                    (candidate.send_time <= send_interval_end and candidate.send_override)) and \
-                    (not candidate.preview or candidate.previews.filter(requested_start=requested_start).count()):
-
-                # Email is queued to be sent so no need override the send functionality anymore
-                candidate.send_override = False
-                candidate.save()
-                if candidate.instances.filter(requested_start=requested_start).count() == 0:
-                    email_pks.append(candidate.pk)
-        return Email.objects.filter(pk__in=email_pks)
+        # Exclude emails outside this sending interval and emails whose
+        # preview hasn't been sent (when one is requested)
+        candidates = self.sending_today(now=now).filter(
+            self._in_interval(send_interval_start, send_interval_end),
+            Q(preview=False) | Q(self._requested_today(PreviewInstance, now))
+        ).annotate(
+            sent=self._requested_today(Instance, now)
+        ).values_list('pk', 'send_override', 'sent')
+        candidates = list(candidates)
+
+        # Emails are queued to be sent so no need override the send
+        # functionality anymore
+        overridden = [pk for pk, send_override, sent in candidates if send_override]
+        if overridden:
+            Email.objects.filter(pk__in=overridden).update(send_override=False)
+
+        # Exclude emails with instances that have the same requested_start
+        return Email.objects.filter(pk__in=[pk for pk, send_override, sent in candidates if not sent])
+
+    def staging_now(self, now=None):
+        """Returns the emails the next processing run is estimated to send
+        that haven't been staged for today
+
+        :param now: The datetime of the current processing run
+        :return: Email queryset
+        """
+        if now is None:
+            now = datetime.now()
+        return self.sending_today(now=now).filter(
+            ~Q(self._requested_today(StagedSend, now)),
+            live_est_time__gt=now,
+            live_est_time__lte=now + self.processing_interval_duration
+        )
 
     def previewing_now(self, now=None):
         if now is None:
@@ -554,17 +1009,14 @@ class EmailManager(models.Manager):
         preview_interval_start = (now + preview_lead_time).time()
         preview_interval_end = (now + preview_lead_time + self.processing_interval_duration).time()
 
-        # Exclude emails outside this previewing interval
-        # Exclude emails with instances that have the same requested_start or
-        # or are in progress (end=None)
-        email_pks = []
-        for candidate in Email.objects.sending_today(now=now).filter(preview=True):
-            if (preview_interval_start <= candidate.send_time <= preview_interval_end) or \
-                    (candidate.send_time <= preview_interval_end and candidate.send_override):
-                requested_start = datetime.combine(now.date(), candidate.send_time)
-                if candidate.previews.filter(requested_start=requested_start).count() == 0:
-                    email_pks.append(candidate.pk)
-        return Email.objects.filter(pk__in=email_pks)
+        # Exclude emails outside this previewing interval and emails with
+        # previews that have the same requested_start
+        email_pks = self.sending_today(now=now).filter(
+            self._in_interval(preview_interval_start, preview_interval_end),
+            ~Q(self._requested_today(PreviewInstance, now)),
+            preview=True
+        ).values_list('pk', flat=True)
+        return Email.objects.filter(pk__in=list(email_pks))
 
 
 class Email(models.Model):
@@ -725,24 +1177,22 @@ class Email(models.Model):
             raise HTMLContentMissingException()
         else:
             try:
-                # Warm the cache
-                requests.get(self.source_html_uri, verify=False)
-
-                request = requests.get(self.source_html_uri, verify=False)
-
                 # Get the email html
-                html = request.text
-                return (request.status_code, html)
+                content = content_fetcher().fetch(self.source_html_uri)
+                return (content.status_code, content.text)
             except IOError as e:
                 log.exception('Unable to fetch email html')
                 raise self.EmailException()
 
-    @property
-    def placeholders(self):
+    def find_placeholders(self, html):
         delimiter    = self.replace_delimiter
-        placeholders = re.findall(re.escape(delimiter) + '(.+)' + re.escape(delimiter), self.html[1])
+        placeholders = re.findall(re.escape(delimiter) + '(.+)' + re.escape(delimiter), html)
         return [p for p in placeholders if p.lower() != 'unsubscribe']
 
+    @property
+    def placeholders(self):
+        return self.find_placeholders(self.html[1])
+
     @property
     def recipients(self):
         retval = None
@@ -754,9 +1204,9 @@ class Email(models.Model):
 
         for segment in self.segments.all():
             if retval is None:
-                retval = segment.recipients.all()
+                retval = segment.current_recipients.all()
             else:
-                retval = retval | segment.recipients.all()
+                retval = retval | segment.current_recipients.all()
 
         return retval.distinct()
 
@@ -771,16 +1221,59 @@ class Email(models.Model):
             raise self.TextContentMissingException()
         else:
             try:
-                # Warm the cache
-                urllib.request.urlopen(self.source_text_uri)
-
                 # Get the email text
-                page = urllib.request.urlopen(self.source_text_uri)
-                content = page.read()
-                return content.encode('ascii', 'ignore')
+                content = content_fetcher().fetch(self.source_text_uri)
             except IOError as e:
                 log.exception('Unable to fetch email text')
                 raise self.EmailException()
+            if content.status_code != requests.codes.ok:
+                log.error('Email text request returned status code ' + str(content.status_code))
+                raise self.EmailException()
+            return content.text.encode('ascii', 'ignore').decode('ascii')
+
+    def live_content(self):
+        '''
+            The html and text (None if there is none) of a live send: the
+            content of today's preview if it's locked, else the current
+            content. Raises EmailException if the html can't be fetched.
+        '''
+        # Check to see if there is a content lock on the preview email
+        # otherwise grab the new content
+        preview_email = self.todays_preview
+        if preview_email is not None and \
+           preview_email.lock_content and \
+           preview_email.sent_html:
+            return (preview_email.sent_html, None)
+
+        try:
+            text = self.text
+        except self.TextContentMissingException:
+            text = None
+
+        status_code, html = self.html
+        if status_code != requests.codes.ok:
+            log.exception('Not sending Live email. HTML request returned status code ' + str(status_code))
+            raise self.EmailException()
+        return (html, text)
+
+    @property
+    def staging_signature(self):
+        '''
+            A hash of the fields a staged send is built from, which changes
+            whenever they, the email's groups or its segments' rules do.
+        '''
+        values = [
+            self.subject,
+            self.source_html_uri,
+            self.source_text_uri,
+            self.replace_delimiter,
+            self.track_urls,
+            self.subscription_category_id,
+            self.track_opens,
+            sorted(self.recipient_groups.values_list('pk', flat=True)),
+            [(segment.pk, segment.rules_signature) for segment in self.segments.order_by('pk')]
+        ]
+        return hashlib.sha1(repr(values).encode()).hexdigest()
 
     def send_preview(self):
         '''
@@ -834,11 +1327,10 @@ class Email(models.Model):
         else:
             log.debug('email_address not set for creator')
 
+        pool = amazon_smtp_pool()
         try:
-            amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'],
-                                      settings.AMAZON_SMTP['port'])
-            amazon.login(settings.AMAZON_SMTP['username'],
-                         settings.AMAZON_SMTP['password'])
+            # Make sure a connection can be made before creating the preview
+            pool.release(pool.acquire())
         except smtplib.SMTPException as e:
             log.exception('Unable to connect to Amazon')
             raise self.AmazonConnectionException()
@@ -864,12 +1356,12 @@ class Email(models.Model):
                     msg.attach_text(text_explanation + text)
 
                 try:
-                    amazon.sendmail(self.from_email_address,
-                                    recipient,
-                                    msg.as_string())
+                    amazon_rate_limiter().acquire()
+                    pool.sendmail(self.from_email_address,
+                                  recipient,
+                                  msg.as_string())
                 except smtplib.SMTPException as e:
                     log.exception('Unable to send email.')
-            amazon.quit()
 
     def send(self, additional_subject=''):
         '''
@@ -897,7 +1389,7 @@ class Email(models.Model):
                         instance.send_terminate = True
                         instance.save()
                         break
-                    elif recipient_details_queue.empty():
+                    elif producer_done.is_set() and recipient_details_queue.empty():
                         break
                     else:
                         time.sleep(1)
@@ -914,169 +1406,137 @@ class Email(models.Model):
                 error              = False
                 error_counter      = 0
                 rate_limit_counter = 0
+                # Details that failed for a transient reason are retried by
+                # this thread instead of being put back on the bounded queue,
+                # which could block every thread while the queue is full.
+                retry              = None
 
-                while True:
-                    if recipient_details_queue.empty():
-                        log.debug('%s queue empty, exiting.' % self.name)
-                        break
-
-                    if sender_stop.is_set():
-                        log.debug('%s receieved termination signal.' % self.name)
-                        while not recipient_details_queue.empty():
-                            recipient_details_queue.get()
-                            recipient_details_queue.task_done()
-                        break
-
-                    recipient_details = recipient_details_queue.get()
-
-                    try:
-                        if amazon is None or reconnect:
+                try:
+                    while True:
+                        if sender_stop.is_set():
+                            log.debug('%s receieved termination signal.' % self.name)
+                            if retry is not None:
+                                recipient_details_queue.task_done()
+                            while not (producer_done.is_set() and recipient_details_queue.empty()):
+                                try:
+                                    recipient_details_queue.get(timeout=1)
+                                except Empty:
+                                    continue
+                                recipient_details_queue.task_done()
+                            break
+
+                        if retry is not None:
+                            recipient_details, retry = retry, None
+                        else:
                             try:
-                                amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'], settings.AMAZON_SMTP['port'])
-                                amazon.login(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
-                            except:
-                                if reconnect_counter == SendingThread._AMAZON_RECONNECT_THRESHOLD:
-                                    log.debug('%s, reached reconnect threshold, exiting')
-                                    raise
-                                reconnect_counter += 1
-                                reconnect         = True
+                                recipient_details = recipient_details_queue.get(timeout=1)
+                            except Empty:
+                                if producer_done.is_set() and recipient_details_queue.empty():
+                                    log.debug('%s queue empty, exiting.' % self.name)
+                                    break
                                 continue
-                            else:
-                                reconnect = False
-
-                        # Customize the email for this recipient
-                        customized_html = recipient_details.instance.sent_html
-                        # Replace template placeholders
-                        delimiter = recipient_details.instance.email.replace_delimiter
-                        for placeholder in placeholders:
-                            replacement = ''
-                            if placeholder.lower() != 'unsubscribe':
-                                if recipient_attributes[recipient_details.recipient.pk][placeholder] is None:
-                                    log.error('Recipient %s is missing attribute %s' % (str(recipient_details.recipient), placeholder))
-                                else:
-                                    replacement = recipient_attributes[recipient_details.recipient.pk][placeholder]
-                                customized_html = customized_html.replace(delimiter + placeholder + delimiter, replacement)
-                        # URL Tracking
-                        if recipient_details.instance.urls_tracked:
-                            for url in tracking_urls:
-                                tracking_url = '?'.join([
-                                    settings.PROJECT_URL + reverse('manager-email-redirect'),
-                                    urllib.parse.urlencode({
-                                        'instance'  :recipient_details.instance.pk,
-                                        'recipient' :recipient_details.recipient.pk,
-                                        'url'       :urllib.parse.quote(url.name),
-                                        'position'  :url.position,
-                                        # The mac uniquely identifies the recipient and acts as a secure integrity check
-                                        'mac'       :calc_url_mac(url.name, url.position, recipient_details.recipient.pk, recipient_details.instance.pk)
-                                    })
-                                ])
-
-                                customized_html = customized_html.replace(
-                                    'href="' + url.name + '"',
-                                    'href="' + tracking_url + '"',
-                                    1
-                                )
-                        # Open Tracking
-                        if recipient_details.instance.opens_tracked:
-                            customized_html += '<img src="%s" />' % '?'.join([
-                                settings.PROJECT_URL + reverse('manager-email-open'),
-                                urllib.parse.urlencode({
-                                    'recipient':recipient_details.recipient.pk,
-                                    'instance' :recipient_details.instance.pk,
-                                    'mac'      :calc_open_mac(recipient_details.recipient.pk, recipient_details.instance.pk)
-                                })
-                            ])
-                        # Unsubscribe link
-                        customized_html = re.sub(
-                            re.escape(delimiter) + 'UNSUBSCRIBE' + re.escape(delimiter),
-                            '<a href="%s" style="color:blue;text-decoration:none;">unsubscribe</a>' % recipient_details.recipient.unsubscribe_url,
-                            customized_html)
-
-                        # Construct the message
-                        msg = EmailMessage(
-                            subject=subject,
-                            from_friendly_name=from_friendly_name,
-                            from_address=from_address,
-                            to_address=recipient_details.recipient.email_address,
-                            html=customized_html
-                        )
-                        if text is not None:
-                            msg.attach_text(text)
-
-                        log.debug('thread: %s, email: %s' % (self.name, recipient_details.recipient.email_address))
+
                         try:
-                            amazon.sendmail(real_from, recipient_details.recipient.email_address, msg.as_string())
-                        except smtplib.SMTPResponseException as e:
-                            if e.smtp_error.find('Maximum sending rate exceeded'.encode()) >= 0:
-                                recipient_details_queue.put(recipient_details)
-                                log.debug('thread %s, maximum sending rate exceeded, sleeping for a bit')
+                            if amazon is None or reconnect:
+                                try:
+                                    if amazon is not None:
+                                        pool.discard(amazon)
+                                        amazon = None
+                                    amazon = pool.acquire()
+                                except:
+                                    if reconnect_counter == SendingThread._AMAZON_RECONNECT_THRESHOLD:
+                                        log.debug('%s, reached reconnect threshold, exiting')
+                                        raise
+                                    reconnect_counter += 1
+                                    reconnect         = True
+                                    retry             = recipient_details
+                                    continue
+                                else:
+                                    reconnect = False
+
+                            # Customize the email for this recipient, unless it
+                            # was already rendered by the render pool
+                            message = getattr(recipient_details, 'message', None)
+                            if message is None:
+                                message = build_message(
+                                    template,
+                                    message_factory,
+                                    recipient_details.recipient,
+                                    recipient_attributes[recipient_details.recipient.pk])
+
+                            log.debug('thread: %s, email: %s' % (self.name, recipient_details.recipient.email_address))
+                            try:
+                                limiter.acquire()
+                                amazon.sendmail(real_from, recipient_details.recipient.email_address, message)
+                            except smtplib.SMTPResponseException as e:
+                                if e.smtp_error.find('Maximum sending rate exceeded'.encode()) >= 0:
+                                    retry = recipient_details
+                                    log.debug('thread %s, maximum sending rate exceeded, draining the rate limiter' % self.name)
+                                    limiter.drain()
+                                else:
+                                    recipient_details.exception_msg = str(e)
+                            except smtplib.SMTPServerDisconnected:
+                                # Connection error
+                                log.debug('thread %s, connection error, sleeping for a bit')
                                 time.sleep(float(1) + random.random())
-                            else:
+                                retry     = recipient_details
+                                reconnect = True
+                            except Exception as e:
+                                # General error
+                                log.debug('thread %s, error: %s', (self.name, str(e)))
                                 recipient_details.exception_msg = str(e)
-                        except smtplib.SMTPServerDisconnected:
-                            # Connection error
-                            log.debug('thread %s, connection error, sleeping for a bit')
-                            time.sleep(float(1) + random.random())
-                            recipient_details_queue.put(recipient_details)
-                            reconnect = True
+                            else:
+                                recipient_details.when = datetime.now()
+                            finally:
+                                if retry is None:
+                                    recorder.record(
+                                        recipient_details.pk,
+                                        recipient_details.when,
+                                        recipient_details.exception_msg)
                         except Exception as e:
-                            # General error
-                            log.debug('thread %s, error: %s', (self.name, str(e)))
-                            recipient_details.exception_msg = str(e)
-                        else:
-                            recipient_details.when = datetime.now()
-                        finally:
-                            recipient_details.save()
-                    except Exception as e:
-                        if error_counter == SendingThread._ERROR_THRESHOLD:
-                            recipient_details_queue.task_done()
-                            log.debug('%s, reached error threshold, exiting')
-                            recipient_details_queue.queue.clear()
-                            return
-                        error_counter += 1
-                        log.exception('%s exception' % self.name)
+                            retry = None
+                            if error_counter == SendingThread._ERROR_THRESHOLD:
+                                recipient_details_queue.task_done()
+                                log.debug('%s, reached error threshold, exiting')
+                                sender_stop.set()
+                                continue
+                            error_counter += 1
+                            log.exception('%s exception' % self.name)
 
-                    recipient_details_queue.task_done()
+                        if retry is None:
+                            recipient_details_queue.task_done()
+                finally:
+                    if amazon is not None:
+                        if reconnect:
+                            pool.discard(amazon)
+                        else:
+                            pool.release(amazon)
 
 
-        # Check to see if there is a content lock on the preview email
-        # otherwise grab the new content
-        preview_email = self.todays_preview
-        if preview_email is not None and \
-           preview_email.lock_content and \
-           preview_email.sent_html:
-            html = preview_email.sent_html
-            text = None
-        else:
-            try:
-                text = self.text
-            except self.TextContentMissingException:
-                text = None
+        html, text = self.live_content()
+        requested_start = datetime.combine(datetime.now().today(), self.send_time)
 
-            status_code, html = self.html
-            if status_code != requests.codes.ok:
-                log.exception('Not sending Live email. HTML request returned status code ' + str(status_code))
-                raise self.EmailException()
+        # Content, recipients, URLs and attributes staged by mailer-process
+        # before the send, unless the email or its content changed since
+        staged = StagedSend.objects.current(self, requested_start, html, text)
 
         instance = Instance.objects.create(
             email           = self,
             subject         = self.subject,
             sent_html       = html,
-            requested_start = datetime.combine(datetime.now().today(), self.send_time),
+            requested_start = requested_start,
             opens_tracked   = self.track_opens,
             urls_tracked    = self.track_urls,
-            campaign        = self.campaign
+            campaign        = self.campaign,
+            # Counted from the start, no need to reconcile
+            counters_current = True
         )
+        self.staged_sends.all().delete()
 
-        recipients = self.recipients.filter(disable=False)
-
-        if self.subscription_category:
-            unsubscriptions = self.subscription_category.unsubscriptions.all()
-        else:
-            unsubscriptions = self.unsubscriptions.all()
-
-        if unsubscriptions:
-            recipients = recipients.exclude(id__in=[o.id for o in unsubscriptions])
+        # Resolved as sets of ids rather than by joining the groups,
+        # segments and unsubscriptions. Unsubscribes since staging still
+        # apply
+        recipients = email_audience(self, staged.recipients if staged else None).recipients()
 
         # Add email creator email to recipient list
         if self.creator.email:
@@ -1096,49 +1556,137 @@ class Email(models.Model):
         from_address            = self.from_email_address
         from_friendly_name      = self.from_friendly_name
         real_from               = self.from_email_address
-        recipient_details_queue = Queue()
+        batch_size              = getattr(settings, 'SEND_BATCH_SIZE', 500)
+        render_processes        = getattr(settings, 'SEND_RENDER_PROCESSES', 0)
+        queue_size              = getattr(settings, 'SEND_QUEUE_SIZE', 2000)
+        if render_processes > 0:
+            # Queued recipients carry their rendered message
+            queue_size = min(queue_size, batch_size)
+        recipient_details_queue = Queue(queue_size)
         sender_stop             = threading.Event()
+        producer_done           = threading.Event()
         success                 = True
-        recipient_attributes    = {}
-        placeholders            = instance.placeholders
-        tracking_urls           = instance.tracking_urls
-
-
-        # Create all the instancerecipientdetails before hand so in case sending
-        # fails, we know who hasn't been sent too
-        # Here, also, we want to lookup the recipients attributes that are used
-        # in the template. Do this upfront because looking up each one in the
-        # sending loop is too slow
+        limiter                 = amazon_rate_limiter()
+        pool                    = amazon_smtp_pool()
+        placeholders            = staged.placeholders if staged else instance.placeholders
+        tracking_urls           = instance.register_urls(staged.urls) if staged and instance.urls_tracked else instance.tracking_urls
+        template                = EmailTemplate(instance, placeholders, tracking_urls, state=staged.template_state if staged else None)
+        # Headers and the text part are the same for every recipient
+        message_factory         = MessageFactory(subject, from_friendly_name, from_address, text)
+
+
+        # Lookup the recipients attributes that are used in the template.
+        # Do this upfront because looking up each one in the sending loop
+        # is too slow
         log.debug('building recipients and recipient attributes...')
-        # Get all recipient attributes
-        for recipient in recipients:
-            recipient_attributes[recipient.pk] = {}
-            for placeholder in placeholders:
-                try:
-                    recipient_attributes[recipient.pk][placeholder] = getattr(recipient, placeholder)
-                except AttributeError:
-                    recipient_attributes[recipient.pk][placeholder] = None
+        recipients = list(recipients)
+        if staged:
+            recipient_attributes = staged.attributes
+            unstaged = [r for r in recipients if r.pk not in recipient_attributes]
+            recipient_attributes.update(Recipient.attributes_for(unstaged, placeholders))
+        else:
+            recipient_attributes = Recipient.attributes_for(recipients, placeholders)
 
+        # Optionally build the messages in worker processes, so rendering
+        # isn't serialized by the GIL with the sending threads
+        if render_processes > 0:
+            render_pool = RenderPool(render_processes, template, message_factory)
+        else:
+            render_pool = None
 
-            recipient_details_queue.put(
-                InstanceRecipientDetails.objects.create(
-                    recipient = recipient,
-                    instance  = instance))
+        if getattr(settings, 'SEND_ENGINE', 'threads') == 'asyncio':
+            log.debug('sending with the asyncio engine...')
+            try:
+                AsyncEmailSender(
+                    instance,
+                    template,
+                    message_factory,
+                    recipient_attributes,
+                    render_pool=render_pool
+                ).send(recipients)
+            finally:
+                if render_pool is not None:
+                    render_pool.shutdown()
+
+            instance.end = datetime.now()
+            instance.save()
+            return
 
         log.debug('spin up sending threads...')
         html_lock        = threading.Lock()
 
+        # Send outcomes are written in batches by the recorder instead of
+        # one UPDATE per recipient from every sending thread
+        recorder = ResultRecorder(instance.pk)
+        recorder.start()
+
         terminate_thread = TerminationThread()
         terminate_thread.daemon = True
         terminate_thread.start()
 
-        for i in range(0, settings.AMAZON_SMTP['rate'] - 1):
+        # Each sending thread holds one pooled connection
+        for i in range(0, min(settings.AMAZON_SMTP['rate'] - 1, pool.size)):
             sending_thread = SendingThread()
             sending_thread.daemon = True
             sending_thread.start()
 
+        # Batches being rendered by the render pool, oldest first, and how
+        # many are rendered ahead of the one being queued
+        rendering    = deque()
+        render_ahead = 2
+
+        def queue_rendered(batch, futures):
+            for recipient_details, message in zip(batch, RenderPool.results(futures)):
+                recipient_details.message = message
+                recipient_details_queue.put(recipient_details)
+
+        # Create the instancerecipientdetails in batches so in case sending
+        # fails, we know who hasn't been sent too. Each batch is queued as
+        # soon as it is written (and rendered) so sending starts after the
+        # first batch instead of after the whole recipient list. The queue
+        # is bounded, so this blocks while the sending threads catch up.
+        try:
+            for i in range(0, len(recipients), batch_size):
+                if recorder.error is not None:
+                    # Outcomes aren't being recorded, so stop sending
+                    # rather than send to recipients that will look unsent
+                    sender_stop.set()
+                if sender_stop.is_set():
+                    break
+                batch = InstanceRecipientDetails.objects.create_batch(
+                    instance,
+                    recipients[i:i + batch_size]
+                )
+                if render_pool is None:
+                    for recipient_details in batch:
+                        recipient_details_queue.put(recipient_details)
+                    continue
+
+                # The workers render the next batches while this one is
+                # queued and sent
+                rendering.append((batch, render_pool.submit([d.recipient for d in batch], recipient_attributes)))
+                if len(rendering) > render_ahead:
+                    queue_rendered(*rendering.popleft())
+
+            while rendering and not sender_stop.is_set():
+                queue_rendered(*rendering.popleft())
+        except:
+            sender_stop.set()
+            producer_done.set()
+            recipient_details_queue.join()
+            recorder.stop()
+            raise
+        finally:
+            producer_done.set()
+            if render_pool is not None:
+                for batch, futures in rendering:
+                    RenderPool.cancel(futures)
+                render_pool.shutdown()
+
         # Block the main thread until the queue is empty
         recipient_details_queue.join()
+        recorder.stop()
+        log.debug('rate limiter: %s' % limiter.stats())
 
         instance.end = datetime.now()
         instance.save()
@@ -1153,10 +1701,92 @@ def on_post_save_email(sender, instance, **kwargs):
             campaign=instance.campaign
         )
 
+class InstanceManager(models.Manager):
+    '''
+    A custom manager for maintaining the engagement counters of instances.
+    '''
+    def increment_counters(self, pk, **counts):
+        """Atomically adds to an instance's counters
+
+        :param pk: The primary key of the instance
+        :param counts: Counter field names and the amounts to add
+        """
+        counts = {name: F(name) + count for name, count in counts.items() if count}
+        if counts:
+            self.filter(pk=pk).update(**counts)
+
+    def reconcile_counters(self, instance_pks=None):
+        """Recomputes the counters from the raw tables and marks them current
+
+        :param instance_pks: The instances to reconcile, or None for all
+        :return: The number of instances reconciled
+        """
+        def grouped(queryset, instance_field, count):
+            if instance_pks is not None:
+                queryset = queryset.filter(**{instance_field + '__in': instance_pks})
+            return dict(
+                queryset.order_by()
+                        .values(instance_field)
+                        .annotate(total=count)
+                        .values_list(instance_field, 'total')
+            )
+
+        details = InstanceRecipientDetails.objects.all()
+        opened = InstanceOpen.objects.filter(
+            instance_id=OuterRef('url__instance_id'),
+            recipient_id=OuterRef('recipient_id'))
+
+        recipients = grouped(details, 'instance', Count('pk'))
+        sent = grouped(details.exclude(when=None), 'instance', Count('pk'))
+        openers = grouped(InstanceOpen.objects.all(), 'instance', Count('recipient', distinct=True))
+        reopens = grouped(InstanceOpen.objects.filter(is_reopen=True), 'instance', Count('pk'))
+        clicks = grouped(URLClick.objects.all(), 'url__instance', Count('pk'))
+        clickers = grouped(URLClick.objects.all(), 'url__instance', Count('recipient', distinct=True))
+        # Recipients who clicked without their open being tracked count
+        # as openers too
+        unopened_clickers = grouped(
+            URLClick.objects.annotate(opened=Exists(opened)).filter(opened=False),
+            'url__instance',
+            Count('recipient', distinct=True))
+
+        instances = self.all()
+        if instance_pks is not None:
+            instances = instances.filter(pk__in=instance_pks)
+
+        reconciled = [
+            self.model(
+                pk=pk,
+                recipient_total=recipients.get(pk, 0),
+                sent_total=sent.get(pk, 0),
+                opener_total=openers.get(pk, 0) + unopened_clickers.get(pk, 0),
+                reopen_total=reopens.get(pk, 0),
+                click_total=clicks.get(pk, 0),
+                clicker_total=clickers.get(pk, 0),
+                counters_current=True
+            )
+            for pk in instances.values_list('pk', flat=True)
+        ]
+        self.bulk_update(reconciled, self.model.COUNTERS, batch_size=500)
+        return len(reconciled)
+
+
 class Instance(models.Model):
     '''
         Describes what happens when an email is actual sent.
     '''
+    objects = InstanceManager()
+
+    # Fields that are only written with InstanceManager's atomic updates
+    COUNTERS = (
+        'recipient_total',
+        'sent_total',
+        'opener_total',
+        'reopen_total',
+        'click_total',
+        'clicker_total',
+        'counters_current'
+    )
+
     email = models.ForeignKey(Email, related_name='instances', on_delete=models.CASCADE)
     subject = models.TextField(null=True, max_length=998)
     sent_html = models.TextField()
@@ -1171,6 +1801,28 @@ class Instance(models.Model):
     send_terminate = models.BooleanField(default=False)
     campaign = models.ForeignKey(Campaign, related_name='instances', null=True, on_delete=models.SET_NULL)
 
+    # Engagement counters, kept current by the send and tracking paths so
+    # stats are read without counting the raw tables. Instances created
+    # before the counters existed are counted until they are reconciled
+    # with the reconcile-instance-counters command.
+    recipient_total = models.PositiveIntegerField(default=0)
+    sent_total = models.PositiveIntegerField(default=0)
+    opener_total = models.PositiveIntegerField(default=0)
+    reopen_total = models.PositiveIntegerField(default=0)
+    click_total = models.PositiveIntegerField(default=0)
+    clicker_total = models.PositiveIntegerField(default=0)
+    counters_current = models.BooleanField(default=False)
+
+    def save(self, *args, **kwargs):
+        # Saving a copy of the instance loaded before a counter changed
+        # must not undo the change
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTERS
+            ]
+        super(Instance, self).save(*args, **kwargs)
+
     @property
     def in_progress(self):
         if self.start is not None and self.end is None and self.send_terminate is False:
@@ -1189,10 +1841,14 @@ class Instance(models.Model):
     @property
     @lru_cache(1)
     def recipient_details_count(self):
+        if self.counters_current:
+            return self.recipient_total
         return self.recipient_details.count()
 
     @property
     def sent_count(self):
+        if self.counters_current:
+            return self.sent_total
         return self.recipient_details.exclude(when=None).count()
 
     @property
@@ -1217,6 +1873,8 @@ class Instance(models.Model):
         Returns the number of recipients that either opened
         or interacted with the instance at least once.
         """
+        if self.counters_current:
+            return self.opener_total
         recipient_open_ids = InstanceOpen.objects.filter(instance=self).values_list('recipient_id')
         recipient_click_ids = URLClick.objects.filter(url__instance=self).values_list('recipient_id')
         return len(set(recipient_open_ids).union(set(recipient_click_ids)))
@@ -1230,37 +1888,74 @@ class Instance(models.Model):
 
     @property
     def re_opens(self):
+        if self.counters_current:
+            return self.reopen_total
         return self.opens.exclude(is_reopen=False).count()
 
     @property
     def placeholders(self):
-        delimiter    = self.email.replace_delimiter
-        placeholders = re.findall(re.escape(delimiter) + '(.+)' + re.escape(delimiter), self.sent_html)
-        return [p for p in placeholders if p.lower() != 'unsubscribe']
+        return self.email.find_placeholders(self.sent_html)
 
-    @property
-    def tracking_urls(self):
-        if not self.urls_tracked:
-            return []
+    # The URLs registered for the links in sent_html
+    _tracking_urls = None
 
-        hrefs = re.findall('<a(?:[\s\w\-\"=\':;#\(\),]+)?href=\"([^\"]+)\"', self.sent_html)
-        urls  = []
+    # The href of every <a> tag, in order
+    _HREF_PATTERN = re.compile('<a(?:[\s\w\-\"=\':;#\(\),]+)?href=\"([^\"]+)\"')
 
-        for href in hrefs:
-            # Check to see if this URL is trackable. Links that don't start
-            # with http, https or ftp will raise a SuspiciousOperation exception
-            # when you try to HttpResponseRedirect them.
-            # See HttpResponseRedirectBase in django/http/__init__.py
+    @classmethod
+    def trackable_hrefs(cls, html):
+        """
+        Returns the hrefs of the links in html that are tracked, in order.
+        """
+        # Links with a scheme other than http, https or ftp can't be
+        # redirected to, see HttpResponseRedirectBase in django/http
+        allowed_schemes = HttpResponseRedirect.allowed_schemes
+        trackable = []
+        for href in cls._HREF_PATTERN.findall(html):
             try:
-                HttpResponseRedirect(href)
-            except SuspiciousOperation:
+                scheme = urllib.parse.urlparse(href).scheme
+            except ValueError:
                 continue
-            else:
-                urls.append(URL.objects.get_or_create(
-                    instance = self,
-                    name     = href,
-                    position = URL.objects.filter(instance=self, name=href).count())[0])
-        return urls
+            if not scheme or scheme in allowed_schemes:
+                trackable.append(href)
+        return trackable
+
+    def register_urls(self, hrefs):
+        """
+        Returns the URLs of the instance for the trackable hrefs of its
+        sent_html, in order, with one query for the existing ones and one
+        bulk insert of the rest, and keeps them as its tracking_urls. A
+        repeated href gets the next position, so registering the same
+        hrefs again returns the same URLs.
+        """
+        keys = []
+        positions = Counter()
+        for href in hrefs:
+            keys.append((href, positions[href]))
+            positions[href] += 1
+
+        def existing():
+            return {(url.name, url.position): url for url in URL.objects.filter(instance=self)}
+
+        urls = existing()
+        missing = list(OrderedDict.fromkeys(key for key in keys if key not in urls))
+        if missing:
+            URL.objects.bulk_create([
+                URL(instance=self, name=name, position=position)
+                for name, position in missing
+            ])
+            # bulk_create doesn't set the pks on MySQL
+            urls = existing()
+        self._tracking_urls = [urls[key] for key in keys]
+        return self._tracking_urls
+
+    @property
+    def tracking_urls(self):
+        if not self.urls_tracked:
+            return []
+        if self._tracking_urls is None:
+            self.register_urls(self.trackable_hrefs(self.sent_html))
+        return self._tracking_urls
 
     @property
     def clicks(self):
@@ -1274,6 +1969,8 @@ class Instance(models.Model):
         """
         Returns the total count of clicks
         """
+        if self.counters_current:
+            return self.click_total
         return self.clicks.count()
 
     @property
@@ -1290,6 +1987,8 @@ class Instance(models.Model):
         The number of recipients who clicked on
         at least one URL in the email.
         """
+        if self.counters_current:
+            return self.clicker_total
         return len(set(URLClick.objects.filter(url__instance=self).values_list('recipient_id', flat=True)))
 
     @property
@@ -1361,11 +2060,185 @@ class PreviewInstance(models.Model):
         ordering = ('-when',)
 
 
+class StagedSendManager(models.Manager):
+    '''
+    A custom manager for staging live sends ahead of their send time.
+    '''
+    def stage(self, email, requested_start):
+        """Fetches the content of a live send and resolves its recipients,
+        placeholders, tracked URLs and the recipients' attributes, so the
+        send can start sending right away
+
+        Content of a locked preview is used like Email.send does, and the
+        html is compiled into the send's EmailTemplate. The recipients are
+        staged before unsubscribes and disabled recipients are removed,
+        which happens at the send. Attributes that change between staging
+        and the send aren't picked up.
+
+        :param email: The email to stage
+        :param requested_start: The datetime the email is sent for
+        :return: The StagedSend
+        """
+        signature = email.staging_signature
+        html, text = email.live_content()
+        recipients = email_recipients(email)
+        placeholders = email.find_placeholders(html)
+        urls = Instance.trackable_hrefs(html) if email.track_urls else []
+
+        attributes = {}
+        for chunk in recipients.chunks(RecipientAttribute.objects.chunk_size):
+            attributes.update(Recipient.attributes_for(
+                list(Recipient.objects.filter(pk__in=chunk)),
+                placeholders))
+
+        # The compiled template doesn't depend on the pks of the instance
+        # and its URLs, which don't exist yet. Stand-ins give the tracking
+        # links the same format as the send's
+        instance = Instance(
+            pk=0,
+            email=email,
+            sent_html=html,
+            opens_tracked=email.track_opens,
+            urls_tracked=email.track_urls)
+        positions = Counter()
+        tracking_urls = []
+        for name in urls:
+            tracking_urls.append(URL(pk=0, name=name, position=positions[name]))
+            positions[name] += 1
+        template = EmailTemplate(instance, placeholders, tracking_urls)
+
+        staged, created = self.update_or_create(
+            email=email,
+            requested_start=requested_start,
+            defaults={
+                'signature': signature,
+                'content_hash': StagedSend.hash_content(html, text),
+                'recipient_data': recipients.bits.to_bytes((recipients.bits.bit_length() + 7) >> 3, 'little'),
+                'placeholder_data': json.dumps(placeholders),
+                'url_data': json.dumps(urls),
+                'attribute_data': zlib.compress(json.dumps(attributes).encode('utf-8')),
+                'template_data': zlib.compress(json.dumps(template.state()).encode('utf-8'))
+            })
+        return staged
+
+    def current(self, email, requested_start, html, text):
+        """Returns the send staged for the email at requested_start, unless
+        the email or its content changed since it was staged
+
+        :param email: The email being sent
+        :param requested_start: The datetime the email is sent for
+        :param html: The html being sent
+        :param text: The text being sent, or None
+        :return: The StagedSend or None
+        """
+        try:
+            staged = self.get(email=email, requested_start=requested_start)
+        except StagedSend.DoesNotExist:
+            return None
+
+        if staged.signature != email.staging_signature or \
+           staged.content_hash != StagedSend.hash_content(html, text):
+            log.info('Not using the staged send of %s, it changed since it was staged' % email.title)
+            staged.delete()
+            return None
+        return staged
+
+
+class StagedSend(models.Model):
+    '''
+        The content, recipients, placeholders, tracked URLs and recipient
+        attributes of a live send, resolved by mailer-process the run
+        before the email is sent.
+    '''
+    objects = StagedSendManager()
+
+    email = models.ForeignKey(Email, related_name='staged_sends', on_delete=models.CASCADE)
+    requested_start = models.DateTimeField()
+    staged_at = models.DateTimeField(auto_now_add=True)
+    # Email.staging_signature and a hash of the content when staged. The
+    # content itself is fetched again at the send to check it's unchanged
+    signature = models.CharField(max_length=40)
+    content_hash = models.CharField(max_length=40)
+    # A RecipientBitmap's bytes, little endian
+    recipient_data = models.BinaryField()
+    placeholder_data = models.TextField()
+    url_data = models.TextField()
+    # zlib compressed JSON of recipient pk to attribute name to value
+    attribute_data = models.BinaryField()
+    # zlib compressed JSON of the html's compiled EmailTemplate.state()
+    template_data = models.BinaryField(default=b'')
+
+    @staticmethod
+    def hash_content(html, text):
+        return hashlib.sha1(repr((html, text)).encode()).hexdigest()
+
+    @property
+    def recipients(self):
+        return RecipientBitmap(int.from_bytes(bytes(self.recipient_data), 'little'))
+
+    @property
+    def placeholders(self):
+        return json.loads(self.placeholder_data)
+
+    @property
+    def urls(self):
+        return json.loads(self.url_data)
+
+    @property
+    def attributes(self):
+        attributes = json.loads(zlib.decompress(bytes(self.attribute_data)).decode('utf-8'))
+        return {int(pk): values for pk, values in attributes.items()}
+
+    @property
+    def template_state(self):
+        if not self.template_data:
+            return None
+        return json.loads(zlib.decompress(bytes(self.template_data)).decode('utf-8'))
+
+    class Meta:
+        unique_together = (('email', 'requested_start'))
+
+
+class InstanceRecipientDetailsManager(models.Manager):
+    '''
+    A custom manager for creating the recipient details of an instance
+    in batches.
+    '''
+    def create_batch(self, instance, recipients):
+        """Inserts the recipient details for a batch of recipients
+
+        :param instance: The instance being sent
+        :param recipients: A list of recipients
+        :return: The created InstanceRecipientDetails, in recipient order,
+                 with their primary keys set and recipients cached
+        """
+        details = self.bulk_create([
+            self.model(recipient=recipient, instance=instance)
+            for recipient in recipients
+        ])
+
+        if details and details[-1].pk is None:
+            # The database backend does not return primary keys from
+            # bulk inserts (e.g. MySQL). Only the sending process creates
+            # details for an instance, so the newest rows are this batch.
+            pks = list(
+                self.filter(instance=instance)
+                    .order_by('-pk')
+                    .values_list('pk', flat=True)[:len(details)]
+            )
+            for detail, pk in zip(details, reversed(pks)):
+                detail.pk = pk
+
+        Instance.objects.increment_counters(instance.pk, recipient_total=len(details))
+        return details
+
+
 class InstanceRecipientDetails(models.Model):
     '''
         Describes what happens when an instance of an email is sent to specific
         recipient.
     '''
+    objects = InstanceRecipientDetailsManager()
 
     recipient      = models.ForeignKey(Recipient, related_name='instance_receipts', on_delete=models.CASCADE)
     instance       = models.ForeignKey(Instance, related_name='recipient_details', on_delete=models.CASCADE)
@@ -1395,7 +2268,7 @@ class URLClick(models.Model):
     '''
     recipient = models.ForeignKey(Recipient, related_name='urls_clicked', on_delete=models.CASCADE)
     url       = models.ForeignKey(URL, related_name='clicks', on_delete=models.CASCADE)
-    when      = models.DateTimeField(auto_now_add=True)
+    when      = models.DateTimeField(default=datetime.now)
 
 
 class InstanceOpen(models.Model):
@@ -1404,14 +2277,67 @@ class InstanceOpen(models.Model):
     '''
     recipient = models.ForeignKey(Recipient, related_name='instances_opened', on_delete=models.CASCADE)
     instance  = models.ForeignKey(Instance, related_name='opens', on_delete=models.CASCADE)
-    when      = models.DateTimeField(auto_now_add=True)
+    when      = models.DateTimeField(default=datetime.now)
     is_reopen = models.BooleanField(default=False)
 
+class CampaignInstanceStatManager(models.Manager):
+    '''
+    A custom manager for collating the stats of campaign instances.
+    '''
+    def collate(self, instance_pks, batch_size=500):
+        """Computes the stats of instances that belong to a campaign from
+        their engagement counters and inserts or updates them in bulk
+
+        :param instance_pks: The instances to collate
+        :param batch_size: The number of rows per INSERT or UPDATE statement
+        :return: The number of instances collated and the pks of their
+                 campaigns
+        """
+        instances = Instance.objects.filter(pk__in=instance_pks).exclude(campaign=None)
+
+        # Instances sent before the counters existed are counted once
+        stale = list(instances.filter(counters_current=False).values_list('pk', flat=True))
+        if stale:
+            Instance.objects.reconcile_counters(stale)
+
+        existing = {}
+        for stat in self.filter(instance__in=instance_pks):
+            existing.setdefault((stat.campaign_id, stat.instance_id), []).append(stat)
+
+        created = []
+        updated = []
+        count = 0
+        campaign_pks = set()
+        for pk, campaign_pk, recipients, openers, clickers in instances.values_list(
+                'pk', 'campaign_id', 'recipient_total', 'opener_total', 'clicker_total'):
+            values = {
+                'open_rate': round(float(openers) / float(recipients) * 100, 2) if recipients > 0 else 0,
+                'click_rate': round(float(clickers) / float(recipients) * 100, 2) if clickers > 0 and recipients > 0 else 0,
+                'recipient_count': recipients,
+                'click_to_open_rate': round(float(clickers) / float(openers) * 100, 2) if openers > 0 and clickers > 0 else 0
+            }
+            stats = existing.get((campaign_pk, pk))
+            if stats is None:
+                created.append(self.model(campaign_id=campaign_pk, instance_id=pk, **values))
+            for stat in stats or []:
+                for name, value in values.items():
+                    setattr(stat, name, value)
+                updated.append(stat)
+            campaign_pks.add(campaign_pk)
+            count += 1
+
+        self.bulk_create(created, batch_size=batch_size)
+        self.bulk_update(updated, ['open_rate', 'click_rate', 'recipient_count', 'click_to_open_rate'], batch_size=batch_size)
+        return count, campaign_pks
+
+
 class CampaignInstanceStat(models.Model):
     '''
     Describes the aggregate stats of an instance.
     Cached in this model for performance reasons.
     '''
+    objects = CampaignInstanceStatManager()
+
     campaign = models.ForeignKey(Campaign, related_name='instance_stats', on_delete=models.CASCADE)
     instance = models.ForeignKey(Instance, related_name='stats', on_delete=models.CASCADE)
     open_rate = models.FloatField(default=0, null=False, blank=False)
@@ -5,15 +5,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test              import TestCase, Client
+from django.test              import TestCase, TransactionTestCase, Client
 from manager.models           import *
 from django.conf              import settings
 from datetime                 import datetime, timedelta
-from util                     import calc_url_mac, calc_open_mac, calc_unsubscribe_mac
+from util                     import calc_url_mac, calc_open_mac, calc_unsubscribe_mac, calc_click_token, parse_click_token
 from django.urls              import reverse
-from django.http              import HttpResponseRedirect
+from django.db.models         import Q
+from django.http              import HttpResponseRedirect, Http404
 from django.core.exceptions   import SuspiciousOperation
 import urllib.request, urllib.parse, urllib.error
+import smtplib
+import time
+from email                    import message_from_string
 
 class RecipientTestCase(TestCase):
 	def setUp(self):
@@ -46,6 +50,18 @@ class RecipientTestCase(TestCase):
 		with self.assertRaises(AttributeError):
 			self.recipient.blah
 
+	def test_attributes_for(self):
+		'''
+			Bulk loaded attributes should match the per recipient lookups
+			and include an entry for every recipient.
+		'''
+		other = Recipient.objects.create(email_address='other@ucf.edu')
+		attributes = Recipient.attributes_for([self.recipient, other], ['first_name', 'email_address', 'blah'])
+		self.assertEqual(attributes[self.recipient.pk]['first_name'], self.recipient.first_name)
+		self.assertEqual(attributes[other.pk]['email_address'], 'other@ucf.edu')
+		self.assertNotIn('first_name', attributes[other.pk])
+		self.assertNotIn('blah', attributes[self.recipient.pk])
+
 class EmailTestCase(TestCase):
 	def setUp(self):
 		now = datetime.now()
@@ -218,3 +234,1716 @@ class EmailTestCase(TestCase):
 		self.email.save()
 		self.email.send_preview()
 		self.assertTrue(PreviewInstance.objects.count() == 1)
+
+class EstimateTestCase(TestCase):
+	def _scanned_time(self, send_time, send_override, start, offset, exclude=None):
+		'''
+			The estimate found by trying every processing run until midnight.
+		'''
+		interval = Email.objects.processing_interval_duration
+		end      = (start + timedelta(days=1)).replace(hour=0, minute=0, second=0)
+		run      = start
+		while run <= end:
+			when = run.replace(second=0, microsecond=0)
+			if send_time <= (when + offset).time() and \
+					(when.time() <= send_time or send_override) and when != exclude:
+				return when
+			run += interval
+		return None
+
+	def test_estimated_time(self):
+		day     = datetime(2020, 1, 31)
+		starts  = [day, day.replace(hour=8, minute=7, second=30), day.replace(hour=23, minute=50)]
+		offsets = [
+			timedelta(0),
+			Email.objects.processing_interval_duration,
+			timedelta(seconds=settings.PREVIEW_LEAD_TIME) + Email.objects.processing_interval_duration
+		]
+		for start in starts:
+			for offset in offsets:
+				for minute in range(0, 24 * 60, 37):
+					send_time = (day + timedelta(minutes=minute, seconds=minute % 60)).time()
+					for send_override in (False, True):
+						expected = self._scanned_time(send_time, send_override, start, offset)
+						self.assertEqual(
+							Email.objects.estimated_time(send_time, send_override, start, offset),
+							expected)
+						if expected is not None:
+							self.assertEqual(
+								Email.objects.estimated_time(send_time, send_override, start, offset, expected),
+								self._scanned_time(send_time, send_override, start, offset, expected))
+
+	def test_estimate_times(self):
+		now   = datetime(2020, 1, 31, 8, 0)
+		email = Email.objects.create(
+			active           = True,
+			title            = 'Test Estimates',
+			subject          = 'Test Estimates',
+			start_date       = now.date(),
+			send_time        = now.time(),
+			send_override    = True,
+			recurrence       = 0, # Never
+			preview          = True,
+			preview_est_time = now - timedelta(days=1),
+			live_est_time    = now - timedelta(days=1))
+
+		Email.objects.clear_estimates(now)
+		email.refresh_from_db()
+		self.assertIsNone(email.preview_est_time)
+		self.assertIsNone(email.live_est_time)
+
+		Email.objects.estimate_times(now)
+		email.refresh_from_db()
+		self.assertEqual(email.preview_est_time, now)
+		# Not sent by the run that sends the preview
+		self.assertEqual(email.live_est_time, (now + Email.objects.processing_interval_duration).replace(second=0))
+
+	def test_sending_now(self):
+		now = datetime(2020, 1, 31, 8, 0)
+		def create(title, minutes, preview=False, send_override=False):
+			return Email.objects.create(
+				active        = True,
+				title         = title,
+				subject       = title,
+				start_date    = now.date(),
+				send_time     = (now + timedelta(minutes=minutes)).time(),
+				recurrence    = 0, # Never
+				preview       = preview,
+				send_override = send_override)
+
+		due         = create('Due', 5)
+		overridden  = create('Overridden', -60, send_override=True)
+		late        = create('Late', -60)
+		later       = create('Later', 60)
+		previewed   = create('Previewed', 5, preview=True)
+		unpreviewed = create('Unpreviewed', 5, preview=True)
+		sent        = create('Sent', 5)
+		for email, model in ((previewed, PreviewInstance), (sent, Instance)):
+			model.objects.create(
+				email           = email,
+				sent_html       = '',
+				requested_start = datetime.combine(now.date(), email.send_time))
+
+		self.assertEqual(
+			set(Email.objects.sending_now(now)),
+			set([due, overridden, previewed]))
+		overridden.refresh_from_db()
+		self.assertFalse(overridden.send_override)
+
+		preview_start = now - timedelta(seconds=settings.PREVIEW_LEAD_TIME)
+		self.assertEqual(set(Email.objects.previewing_now(preview_start)), set([unpreviewed]))
+
+class EmailTemplateTestCase(TestCase):
+	def setUp(self):
+		now = datetime.now()
+
+		self.recipient = Recipient.objects.create(email_address='template-test@ucf.edu')
+		self.email = Email.objects.create(
+			title              = 'Template Test Email',
+			subject            = 'Template Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = now.date(),
+			send_time          = now.time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+
+	def _create_instance(self, html):
+		return Instance.objects.create(
+			email           = self.email,
+			sent_html       = html,
+			requested_start = datetime.now(),
+			opens_tracked   = True,
+			urls_tracked    = True
+			)
+
+	def _assert_renders_match(self, html, values):
+		'''
+			The compiled template must be byte-identical to the legacy
+			replacement chain for every set of attribute values.
+		'''
+		from manager.utilities.email_template import EmailTemplate
+
+		instance = self._create_instance(html)
+		template = EmailTemplate(instance, instance.placeholders, instance.tracking_urls)
+		for value in values:
+			attributes = {p: value for p in instance.placeholders}
+			self.assertEqual(
+				template.render(self.recipient, attributes),
+				template.render_legacy(self.recipient, attributes))
+		return template
+
+	def test_compiled_render(self):
+		html = '<p>Dear !@!First Name!@!,</p>\n' \
+			'<a href="http://www.ucf.edu/">UCF</a> <a href="http://www.ucf.edu/">Again</a>\n' \
+			'<a style="color:red" href="https://news.ucf.edu/?a=1&amp;b=2">News</a>\n' \
+			'<p>!@!UNSUBSCRIBE!@!</p>'
+		template = self._assert_renders_match(html, ['Jo', '', None, 'a"b', '!@!UNSUBSCRIBE!@!'])
+		self.assertTrue(template.compiled)
+
+	def test_placeholder_in_href(self):
+		'''
+			A personalized href that can collide with another tracked link
+			must fall back to the legacy renderer.
+		'''
+		html = '<a href="http://www.ucf.edu/?id=!@!id!@!">Mine</a>\n' \
+			'<a href="http://www.ucf.edu/?id=5">Five</a>'
+		template = self._assert_renders_match(html, ['5', '6', ''])
+		self.assertFalse(template.compiled)
+
+	def test_normalized_render(self):
+		'''
+			Html normalized once per instance must match normalizing each
+			recipient's html, including values that fall back to parsing.
+		'''
+		from manager.utilities.email_template import EmailTemplate
+
+		html = '<p>Dear !@!First Name!@! &ndash; welcome &amp; thanks&copy;</p>\n' \
+			'<a href="http://www.ucf.edu/" title="For !@!First Name!@!">UCF</a>\n' \
+			'<a style="color:red" href="https://news.ucf.edu/?a=1&amp;b=2">News</a>\n' \
+			'<p>!@!UNSUBSCRIBE!@!</p>'
+
+		instance = self._create_instance(html)
+		template = EmailTemplate(instance, instance.placeholders, instance.tracking_urls)
+		self.assertTrue(template.normalized)
+		for value in ['Jo', '', None, 'Jo & Al', '<b>Jo</b>', 'Zo\u00eb', "O'Neil", '&amp;']:
+			attributes = {p: value for p in instance.placeholders}
+			self.assertEqual(
+				template.render_normalized(self.recipient, attributes),
+				template.normalize(template.render(self.recipient, attributes)))
+
+	def test_unquoted_placeholder_not_normalized(self):
+		'''
+			Values in an unquoted attribute are split by the parser, so the
+			html can not be normalized once.
+		'''
+		from manager.utilities.email_template import EmailTemplate
+
+		instance = self._create_instance('<p class=!@!Group!@!>Hello</p>')
+		template = EmailTemplate(instance, instance.placeholders, instance.tracking_urls)
+		self.assertFalse(template.normalized)
+
+class TrackingURLsTestCase(TestCase):
+	def test_register(self):
+		'''
+			Tracked links should be registered once, with positions counting
+			repeated links, and only untracked schemes skipped.
+		'''
+		email = Email.objects.create(
+			title              = 'URLs Test Email',
+			subject            = 'URLs Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(
+			email           = email,
+			requested_start = datetime.now(),
+			urls_tracked    = True,
+			sent_html       = '''
+				<a href="https://www.ucf.edu/donate/">Donate</a>
+				<a class="button" href="mailto:webcom@ucf.edu">Email</a>
+				<a href="https://www.ucf.edu/news/">News</a>
+				<a style="color: #000;" href="https://www.ucf.edu/donate/">Donate</a>
+				<a href="javascript:void(0)">Nothing</a>
+			''')
+
+		with self.assertNumQueries(3):
+			urls = instance.tracking_urls
+		self.assertEqual(
+			[(url.name, url.position) for url in urls],
+			[('https://www.ucf.edu/donate/', 0), ('https://www.ucf.edu/news/', 0), ('https://www.ucf.edu/donate/', 1)])
+
+		with self.assertNumQueries(0):
+			self.assertEqual(instance.tracking_urls, urls)
+
+		# Registered again by another process
+		instance = Instance.objects.get(pk=instance.pk)
+		with self.assertNumQueries(1):
+			self.assertEqual(instance.register_urls(Instance.trackable_hrefs(instance.sent_html)), urls)
+		self.assertEqual(URL.objects.filter(instance=instance).count(), 3)
+
+class TrackingLinkFactoryTestCase(TestCase):
+	def setUp(self):
+		from manager.utilities.tracking_links import tracked_url
+		tracked_url.cache_clear()
+
+	def test_links(self):
+		'''
+			Links from the factory must match the urlencoded links with
+			MACs computed from scratch.
+		'''
+		import pickle
+		from manager.utilities.tracking_links import TrackingLinkFactory
+
+		recipient = Recipient.objects.create(email_address='links-test@ucf.edu')
+		email = Email.objects.create(
+			title              = 'Links Test Email',
+			subject            = 'Links Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now())
+		urls = [
+			URL.objects.create(instance=instance, name='http://www.ucf.edu/a b?c=\u00e9&d=1', position=0),
+			URL.objects.create(instance=instance, name='http://www.ucf.edu/', position=2)
+		]
+
+		# Workers in the render pool receive the factory pickled
+		with self.settings(TRACKING_COMPACT_LINKS=False):
+			links = pickle.loads(pickle.dumps(TrackingLinkFactory(instance, urls)))
+		for index, url in enumerate(urls):
+			self.assertEqual(links.url(recipient.pk, index), '?'.join([
+				settings.PROJECT_URL + reverse('manager-email-redirect'),
+				urllib.parse.urlencode({
+					'instance'  :instance.pk,
+					'recipient' :recipient.pk,
+					'url'       :urllib.parse.quote(url.name),
+					'position'  :url.position,
+					'mac'       :calc_url_mac(url.name, url.position, recipient.pk, instance.pk)
+				})
+			]))
+		self.assertEqual(links.open_url(recipient.pk), '?'.join([
+			settings.PROJECT_URL + reverse('manager-email-open'),
+			urllib.parse.urlencode({
+				'recipient':recipient.pk,
+				'instance' :instance.pk,
+				'mac'      :calc_open_mac(recipient.pk, instance.pk)
+			})
+		]))
+		self.assertEqual(links.unsubscribe_url(recipient), recipient.unsubscribe_url)
+
+		links = pickle.loads(pickle.dumps(TrackingLinkFactory(instance, urls)))
+		for index, url in enumerate(urls):
+			self.assertEqual(
+				links.click_token(recipient.pk, index),
+				calc_click_token(url.pk, recipient.pk, instance.pk))
+
+	def test_token_redirect(self):
+		'''
+			Compact links redirect and record the click. Tampered tokens
+			are rejected.
+		'''
+		from manager.views import token_redirect
+
+		recipient = Recipient.objects.create(email_address='token-test@ucf.edu')
+		email = Email.objects.create(
+			title              = 'Token Test Email',
+			subject            = 'Token Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now())
+		url = URL.objects.create(instance=instance, name='https://www.ucf.edu/?utm_source=a&amp;utm_medium=b', position=0)
+
+		token = calc_click_token(url.pk, recipient.pk, instance.pk)
+		self.assertEqual(parse_click_token(token), (url.pk, recipient.pk, instance.pk))
+
+		client   = Client()
+		response = client.get(reverse('manager-email-redirect') + '?token=' + token)
+		self.assertEqual(response.status_code, 302)
+		self.assertEqual(response['Location'], 'https://www.ucf.edu/?utm_source=a&utm_medium=b')
+		self.assertEqual(URLClick.objects.filter(recipient=recipient, url=url).count(), 1)
+
+		forged = calc_click_token(url.pk, recipient.pk + 1, instance.pk)[:-2] + token[-2:]
+		self.assertIsNone(parse_click_token(forged))
+		with self.assertRaises(Http404):
+			token_redirect(forged)
+
+class TrackingSpoolTestCase(TestCase):
+	def test_ingest(self):
+		'''
+			Spooled events must be inserted like the tracking views insert
+			them: re-opens worked out in order, one click per URL and
+			recipient, and events for missing rows dropped.
+		'''
+		import os, tempfile
+		from manager.utilities.tracking_spool import TrackingSpool
+
+		recipient = Recipient.objects.create(email_address='spool-test@ucf.edu')
+		other     = Recipient.objects.create(email_address='spool-test-2@ucf.edu')
+		email = Email.objects.create(
+			title              = 'Spool Test Email',
+			subject            = 'Spool Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now())
+		url = URL.objects.create(instance=instance, name='http://www.ucf.edu/', position=0)
+		InstanceOpen.objects.create(recipient=other, instance=instance, is_reopen=False)
+		Instance.objects.reconcile_counters([instance.pk])
+
+		now = datetime.now()
+		with tempfile.TemporaryDirectory() as directory:
+			spool = TrackingSpool(directory)
+			spool.append(spool.OPEN, recipient.pk, instance.pk, now + timedelta(seconds=2))
+			spool.append(spool.OPEN, recipient.pk, instance.pk, now + timedelta(seconds=1))
+			spool.append(spool.OPEN, other.pk, instance.pk, now)
+			spool.append(spool.OPEN, other.pk + 100, instance.pk, now)
+			spool.record_click(recipient.pk, url.pk)
+			spool.record_click(recipient.pk, url.pk)
+			spool.record_click(recipient.pk, url.pk + 100)
+
+			paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+			self.assertEqual(len(paths), 1)
+			self.assertEqual(spool.ingest(paths[0]), (3, 1))
+			self.assertFalse(os.path.exists(paths[0]))
+
+		self.assertEqual(
+			list(InstanceOpen.objects.filter(recipient=recipient).order_by('when').values_list('is_reopen', flat=True)),
+			[False, True])
+		self.assertEqual(InstanceOpen.objects.get(recipient=recipient, is_reopen=False).when, now + timedelta(seconds=1))
+		self.assertEqual(InstanceOpen.objects.filter(recipient=other, is_reopen=True).count(), 1)
+		self.assertEqual(URLClick.objects.filter(recipient=recipient, url=url).count(), 1)
+
+		counters = Instance.objects.values_list(*Instance.COUNTERS[:-1]).get(pk=instance.pk)
+		Instance.objects.reconcile_counters([instance.pk])
+		self.assertEqual(Instance.objects.values_list(*Instance.COUNTERS[:-1]).get(pk=instance.pk), counters)
+
+	def test_tracking_errors(self):
+		'''
+			The open pixel must be returned even when the open can't be
+			recorded, like the click redirect is.
+		'''
+		from unittest import mock
+		from django.db import DatabaseError
+		from django.test import RequestFactory
+		from manager.views import instance_open
+
+		request = RequestFactory().get('/', {'instance': 1, 'recipient': 2, 'mac': calc_open_mac(2, 1)})
+		with mock.patch('manager.views.record_open', side_effect=DatabaseError('gone')) as record_open, \
+				self.assertLogs('manager.views', 'ERROR'):
+			response = instance_open(request)
+		record_open.assert_called_once_with(2, 1)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['Content-Type'], 'image/png')
+		self.assertEqual(response.content, settings.DOT)
+
+class InstanceCountersTestCase(TestCase):
+	def test_counters(self):
+		'''
+			The counters kept by the send and tracking paths must match
+			the counts of the raw tables.
+		'''
+		from manager.utilities.result_recorder import ResultRecorder
+		from manager.utilities.tracking_spool import record_click, record_open
+
+		recipients = [Recipient.objects.create(email_address='counter-test-%d@ucf.edu' % i) for i in range(3)]
+		email = Email.objects.create(
+			title              = 'Counter Test Email',
+			subject            = 'Counter Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now(), counters_current=True)
+		urls = [URL.objects.create(instance=instance, name='http://www.ucf.edu/%d' % i, position=0) for i in range(2)]
+
+		details = InstanceRecipientDetails.objects.create_batch(instance, recipients)
+		recorder = ResultRecorder(instance.pk)
+		recorder.flush([(details[0].pk, datetime.now(), None), (details[1].pk, None, 'refused')])
+
+		# Clicking before the open is tracked counts as opening
+		record_click(recipients[0].pk, urls[0].pk)
+		record_open(recipients[0].pk, instance.pk)
+		record_open(recipients[0].pk, instance.pk)
+		record_click(recipients[0].pk, urls[0].pk)
+		record_click(recipients[0].pk, urls[1].pk)
+		record_open(recipients[1].pk, instance.pk)
+		record_click(recipients[1].pk, urls[1].pk)
+
+		# Saving a stale copy must not undo the counts
+		instance.save()
+		instance = Instance.objects.get(pk=instance.pk)
+		counts = (3, 1, 2, 1, 3, 2)
+		self.assertEqual((
+			instance.recipient_details_count,
+			instance.sent_count,
+			instance.open_recipient_count,
+			instance.re_opens,
+			instance.click_count,
+			instance.click_recipient_count
+		), counts)
+
+		Instance.objects.filter(pk=instance.pk).update(counters_current=False, opener_total=0)
+		self.assertEqual(Instance.objects.reconcile_counters([instance.pk]), 1)
+		self.assertEqual(Instance.objects.values_list(*Instance.COUNTERS).get(pk=instance.pk), counts + (True,))
+
+class ResultRecorderTestCase(TestCase):
+	def recorder(self, **kwargs):
+		from manager.utilities.result_recorder import ResultRecorder
+
+		flushed = []
+		class Recorder(ResultRecorder):
+			def flush(self, results):
+				if results:
+					flushed.append([detail_id for detail_id, when, exception_msg in results])
+		return Recorder(**kwargs), flushed
+
+	def wait_for(self, condition):
+		deadline = time.monotonic() + 5
+		while not condition() and time.monotonic() < deadline:
+			time.sleep(0.01)
+
+	def test_flush_by_size(self):
+		recorder, flushed = self.recorder(batch_size=2, interval=60)
+		recorder.start()
+		for i in range(5):
+			recorder.record(i, datetime.now(), None)
+		self.wait_for(lambda: len(flushed) == 2)
+		self.assertEqual(flushed, [[0, 1], [2, 3]])
+		recorder.stop()
+		self.assertEqual(flushed, [[0, 1], [2, 3], [4]])
+
+	def test_flush_by_interval(self):
+		recorder, flushed = self.recorder(batch_size=100, interval=0.05)
+		recorder.start()
+		recorder.record(0, datetime.now(), None)
+		self.wait_for(lambda: flushed)
+		self.assertEqual(flushed, [[0]])
+		recorder.record(1, None, 'refused')
+		self.wait_for(lambda: len(flushed) == 2)
+		self.assertEqual(flushed, [[0], [1]])
+		recorder.stop()
+		self.assertEqual(flushed, [[0], [1]])
+
+	def test_flush_on_stop(self):
+		recorder, flushed = self.recorder(batch_size=100, interval=60)
+		recorder.start()
+		for i in range(3):
+			recorder.record(i, datetime.now(), None)
+		recorder.stop()
+		self.assertEqual(flushed, [[0, 1, 2]])
+		self.assertFalse(recorder.is_alive())
+
+	def create_details(self, count):
+		email = Email.objects.create(
+			title              = 'Recorder Test Email',
+			subject            = 'Recorder Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance   = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now(), counters_current=True)
+		recipients = [Recipient.objects.create(email_address='recorder-test-%d@ucf.edu' % i) for i in range(count)]
+		return instance, InstanceRecipientDetails.objects.create_batch(instance, recipients)
+
+	def test_flush_retry(self):
+		'''
+			A batch that fails to write should be written again, and only
+			counted once.
+		'''
+		from unittest import mock
+		from django.db import DatabaseError
+		from manager.utilities.result_recorder import ResultRecorder
+
+		instance, details = self.create_details(2)
+		write  = ResultRecorder._write
+		writes = []
+		def failing_write(recorder, results):
+			writes.append(len(results))
+			if len(writes) == 1:
+				raise DatabaseError('connection lost')
+			write(recorder, results)
+
+		recorder = ResultRecorder(instance.pk)
+		with mock.patch.object(ResultRecorder, '_write', failing_write), \
+				self.assertLogs('manager.utilities.result_recorder', 'ERROR'):
+			recorder.flush([(details[0].pk, datetime.now(), None), (details[1].pk, datetime.now(), None)])
+
+		self.assertEqual(writes, [2, 2])
+		self.assertIsNone(recorder.error)
+		self.assertEqual(InstanceRecipientDetails.objects.filter(instance=instance, when__isnull=False).count(), 2)
+		self.assertEqual(Instance.objects.get(pk=instance.pk).sent_count, 2)
+
+	def test_flush_fallback(self):
+		'''
+			When a batch can't be written, the rows that can be should be
+			written one at a time, and stop() should raise the error.
+		'''
+		from unittest import mock
+		from django.db import DatabaseError
+		from manager.utilities.result_recorder import ResultRecorder
+
+		instance, details = self.create_details(3)
+		write = ResultRecorder._write
+		def failing_write(recorder, results):
+			if len(results) > 1 or results[0][0] == details[1].pk:
+				raise DatabaseError('bad row')
+			write(recorder, results)
+
+		recorder = ResultRecorder(instance.pk)
+		with mock.patch.object(ResultRecorder, '_write', failing_write), \
+				self.assertLogs('manager.utilities.result_recorder', 'ERROR'):
+			recorder.flush([(detail.pk, datetime.now(), None) for detail in details])
+
+		self.assertIsInstance(recorder.error, DatabaseError)
+		self.assertEqual(
+			set(InstanceRecipientDetails.objects.filter(instance=instance, when__isnull=False).values_list('pk', flat=True)),
+			{details[0].pk, details[2].pk})
+		self.assertEqual(Instance.objects.get(pk=instance.pk).sent_count, 2)
+
+		recorder = ResultRecorder(instance.pk, interval=60)
+		with mock.patch.object(ResultRecorder, '_write', side_effect=DatabaseError('gone')), \
+				self.assertLogs('manager.utilities.result_recorder', 'ERROR'):
+			recorder.start()
+			recorder.record(details[1].pk, datetime.now(), None)
+			with self.assertRaises(DatabaseError):
+				recorder.stop()
+
+class CollateStatsTestCase(TestCase):
+	def test_collate(self):
+		'''
+			Instance stats and campaign averages must match the instance
+			properties, and --since must only recollate engaged instances.
+		'''
+		from io import StringIO
+		from django.core.management import call_command
+
+		campaign = Campaign.objects.create(name='Collate Test Campaign')
+		empty    = Campaign.objects.create(name='Empty Campaign', avg_open_rate=50)
+		email = Email.objects.create(
+			title              = 'Collate Test Email',
+			subject            = 'Collate Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		recipients = [Recipient.objects.create(email_address='collate-test-%d@ucf.edu' % i) for i in range(3)]
+		instances = []
+		for opened in (1, 3):
+			instance = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now(), campaign=campaign)
+			url = URL.objects.create(instance=instance, name='http://www.ucf.edu/', position=0)
+			InstanceRecipientDetails.objects.bulk_create([
+				InstanceRecipientDetails(recipient=recipient, instance=instance, when=datetime.now())
+				for recipient in recipients
+			])
+			for recipient in recipients[:opened]:
+				InstanceOpen.objects.create(recipient=recipient, instance=instance, is_reopen=False)
+			URLClick.objects.create(recipient=recipients[-1], url=url)
+			instances.append(instance)
+
+		call_command('collate-stats', stdout=StringIO())
+		for instance in instances:
+			instance = Instance.objects.get(pk=instance.pk)
+			stat = CampaignInstanceStat.objects.get(instance=instance)
+			self.assertEqual(
+				(stat.open_rate, stat.click_rate, stat.recipient_count, stat.click_to_open_rate),
+				(instance.open_rate, instance.click_rate, 3, instance.click_to_open_rate))
+
+		campaign = Campaign.objects.get(pk=campaign.pk)
+		self.assertEqual(campaign.avg_open_rate, round((66.67 + 100) / 2, 2))
+		self.assertEqual(campaign.avg_recipient_count, 3)
+		self.assertEqual(campaign.avg_open_rate, campaign.calc_avg_open_rate())
+		self.assertEqual(Campaign.objects.get(pk=empty.pk).avg_open_rate, 0)
+
+		old = datetime.now() - timedelta(days=1)
+		Instance.objects.filter(pk=instances[0].pk).update(start=old)
+		InstanceRecipientDetails.objects.update(when=old)
+		InstanceOpen.objects.update(when=old)
+		URLClick.objects.update(when=old)
+		CampaignInstanceStat.objects.update(recipient_count=0)
+		InstanceOpen.objects.create(recipient=recipients[1], instance=instances[1], is_reopen=True)
+		call_command('collate-stats', since=(datetime.now() - timedelta(hours=1)).isoformat(), stdout=StringIO())
+		self.assertEqual(
+			dict(CampaignInstanceStat.objects.values_list('instance', 'recipient_count')),
+			{instances[0].pk: 0, instances[1].pk: 3})
+
+def legacy_rule_query(rule):
+	'''
+		The Recipient filter a segment rule compiled to before rules were
+		compiled to EXISTS subqueries. Kept as an oracle for the compiled
+		rules; see SegmentTestCase.test_legacy_differences for where the
+		two differ.
+	'''
+	if rule.field == 'in_recipient_group':
+		return Q(groups=int(rule.value))
+	elif rule.field == 'has_attribute':
+		return Q(attributes__name=rule.key, attributes__value=rule.value)
+	elif rule.field == 'received_instance':
+		return Q(instance=int(rule.value))
+	elif rule.field in ('opened_email', 'opened_instance'):
+		instance = 'instance__email' if rule.field == 'opened_email' else 'instance'
+		recipient_opens = Recipient.objects.filter(**{'instances_opened__' + instance: int(rule.value)})
+		recipient_clicks = Recipient.objects.filter(**{'urls_clicked__url__' + instance: int(rule.value)})
+		recipient_pks = list(recipient_opens.order_by().union(recipient_clicks.order_by()).values_list('pk', flat=True))
+		return Q(pk__in=recipient_pks)
+	elif rule.field == 'clicked_link':
+		return Q(urls_clicked__url__name=rule.value)
+	elif rule.field == 'clicked_any_url_in_email':
+		return Q(urls_clicked__url__instance=int(rule.value))
+	elif rule.field == 'clicked_url_in_instance':
+		return Q(urls_clicked__url__name=rule.key, urls_clicked__url__instance=int(rule.value))
+	return Q()
+
+def legacy_recipients(segment):
+	'''
+		The recipients of segment, filtered with joins as before its rules
+		were compiled to EXISTS subqueries.
+	'''
+	retval = Recipient.objects.filter(segment._combine(segment.include_rules, legacy_rule_query))
+	if segment.exclude_rules.count() > 0:
+		retval = retval.exclude(segment._combine(segment.exclude_rules, legacy_rule_query))
+	return retval.distinct()
+
+class SegmentTestCase(TestCase):
+	def setUp(self):
+		self.recipients = [Recipient.objects.create(email_address='segment-test-%d@ucf.edu' % i) for i in range(8)]
+		r = self.recipients
+
+		self.groups = [RecipientGroup.objects.create(name='Segment Test Group %d' % i) for i in range(2)]
+		self.groups[0].recipients.add(r[0], r[1], r[2], r[3])
+		self.groups[1].recipients.add(r[2], r[3], r[4])
+
+		for recipient in r[:6]:
+			RecipientAttribute.objects.create(recipient=recipient, name='college', value='CECS' if recipient.pk % 2 else 'COS')
+		RecipientAttribute.objects.create(recipient=r[1], name='level', value='UG')
+		RecipientAttribute.objects.create(recipient=r[5], name='level', value='UG')
+
+		email = Email.objects.create(
+			title              = 'Segment Test Email',
+			subject            = 'Segment Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		self.email = email
+		self.instances = [Instance.objects.create(email=email, sent_html='', requested_start=datetime.now()) for i in range(2)]
+		urls = [URL.objects.create(instance=instance, name='http://www.ucf.edu/', position=0) for instance in self.instances]
+		for recipient in r[:7]:
+			InstanceRecipientDetails.objects.create(recipient=recipient, instance=self.instances[recipient.pk % 2])
+		InstanceOpen.objects.create(recipient=r[0], instance=self.instances[0], is_reopen=False)
+		InstanceOpen.objects.create(recipient=r[0], instance=self.instances[0], is_reopen=True)
+		InstanceOpen.objects.create(recipient=r[3], instance=self.instances[1], is_reopen=False)
+		URLClick.objects.create(recipient=r[0], url=urls[0])
+		URLClick.objects.create(recipient=r[6], url=urls[0])
+		URLClick.objects.create(recipient=r[6], url=urls[1])
+
+	def rules(self):
+		return [
+			('in_recipient_group', None, self.groups[0].pk),
+			('in_recipient_group', None, self.groups[1].pk),
+			('has_attribute', 'college', 'CECS'),
+			('has_attribute', 'level', 'UG'),
+			('received_instance', None, self.instances[0].pk),
+			('opened_email', None, self.email.pk),
+			('opened_instance', None, self.instances[0].pk),
+			('opened_instance', None, self.instances[1].pk),
+			('clicked_link', None, 'http://www.ucf.edu/'),
+			('clicked_any_url_in_email', None, self.instances[1].pk),
+			('clicked_url_in_instance', 'http://www.ucf.edu/', self.instances[0].pk)
+		]
+
+	def segment(self, *rules):
+		Segment.objects.filter(name='Segment Test').delete()
+		segment = Segment.objects.create(name='Segment Test')
+		for index, (rule_type, conditional, (field, key, value)) in enumerate(rules):
+			SegmentRule.objects.create(
+				segment=segment, rule_type=rule_type, conditional=conditional,
+				field=field, key=key, value=value, index=index)
+		return segment
+
+	def assertSameRecipients(self, segment):
+		self.assertEqual(
+			sorted(segment.recipients.values_list('pk', flat=True)),
+			sorted(legacy_recipients(segment).values_list('pk', flat=True)))
+
+	def test_compiled_rules(self):
+		'''
+			Compiled segments must match the recipients the joined
+			queries matched.
+		'''
+		rules = self.rules()
+		for rule in rules:
+			self.assertSameRecipients(self.segment(('include', None, rule)))
+			self.assertSameRecipients(self.segment(('exclude', None, rule)))
+			for other in rules:
+				self.assertSameRecipients(self.segment(('include', None, rule), ('include', 'OR', other)))
+				self.assertSameRecipients(self.segment(('include', None, rule), ('exclude', None, other)))
+				self.assertSameRecipients(self.segment(('exclude', None, rule), ('exclude', 'OR', other)))
+
+		self.assertSameRecipients(self.segment(
+			('include', None, rules[0]),
+			('include', 'AND', rules[2]),
+			('include', 'OR', rules[6]),
+			('exclude', None, rules[8])))
+		self.assertEqual(self.segment().recipients.count(), len(self.recipients))
+
+	def test_independent_rules(self):
+		'''
+			Rules on the same relation must hold for different rows.
+		'''
+		rules = self.rules()
+		segment = self.segment(('include', None, rules[0]), ('include', 'AND', rules[1]))
+		self.assertEqual(set(segment.recipients), set(self.recipients[2:4]))
+
+		segment = self.segment(('include', None, rules[2]), ('include', 'AND', rules[3]))
+		self.assertEqual(set(segment.recipients), set(r for r in (self.recipients[1], self.recipients[5]) if r.pk % 2))
+
+
+		segment = self.segment(('include', None, rules[0]), ('exclude', None, rules[2]))
+		sql = str(segment.recipients.query)
+		self.assertNotIn('JOIN', sql)
+		self.assertIn('NOT (EXISTS', sql)
+		self.assertTrue(segment.explain())
+
+	def test_legacy_differences(self):
+		'''
+			The only cases where compiled rules match different recipients
+			than the joined queries did.
+		'''
+		rules = self.rules()
+		r = self.recipients
+
+		# Rules ANDed on one relation had to hold for the same row
+		segment = self.segment(('include', None, rules[0]), ('include', 'AND', rules[1]))
+		self.assertEqual(set(segment.recipients), {r[2], r[3]})
+		self.assertEqual(set(legacy_recipients(segment)), set())
+
+		# Excluding a rule with two conditions didn't keep them on one row
+		RecipientAttribute.objects.create(recipient=r[6], name='college', value='COS')
+		RecipientAttribute.objects.create(recipient=r[6], name='level', value='CECS')
+		segment = self.segment(('exclude', None, rules[2]))
+		self.assertIn(r[6], set(segment.recipients))
+		self.assertNotIn(r[6], set(legacy_recipients(segment)))
+
+		URLClick.objects.create(recipient=r[7], url=URL.objects.create(instance=self.instances[1], name='http://www.ucf.edu/other', position=0))
+		URLClick.objects.create(recipient=r[7], url=URL.objects.create(instance=self.instances[0], name='http://www.ucf.edu/next', position=1))
+		segment = self.segment(('exclude', None, ('clicked_url_in_instance', 'http://www.ucf.edu/other', self.instances[0].pk)))
+		self.assertIn(r[7], set(segment.recipients))
+		self.assertNotIn(r[7], set(legacy_recipients(segment)))
+
+		# Opens were looked up when the query was built, not when it ran
+		segment = self.segment(('include', None, rules[7]))
+		compiled, legacy = segment.recipients, legacy_recipients(segment)
+		InstanceOpen.objects.create(recipient=r[5], instance=self.instances[1], is_reopen=False)
+		self.assertIn(r[5], set(compiled))
+		self.assertNotIn(r[5], set(legacy))
+
+	def test_membership_refresh(self):
+		'''
+			Incremental refreshes must leave the same membership as the
+			rules, and emails must only use it while it is fresh.
+		'''
+		rules = self.rules()
+		r = self.recipients
+		segment = self.segment(('include', None, rules[1]), ('include', 'OR', rules[7]), ('exclude', None, rules[6]))
+		self.email.segments.add(segment)
+
+		def members():
+			return set(segment.members)
+
+		self.assertEqual(SegmentMembership.objects.refresh(segment), (0, 3))
+		self.assertEqual(members(), set(segment.recipients))
+		self.assertTrue(segment.members_fresh)
+
+		self.groups[1].recipients.add(r[5], r[0])
+		self.groups[1].recipients.remove(r[2])
+		r[6].groups.add(self.groups[1])
+		InstanceOpen.objects.create(recipient=r[7], instance=self.instances[1], is_reopen=False)
+		InstanceOpen.objects.create(recipient=r[4], instance=self.instances[0], is_reopen=False)
+		Recipient.objects.create(email_address='segment-test-new@ucf.edu')
+		self.assertEqual(set(self.email.recipients), members())
+
+		self.assertEqual(SegmentMembership.objects.refresh(segment), (2, 2))
+		self.assertEqual(members(), set(segment.recipients))
+		self.assertEqual(members(), {r[3], r[5], r[7]})
+
+		self.groups[1].recipients.clear()
+		self.assertEqual(SegmentMembership.objects.refresh(segment), (1, 0))
+		self.assertEqual(members(), set(segment.recipients))
+
+		SegmentRule.objects.filter(segment=segment, field='opened_instance', rule_type='exclude').delete()
+		segment = Segment.objects.get(pk=segment.pk)
+		self.assertFalse(segment.members_fresh)
+		self.assertEqual(set(self.email.recipients), set(segment.recipients))
+		self.assertEqual(SegmentMembership.objects.refresh(segment), (0, 1))
+		self.assertEqual(members(), {r[3], r[6], r[7]})
+
+	def test_membership_raw_group_changes(self):
+		'''
+			Group membership written with raw SQL, like the recipient
+			importers write it, must be picked up by refreshes.
+		'''
+		from django.db import connection
+
+		r = self.recipients
+		segment = self.segment(('include', None, self.rules()[1]))
+		self.assertEqual(SegmentMembership.objects.refresh(segment), (0, 3))
+
+		table = RecipientGroup.recipients.through._meta.db_table
+		with connection.cursor() as cursor:
+			cursor.execute('INSERT INTO %s (recipientgroup_id, recipient_id) VALUES (%%s, %%s)' % table, [self.groups[1].pk, r[6].pk])
+			cursor.execute('DELETE FROM %s WHERE recipientgroup_id = %%s AND recipient_id = %%s' % table, [self.groups[1].pk, r[2].pk])
+
+		self.assertEqual(SegmentMembership.objects.refresh(segment), (1, 1))
+		self.assertEqual(set(segment.members), {r[3], r[4], r[6]})
+
+	def test_audience_estimate(self):
+		'''
+			Audience counts must be exact within the budget and
+			estimated, but bounded, past it.
+		'''
+		import json
+		from django.core.cache import cache
+		from django.test import RequestFactory
+		from manager.views import audience_estimate
+		from manager.utilities.audience import AudienceEstimator
+
+		cache.clear()
+		rules = self.rules()
+		posted = [
+			{'rule_type': 'include', 'field': rules[0][0], 'value': rules[0][2]},
+			{'rule_type': 'include', 'field': rules[7][0], 'value': rules[7][2], 'conditional': 'OR'},
+			{'rule_type': 'exclude', 'field': rules[2][0], 'key': rules[2][1], 'value': rules[2][2]}
+		]
+		segment = self.segment(
+			('include', None, rules[0]), ('include', 'OR', rules[7]), ('exclude', None, rules[2]))
+
+		request = RequestFactory().post('/lookup/audience/?type=rules', {'rules': json.dumps(posted)})
+		response = audience_estimate(request)
+		self.assertEqual(json.loads(response.content), {'count': segment.recipients.count(), 'exact': True})
+
+		response = audience_estimate(RequestFactory().get('/lookup/audience/', {'type': 'segment', 'id': segment.pk}))
+		self.assertEqual(json.loads(response.content), {'count': segment.recipients.count(), 'exact': True})
+
+		self.email.segments.add(segment)
+		response = audience_estimate(RequestFactory().get('/lookup/audience/', {'type': 'email', 'id': self.email.pk}))
+		self.assertEqual(json.loads(response.content)['count'], len(list(self.email.recipients)))
+
+		cache.clear()
+		audience = AudienceEstimator(budget=0).segment(segment)
+		self.assertFalse(audience.exact)
+		self.assertTrue(0 <= audience.count <= len(self.recipients))
+
+		response = audience_estimate(RequestFactory().get('/lookup/audience/', {'type': 'rules', 'rules': '[{"rule_type": "include", "field": "bogus", "value": 1}]'}))
+		self.assertEqual(response.status_code, 400)
+		response = audience_estimate(RequestFactory().get('/lookup/audience/', {'type': 'segment', 'id': 0}))
+		self.assertEqual(response.status_code, 404)
+
+class RecipientBitmapTestCase(TestCase):
+	def test_set_algebra(self):
+		'''
+			Bitmaps must behave like sets of ids.
+		'''
+		import random
+		from manager.utilities.recipient_bitmap import RecipientBitmap
+
+		rng = random.Random(19)
+		for size in (0, 1, 50, 5000):
+			a = set(rng.sample(range(200000), size)) | ({0, 7, 8} if size else set())
+			b = set(rng.sample(range(100000), size // 2))
+			x, y = RecipientBitmap.from_ids(a), RecipientBitmap.from_ids(b)
+			self.assertEqual(list(x), sorted(a))
+			self.assertEqual(list(x | y), sorted(a | b))
+			self.assertEqual(list(x & y), sorted(a & b))
+			self.assertEqual(list(x - y), sorted(a - b))
+			self.assertEqual(len(x - y), len(a - b))
+			self.assertEqual(bool(x), bool(a))
+			self.assertEqual([len(chunk) for chunk in x.chunks(1000)], [1000] * (len(a) // 1000) + ([len(a) % 1000] if len(a) % 1000 else []))
+			for recipient_id in list(a)[:10] + list(b)[:10]:
+				self.assertEqual(recipient_id in x, recipient_id in a)
+
+	def test_email_audience(self):
+		'''
+			The audience must be the email's recipients that aren't
+			disabled or unsubscribed.
+		'''
+		from manager.utilities.recipient_bitmap import email_audience
+
+		recipients = [Recipient.objects.create(email_address='bitmap-test-%d@ucf.edu' % i) for i in range(6)]
+		Recipient.objects.filter(pk=recipients[1].pk).update(disable=True)
+		group = RecipientGroup.objects.create(name='Bitmap Test Group')
+		group.recipients.add(*recipients[:4])
+		segment = Segment.objects.create(name='Bitmap Test Segment')
+		SegmentRule.objects.create(segment=segment, rule_type='include', field='has_attribute', key='level', value='UG')
+		for recipient in recipients[3:5]:
+			RecipientAttribute.objects.create(recipient=recipient, name='level', value='UG')
+
+		email = Email.objects.create(
+			title              = 'Bitmap Test Email',
+			subject            = 'Bitmap Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		email.recipient_groups.add(group)
+		email.segments.add(segment)
+		email.unsubscriptions.add(recipients[2])
+
+		audience = email_audience(email)
+		self.assertEqual(list(audience), [recipients[i].pk for i in (0, 3, 4)])
+		self.assertEqual(list(audience.recipients(chunk_size=2)), [recipients[i] for i in (0, 3, 4)])
+
+		category = SubscriptionCategory.objects.create(name='Bitmap Test Category', description='Test')
+		category.unsubscriptions.add(recipients[0])
+		email.subscription_category = category
+		self.assertEqual(list(email_audience(email)), [recipients[i].pk for i in (2, 3, 4)])
+
+class TrackingApplicationTestCase(TestCase):
+	def setUp(self):
+		from manager.utilities.tracking_links import tracked_url
+		tracked_url.cache_clear()
+
+	def _get(self, application, path, query):
+		import io
+		from django.core import signals
+		from django.db import close_old_connections
+		response = {}
+
+		def start_response(status, headers):
+			response['status']  = status
+			response['headers'] = dict(headers)
+
+		# Like the test Client, keep the test's database connection open
+		signals.request_started.disconnect(close_old_connections)
+		signals.request_finished.disconnect(close_old_connections)
+		try:
+			response['body'] = b''.join(application({
+				'REQUEST_METHOD' : 'GET',
+				'PATH_INFO'      : path,
+				'QUERY_STRING'   : query,
+				'wsgi.input'     : io.BytesIO(),
+				'wsgi.url_scheme': 'http'
+			}, start_response))
+		finally:
+			signals.request_started.connect(close_old_connections)
+			signals.request_finished.connect(close_old_connections)
+		return response
+
+	def test_tracking(self):
+		'''
+			The tracking app must record opens and clicks like the views.
+		'''
+		from manager.utilities.tracking_app import TrackingApplication
+
+		recipient = Recipient.objects.create(email_address='wsgi-test@ucf.edu')
+		email = Email.objects.create(
+			title              = 'WSGI Test Email',
+			subject            = 'WSGI Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(email=email, sent_html='', requested_start=datetime.now())
+		url = URL.objects.create(instance=instance, name='https://www.ucf.edu/?a=1&amp;b=2', position=0)
+		application = TrackingApplication()
+
+		open_query = urllib.parse.urlencode({
+			'recipient':recipient.pk,
+			'instance' :instance.pk,
+			'mac'      :calc_open_mac(recipient.pk, instance.pk)
+		})
+		for i in range(2):
+			response = self._get(application, reverse('manager-email-open'), open_query)
+			self.assertEqual(response['status'], '200 OK')
+			self.assertEqual(response['body'], settings.DOT)
+		self.assertEqual(list(InstanceOpen.objects.order_by('pk').values_list('is_reopen', flat=True)), [False, True])
+
+		response = self._get(application, reverse('manager-email-open'), open_query.replace('mac=', 'mac=0'))
+		self.assertEqual(response['status'], '200 OK')
+		self.assertEqual(InstanceOpen.objects.count(), 2)
+
+		response = self._get(application, reverse('manager-email-redirect'),
+			'token=' + calc_click_token(url.pk, recipient.pk, instance.pk))
+		self.assertEqual(response['status'], '302 Found')
+		self.assertEqual(response['headers']['Location'], 'https://www.ucf.edu/?a=1&b=2')
+		self.assertEqual(URLClick.objects.filter(recipient=recipient, url=url).count(), 1)
+
+		response = self._get(application, reverse('manager-email-redirect'), 'token=AAAA')
+		self.assertEqual(response['status'], '404 Not Found')
+
+	def test_open_error(self):
+		'''
+			The open pixel must be returned even when the open can't be
+			recorded.
+		'''
+		from unittest import mock
+		from django.db import DatabaseError
+		from manager.utilities.tracking_app import TrackingApplication
+
+		open_query = urllib.parse.urlencode({'recipient': 2, 'instance': 1, 'mac': calc_open_mac(2, 1)})
+		with mock.patch('manager.utilities.tracking_app.record_open', side_effect=DatabaseError('gone')) as record_open, \
+				self.assertLogs('manager.utilities.tracking_app', 'ERROR'):
+			response = self._get(TrackingApplication(), reverse('manager-email-open'), open_query)
+		record_open.assert_called_once_with(2, 1)
+		self.assertEqual(response['status'], '200 OK')
+		self.assertEqual(response['headers']['Content-Type'], 'image/png')
+		self.assertEqual(response['body'], settings.DOT)
+
+class MessageFactoryTestCase(TestCase):
+	def test_build(self):
+		'''
+			Messages spliced into the skeleton must match messages built
+			by EmailMessage and parse back to the same parts.
+		'''
+		import email
+		from manager.utilities.email_message import EmailMessage, MessageFactory
+
+		factory = MessageFactory('Subject \u00e9', 'Web Communications', 'webcom@ucf.edu', 'Plain text \u00e9')
+		html    = '<p>Dear Zo\u00eb &ndash; welcome</p>' * 20
+		for to_address in ['test@ucf.edu', 'zo\u00eb@ucf.edu', 'a' * 80 + '@ucf.edu']:
+			message = factory.build(to_address, html)
+
+			expected = EmailMessage('Subject \u00e9', 'Web Communications', 'webcom@ucf.edu', to_address)
+			expected.msg.set_boundary(factory.boundary)
+			expected.attach_html(html)
+			expected.attach_text('Plain text \u00e9')
+			self.assertEqual(message, expected.as_string())
+
+			parsed = email.message_from_string(message)
+			parts  = parsed.get_payload()
+			self.assertEqual(len(parts), 2)
+			self.assertEqual(parts[0].get_content_type(), 'text/html')
+			self.assertEqual(
+				parts[0].get_payload(decode=True).decode('utf-8'),
+				'<p>Dear Zo\u00eb \u2013 welcome</p>' * 20)
+			self.assertEqual(parts[1].get_payload(decode=True).decode('utf-8'), 'Plain text \u00e9')
+
+class RenderPoolTestCase(TestCase):
+	def test_render(self):
+		'''
+			Messages rendered in a worker process must be byte-identical to
+			the messages rendered in process.
+		'''
+		from manager.utilities.email_message import MessageFactory
+		from manager.utilities.email_template import EmailTemplate
+		from manager.utilities.render_pool import RenderPool, build_message
+
+		# Unsaved, like the models the workers unpickle
+		email = Email(
+			pk                 = 1,
+			subject            = 'Render Pool Test Subject',
+			replace_delimiter  = '!@!',
+			from_email_address = 'webcom@ucf.edu',
+			from_friendly_name = 'Web Communications'
+			)
+		instance = Instance(
+			pk              = 1,
+			email           = email,
+			subject         = email.subject,
+			sent_html       = '<p>Dear !@!first_name!@! &ndash; <a href="https://www.ucf.edu/">UCF</a></p><p>!@!UNSUBSCRIBE!@!</p>',
+			requested_start = datetime.now(),
+			opens_tracked   = True,
+			urls_tracked    = True
+			)
+		urls       = [URL(pk=1, instance=instance, name='https://www.ucf.edu/', position=0)]
+		template   = EmailTemplate(instance, ['first_name'], urls)
+		factory    = MessageFactory(email.subject, email.from_friendly_name, email.from_email_address, 'Plain text \u00e9')
+		recipients = [Recipient(pk=i + 1, email_address='render-pool-%d@ucf.edu' % i) for i in range(5)]
+		attributes = {
+			recipient.pk: {'first_name': 'Zo\u00eb <%d>' % recipient.pk if recipient.pk % 2 else 'Recipient %d' % recipient.pk}
+			for recipient in recipients
+		}
+
+		pool = RenderPool(1, template, factory)
+		try:
+			messages = pool.render(recipients, attributes)
+		finally:
+			pool.shutdown()
+
+		self.assertEqual(messages, [
+			build_message(template, factory, recipient, attributes[recipient.pk])
+			for recipient in recipients
+		])
+		html = message_from_string(messages[1]).get_payload()[0]
+		self.assertIn('Dear Recipient 2', html.get_payload(decode=True).decode('utf-8'))
+
+class TokenBucketTestCase(TestCase):
+	def test_rate(self):
+		'''
+			Once the burst is used up, tokens should be handed out at the
+			configured rate.
+		'''
+		from manager.utilities.rate_limiter import TokenBucket
+
+		bucket = TokenBucket(rate=100, capacity=5)
+		start  = time.monotonic()
+		for i in range(25):
+			bucket.acquire()
+		elapsed = time.monotonic() - start
+
+		self.assertGreaterEqual(elapsed, 0.19)
+		self.assertEqual(bucket.acquired, 25)
+		self.assertEqual(bucket.waits, 20)
+		self.assertLessEqual(bucket.level, 1)
+
+	def test_drain(self):
+		from manager.utilities.rate_limiter import TokenBucket
+
+		bucket = TokenBucket(rate=10)
+		bucket.drain()
+		self.assertLess(bucket.level, 1)
+
+class SMTPConnectionPoolTestCase(TestCase):
+	class FakeSMTP:
+		'''
+			Stands in for smtplib.SMTP_SSL, recording what each connection
+			was asked to do.
+		'''
+		def __init__(self, host, port):
+			self.closed   = False
+			self.dropped  = False
+			self.messages = []
+			self.opened.append(self)
+
+		def login(self, username, password):
+			if password != 'secret':
+				raise smtplib.SMTPAuthenticationError(535, b'Authentication Credentials Invalid')
+
+		def noop(self):
+			if self.dropped:
+				raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+			return (250, b'Ok')
+
+		def sendmail(self, from_addr, to_addrs, msg):
+			if self.dropped:
+				raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+			self.messages.append(to_addrs)
+
+		def quit(self):
+			self.close()
+
+		def close(self):
+			self.closed = True
+
+	def pool(self, **kwargs):
+		from unittest import mock
+		from manager.utilities.smtp_pool import SMTPConnectionPool
+
+		self.FakeSMTP.opened = []
+		patcher = mock.patch('smtplib.SMTP_SSL', self.FakeSMTP)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		return SMTPConnectionPool('localhost', 465, 'user', kwargs.pop('password', 'secret'), **kwargs)
+
+	def test_acquire_release_discard(self):
+		pool = self.pool(size=2)
+
+		connection = pool.acquire()
+		pool.release(connection)
+		self.assertIs(pool.acquire(), connection)
+		self.assertEqual(len(self.FakeSMTP.opened), 1)
+
+		pool.discard(connection)
+		self.assertTrue(connection.closed)
+		other = pool.acquire()
+		self.assertIsNot(other, connection)
+		self.assertEqual(len(self.FakeSMTP.opened), 2)
+
+		pool.release(other)
+		pool.close()
+		self.assertTrue(other.closed)
+
+	def test_failed_login(self):
+		pool = self.pool(size=1, password='wrong')
+		with self.assertRaises(smtplib.SMTPAuthenticationError):
+			pool.acquire()
+		self.assertTrue(self.FakeSMTP.opened[0].closed)
+
+		# The failed connection must not hold the only place in the pool
+		pool.password = 'secret'
+		self.assertIsNotNone(pool.acquire())
+
+	def test_stale_connections(self):
+		'''
+			Connections idle past idle_timeout, and connections the server
+			dropped, should be replaced rather than handed out.
+		'''
+		pool = self.pool(size=1, idle_timeout=-1)
+		connection = pool.acquire()
+		pool.release(connection)
+		self.assertIsNot(pool.acquire(), connection)
+		self.assertTrue(connection.closed)
+
+		pool = self.pool(size=1, health_check_interval=-1)
+		connection = pool.acquire()
+		pool.release(connection)
+		self.assertIs(pool.acquire(), connection)
+		connection.dropped = True
+		pool.release(connection)
+		self.assertIsNot(pool.acquire(), connection)
+		self.assertTrue(connection.closed)
+
+	def test_sendmail_reconnects(self):
+		pool = self.pool(size=1)
+		connection = pool.acquire()
+		connection.dropped = True
+		pool.release(connection)
+
+		pool.sendmail('webcom@ucf.edu', 'recipient@ucf.edu', 'message')
+		self.assertEqual(len(self.FakeSMTP.opened), 2)
+		self.assertEqual(self.FakeSMTP.opened[1].messages, ['recipient@ucf.edu'])
+		self.assertTrue(connection.closed)
+
+	def test_size_limit(self):
+		'''
+			No more than size connections should be open at once. acquire()
+			should wait for one to be given back, and warm() should only
+			use free places.
+		'''
+		import threading
+
+		pool = self.pool(size=2)
+		self.assertEqual(pool.warm(5), 2)
+		self.assertEqual(pool.warm(), 0)
+		connections = [pool.acquire(), pool.acquire()]
+		self.assertEqual(len(self.FakeSMTP.opened), 2)
+		self.assertEqual(pool.warm(), 0)
+
+		acquired = []
+		waiter   = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+		waiter.start()
+		waiter.join(0.1)
+		self.assertTrue(waiter.is_alive())
+
+		pool.release(connections[0])
+		waiter.join(5)
+		self.assertEqual(acquired, [connections[0]])
+		self.assertEqual(len(self.FakeSMTP.opened), 2)
+
+class StubSMTPServer:
+	'''
+		A scriptable SMTP server on localhost, without TLS, served from its
+		own event loop thread. Recipients in refuse are refused at RCPT with
+		a multiline reply. DATA is refused for recipients in refuse_data,
+		and the message is rejected after it was sent for those in reject.
+		The server shuts down (421) at DATA for recipients in shut_down.
+		The connection is dropped in the middle of the first message to
+		each recipient in drop. The first throttle MAIL commands get
+		Amazon's sending rate error. Like a real server, MAIL is refused
+		until the previous transaction is finished or reset.
+	'''
+	def __init__(self, password='secret', refuse=(), refuse_data=(), reject=(), shut_down=(), drop=(), throttle=0):
+		import asyncio, threading
+
+		self.password    = password
+		self.refuse      = set(refuse)
+		self.refuse_data = set(refuse_data)
+		self.reject      = set(reject)
+		self.shut_down   = set(shut_down)
+		self.drop        = set(drop)
+		self.throttle    = throttle
+		self.received    = []
+		self.connections = 0
+
+		self.loop   = asyncio.new_event_loop()
+		self.server = self.loop.run_until_complete(self.start())
+		self.port   = self.server.sockets[0].getsockname()[1]
+		self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+
+	async def start(self):
+		import asyncio
+
+		return await asyncio.start_server(self.handle, '127.0.0.1', 0)
+
+	def close(self):
+		self.loop.call_soon_threadsafe(self.server.close)
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+
+	async def handle(self, reader, writer):
+		import base64
+
+		self.connections += 1
+		recipient   = None
+		transaction = False
+		writer.write(b'220 stub ESMTP\r\n')
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			command = line.decode('ascii').strip()
+			verb    = command.split(' ', 1)[0].upper()
+
+			if verb == 'EHLO':
+				writer.write(b'250-stub\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN\r\n')
+			elif verb == 'AUTH':
+				password = base64.b64decode(command.split(' ')[2]).split(b'\0')[2]
+				if password.decode('utf-8') == self.password:
+					writer.write(b'235 Authentication successful.\r\n')
+				else:
+					writer.write(b'535 Authentication Credentials Invalid\r\n')
+			elif verb == 'MAIL':
+				if transaction:
+					writer.write(b'503 5.5.1 Error: nested MAIL command\r\n')
+				elif self.throttle > 0:
+					self.throttle -= 1
+					writer.write(b'454 Throttling failure: Maximum sending rate exceeded.\r\n')
+				else:
+					transaction = True
+					writer.write(b'250 Ok\r\n')
+			elif verb == 'RCPT':
+				recipient = command[len('RCPT TO:<'):-1]
+				if recipient in self.refuse:
+					writer.write(b'550-Mailbox unavailable\r\n550 5.1.1 User unknown\r\n')
+				else:
+					writer.write(b'250 Ok\r\n')
+			elif verb == 'DATA':
+				if recipient in self.refuse_data:
+					writer.write(b'554 Transaction failed\r\n')
+					await writer.drain()
+					continue
+				if recipient in self.shut_down:
+					writer.write(b'421 Service not available, closing transmission channel\r\n')
+					await writer.drain()
+					break
+				writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+				await writer.drain()
+				data = b''
+				while True:
+					line = await reader.readline()
+					if line in (b'.\r\n', b''):
+						break
+					data += line
+				if recipient in self.drop:
+					self.drop.discard(recipient)
+					break
+				transaction = False
+				if recipient in self.reject:
+					writer.write(b'554 Message rejected: Email address is not verified.\r\n')
+				else:
+					self.received.append((recipient, data))
+					writer.write(b'250-Ok\r\n250 Queued\r\n')
+			elif verb == 'RSET':
+				transaction = False
+				writer.write(b'250 Ok\r\n')
+			elif verb == 'QUIT':
+				writer.write(b'221 Bye\r\n')
+				await writer.drain()
+				break
+			else:
+				writer.write(b'502 Command not implemented\r\n')
+			await writer.drain()
+		writer.close()
+
+class AsyncSMTPConnectionTestCase(TestCase):
+	def setUp(self):
+		self.server = StubSMTPServer(
+			refuse      = ['refused@ucf.edu'],
+			refuse_data = ['refused-data@ucf.edu'],
+			reject      = ['rejected@ucf.edu'],
+			shut_down   = ['shut-down@ucf.edu'],
+			drop        = ['dropped@ucf.edu'])
+		self.addCleanup(self.server.close)
+
+	def session(self, coroutine, password='secret'):
+		'''
+			Runs coroutine with a connection logged in to the stub server.
+		'''
+		import asyncio
+		from manager.utilities.async_sender import AsyncSMTPConnection
+
+		async def run():
+			connection = AsyncSMTPConnection('127.0.0.1', self.server.port, 'localhost', timeout=5, ssl_context=False)
+			try:
+				await connection.connect('user', password)
+				return await coroutine(connection)
+			finally:
+				self.assertIsNone(connection.writer)
+		return asyncio.run(run())
+
+	def test_multiline_replies(self):
+		async def send(connection):
+			ehlo = await connection.command('EHLO localhost')
+			await connection.sendmail('webcom@ucf.edu', 'recipient@ucf.edu', 'Subject: Test\n\n.leading dot\nbody')
+			with self.assertRaises(smtplib.SMTPRecipientsRefused) as refused:
+				await connection.sendmail('webcom@ucf.edu', 'refused@ucf.edu', 'Subject: Test\n\nbody')
+			await connection.quit()
+			return ehlo, refused.exception
+
+		ehlo, refused = self.session(send)
+		self.assertEqual(ehlo, (250, b'stub\n8BITMIME\nAUTH PLAIN LOGIN'))
+		self.assertEqual(refused.recipients, {'refused@ucf.edu': (550, b'Mailbox unavailable\n5.1.1 User unknown')})
+		self.assertEqual(self.server.received, [('recipient@ucf.edu', b'Subject: Test\r\n\r\n..leading dot\r\nbody\r\n')])
+
+	def test_failed_transactions(self):
+		'''
+			A message refused at or after DATA shouldn't leave the
+			transaction open for the next message on the connection, and a
+			server shutting down should close it.
+		'''
+		async def send(connection):
+			errors = []
+			for address in ('refused-data@ucf.edu', 'rejected@ucf.edu', 'refused@ucf.edu'):
+				try:
+					await connection.sendmail('webcom@ucf.edu', address, 'Subject: Test\n\nbody')
+				except smtplib.SMTPResponseException as e:
+					errors.append((type(e), e.smtp_code))
+				except smtplib.SMTPRecipientsRefused as e:
+					errors.append((type(e), e.recipients[address][0]))
+				await connection.sendmail('webcom@ucf.edu', 'recipient@ucf.edu', 'Subject: Test\n\nbody')
+
+			with self.assertRaises(smtplib.SMTPDataError) as shut_down:
+				await connection.sendmail('webcom@ucf.edu', 'shut-down@ucf.edu', 'Subject: Test\n\nbody')
+			self.assertEqual(shut_down.exception.smtp_code, 421)
+			self.assertIsNone(connection.writer)
+			with self.assertRaises(smtplib.SMTPServerDisconnected):
+				await connection.sendmail('webcom@ucf.edu', 'recipient@ucf.edu', 'Subject: Test\n\nbody')
+			return errors
+
+		self.assertEqual(self.session(send), [
+			(smtplib.SMTPDataError, 554),
+			(smtplib.SMTPDataError, 554),
+			(smtplib.SMTPRecipientsRefused, 550)])
+		self.assertEqual([recipient for recipient, data in self.server.received], ['recipient@ucf.edu'] * 3)
+
+	def test_auth_failure(self):
+		async def send(connection):
+			self.fail('Connected with the wrong password')
+
+		with self.assertRaises(smtplib.SMTPAuthenticationError) as failure:
+			self.session(send, password='wrong')
+		self.assertEqual(failure.exception.smtp_code, 535)
+
+	def test_dropped_connection(self):
+		async def send(connection):
+			await connection.sendmail('webcom@ucf.edu', 'dropped@ucf.edu', 'Subject: Test\n\nbody')
+
+		with self.assertRaises(smtplib.SMTPServerDisconnected):
+			self.session(send)
+		self.assertEqual(self.server.received, [])
+
+class AsyncEmailSenderTestCase(TransactionTestCase):
+	def send(self, server, count, limiter):
+		'''
+			Sends an instance to count new recipients through server.
+		'''
+		from unittest import mock
+		from django.test import override_settings
+		from manager.utilities.async_sender import AsyncEmailSender
+		from manager.utilities.email_message import MessageFactory
+		from manager.utilities.email_template import EmailTemplate
+
+		recipients = [Recipient.objects.create(email_address='recipient%d@ucf.edu' % i) for i in range(count)]
+		email = Email.objects.create(
+			title              = 'Async Test Email',
+			subject            = 'Async Test Email Subject',
+			source_html_uri    = 'http://www.ucf.edu/',
+			start_date         = datetime.now().date(),
+			send_time          = datetime.now().time(),
+			from_email_address = 'webcom@ucf.edu'
+			)
+		instance = Instance.objects.create(email=email, sent_html='<p>Hello</p>', requested_start=datetime.now(), counters_current=True)
+		template = EmailTemplate(instance, [], [])
+		factory  = MessageFactory(email.subject, 'WebCom', email.from_email_address)
+
+		smtp = dict(settings.AMAZON_SMTP, host='127.0.0.1', port=server.port, username='user', password='secret')
+		with override_settings(AMAZON_SMTP=smtp, SEND_ASYNC_CONCURRENCY=4, SEND_BATCH_SIZE=7), \
+				mock.patch('manager.utilities.async_sender.amazon_rate_limiter', return_value=limiter):
+			sender = AsyncEmailSender(instance, template, factory, Recipient.attributes_for(recipients, []), ssl_context=False)
+			sender.send(recipients)
+		return instance, recipients
+
+	def test_outcomes(self):
+		'''
+			Refused recipients should be recorded with the error, and
+			messages cut off by a dropped connection should be sent again on
+			a new one.
+		'''
+		from manager.utilities.rate_limiter import TokenBucket
+
+		server = StubSMTPServer(refuse=['recipient3@ucf.edu'], drop=['recipient5@ucf.edu', 'recipient9@ucf.edu'])
+		self.addCleanup(server.close)
+		instance, recipients = self.send(server, 20, TokenBucket(1000))
+
+		details = {d.recipient.email_address: d for d in instance.recipient_details.select_related('recipient')}
+		self.assertEqual(len(details), 20)
+		self.assertIsNone(details['recipient3@ucf.edu'].when)
+		self.assertIn('User unknown', details['recipient3@ucf.edu'].exception_msg)
+		for address, detail in details.items():
+			if address != 'recipient3@ucf.edu':
+				self.assertIsNotNone(detail.when, address)
+				self.assertIsNone(detail.exception_msg, address)
+
+		self.assertEqual(
+			sorted(recipient for recipient, data in server.received),
+			sorted(r.email_address for r in recipients if r.email_address != 'recipient3@ucf.edu'))
+		# One connection per worker, plus one for each dropped one
+		self.assertEqual(server.connections, 6)
+		self.assertEqual(Instance.objects.get(pk=instance.pk).sent_count, 19)
+
+	def test_rate_limiting(self):
+		'''
+			Sending should be paced by the rate limiter, and messages the
+			server throttles should be sent again after it is drained.
+		'''
+		from manager.utilities.rate_limiter import TokenBucket
+
+		server  = StubSMTPServer(throttle=3)
+		limiter = TokenBucket(rate=50, capacity=1)
+		self.addCleanup(server.close)
+
+		start = time.monotonic()
+		instance, recipients = self.send(server, 20, limiter)
+		elapsed = time.monotonic() - start
+
+		self.assertEqual(len(server.received), 20)
+		self.assertEqual(instance.recipient_details.filter(when__isnull=True).count(), 0)
+		# Throttled messages take another token
+		self.assertEqual(limiter.acquired, 23)
+		self.assertGreater(limiter.waits, 0)
+		self.assertGreaterEqual(elapsed, 22 / 50.0)
+
+class ContentFetcherTestCase(TestCase):
+	def setUp(self):
+		import tempfile, threading
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+
+		self.requests = []
+		requests_seen = self.requests
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = b'<html><body>Hello !first_name!</body></html>'
+				if self.headers.get('If-None-Match') == '"v1"':
+					requests_seen.append(304)
+					self.send_response(304)
+					self.end_headers()
+					return
+				requests_seen.append(200)
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/html; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.send_header('ETag', '"v1"')
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.server = HTTPServer(('127.0.0.1', 0), Handler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.uri       = 'http://127.0.0.1:%d/email.html' % self.server.server_port
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		import shutil
+
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.directory)
+
+	def test_revalidate(self):
+		'''
+			Content fetched again, even by a later run, should only cost a
+			304 from the server.
+		'''
+		from manager.utilities.content_fetcher import ContentFetcher
+
+		fetcher = ContentFetcher(self.directory, memo_seconds=60)
+		first   = fetcher.fetch(self.uri)
+		self.assertEqual(fetcher.fetch(self.uri).text, first.text)
+		self.assertEqual(self.requests, [200])
+
+		# A new process, e.g. the next mailer-process run
+		content = ContentFetcher(self.directory, memo_seconds=60).fetch(self.uri)
+		self.assertEqual(content.status_code, 200)
+		self.assertEqual(content.text, '<html><body>Hello !first_name!</body></html>')
+		self.assertEqual(self.requests, [200, 304])
+
+class StagedSendTestCase(TestCase):
+	def setUp(self):
+		from unittest import mock
+
+		self.now = datetime(2020, 1, 31, 8, 0)
+		self.group = RecipientGroup.objects.create(name='Test Group')
+		for i in range(3):
+			recipient = Recipient.objects.create(email_address='recipient%d@ucf.edu' % i)
+			RecipientAttribute.objects.create(recipient=recipient, name='First Name', value='Recipient %d' % i)
+			self.group.recipients.add(recipient)
+
+		self.email = Email.objects.create(
+			active           = True,
+			title            = 'Test Staging',
+			subject          = 'Test Staging',
+			source_html_uri  = 'https://www.ucf.edu/email.html',
+			start_date       = self.now.date(),
+			send_time        = (self.now + timedelta(minutes=5)).time(),
+			recurrence       = 0, # Never
+			preview          = False,
+			live_est_time    = self.now + Email.objects.processing_interval_duration)
+		self.email.recipient_groups.add(self.group)
+		self.requested_start = datetime.combine(self.now.date(), self.email.send_time)
+
+		self.html = '<p>Hi !@!First Name!@! <a href="https://www.ucf.edu/">UCF</a> <a href="mailto:webcom@ucf.edu">Email</a></p>'
+		patcher = mock.patch.object(Email, 'live_content', lambda email: (self.html, None))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_stage(self):
+		self.assertEqual(list(Email.objects.staging_now(self.now)), [self.email])
+		staged = StagedSend.objects.stage(self.email, self.requested_start)
+		self.assertEqual(list(Email.objects.staging_now(self.now)), [])
+
+		self.assertEqual(
+			list(staged.recipients),
+			sorted(self.group.recipients.values_list('pk', flat=True)))
+		self.assertEqual(staged.placeholders, ['First Name'])
+		self.assertEqual(staged.urls, ['https://www.ucf.edu/'])
+		recipient = self.group.recipients.get(email_address='recipient1@ucf.edu')
+		self.assertEqual(staged.attributes[recipient.pk], {'First Name': 'Recipient 1'})
+
+		self.assertEqual(
+			StagedSend.objects.current(self.email, self.requested_start, self.html, None),
+			staged)
+
+	def test_invalidate(self):
+		'''
+			Staged sends of emails that changed, or whose content did,
+			shouldn't be used.
+		'''
+		StagedSend.objects.stage(self.email, self.requested_start)
+		self.assertIsNone(StagedSend.objects.current(self.email, self.requested_start, self.html + ' ', None))
+		self.assertEqual(StagedSend.objects.count(), 0)
+
+		StagedSend.objects.stage(self.email, self.requested_start)
+		self.email.recipient_groups.add(RecipientGroup.objects.create(name='Another Group'))
+		self.assertIsNone(StagedSend.objects.current(self.email, self.requested_start, self.html, None))
+
+		StagedSend.objects.stage(self.email, self.requested_start)
+		self.email.track_opens = not self.email.track_opens
+		self.email.save()
+		self.assertIsNone(StagedSend.objects.current(self.email, self.requested_start, self.html, None))
+
+	def test_template(self):
+		'''
+			The template compiled while staging should render exactly like
+			one compiled at the send, without compiling the html again.
+		'''
+		from unittest import mock
+		from manager.utilities.email_template import EmailTemplate
+
+		staged = StagedSend.objects.stage(self.email, self.requested_start)
+		instance = Instance.objects.create(
+			email           = self.email,
+			sent_html       = self.html,
+			requested_start = self.requested_start,
+			opens_tracked   = self.email.track_opens,
+			urls_tracked    = self.email.track_urls)
+		tracking_urls = instance.register_urls(staged.urls)
+
+		compiled = EmailTemplate(instance, staged.placeholders, tracking_urls)
+		with mock.patch.object(EmailTemplate, '_compile') as compile:
+			restored = EmailTemplate(instance, staged.placeholders, tracking_urls, state=staged.template_state)
+		compile.assert_not_called()
+		self.assertTrue(restored.compiled)
+		self.assertTrue(restored.normalized)
+
+		for recipient in self.group.recipients.all():
+			attributes = staged.attributes[recipient.pk]
+			self.assertEqual(restored.render(recipient, attributes), compiled.render(recipient, attributes))
+			self.assertEqual(restored.render_normalized(recipient, attributes), compiled.render_normalized(recipient, attributes))
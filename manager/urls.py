@@ -54,6 +54,7 @@ urlpatterns = [
     url(r'^setting/(?P<pk>\d+)/update/$',          login_required(SettingUpdateView.as_view()),      name='manager-setting-update'),
     url(r'^settings/$',                            login_required(SettingListView.as_view()),        name='manager-settings'),
     url(r'^lookup/$',                              login_required(objects_as_options),                name='manager-lookups'),
+    url(r'^lookup/audience/$',                     login_required(audience_estimate),                 name='manager-audience-estimate'),
 
     # Subscriptions
     url(r'^subscriptions/categories/$',                    login_required(SubscriptionCategoryListView.as_view()),   name='manager-subscription-categories'),
@@ -0,0 +1,380 @@
+import asyncio
+import base64
+import logging
+import random
+import re
+import smtplib
+import socket
+import ssl
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.conf import settings
+
+from manager.utilities.flush_transaction import flush_transaction
+from manager.utilities.rate_limiter import amazon_rate_limiter
+from manager.utilities.render_pool import build_message
+from manager.utilities.result_recorder import ResultRecorder
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSMTPConnection:
+    '''
+    A minimal SMTP client over implicit TLS (SMTP_SSL) built on asyncio
+    streams. It implements only what sending through Amazon SES needs and
+    raises the same smtplib exceptions as smtplib.SMTP_SSL, so send
+    outcomes are recorded identically by both sending engines.
+
+    ssl_context defaults to the system's default context. False connects
+    without TLS, e.g. to a local test server.
+    '''
+
+    def __init__(self, host, port, local_hostname, timeout=60, ssl_context=None):
+        self.host           = host
+        self.port           = port
+        self.local_hostname = local_hostname
+        self.timeout        = timeout
+        self.ssl_context    = ssl.create_default_context() if ssl_context is None else ssl_context
+        self.reader         = None
+        self.writer         = None
+
+    async def connect(self, username, password):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl_context),
+            self.timeout
+        )
+
+        try:
+            code, message = await self.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+
+            code, message = await self.command('EHLO ' + self.local_hostname)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+
+            credentials = base64.b64encode(('\0%s\0%s' % (username, password)).encode('utf-8'))
+            code, message = await self.command('AUTH PLAIN ' + credentials.decode('ascii'))
+            if code != 235:
+                raise smtplib.SMTPAuthenticationError(code, message)
+        except:
+            self.close()
+            raise
+
+    async def reply(self):
+        '''
+        Reads a (possibly multiline) reply. Returns the code and message.
+        '''
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(str(e) or 'Connection timed out')
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                try:
+                    code = int(line[:3])
+                except ValueError:
+                    code = -1
+                return code, b'\n'.join(lines)
+
+    async def command(self, line, data=None):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        try:
+            self.writer.write(data if data is not None else line.encode('ascii') + b'\r\n')
+            await self.writer.drain()
+        except ConnectionError as e:
+            self.close()
+            raise smtplib.SMTPServerDisconnected(str(e))
+        return await self.reply()
+
+    async def reset(self, code):
+        '''
+        Ends a failed mail transaction like smtplib.sendmail, so the
+        connection can send the next message: closes it if the server is
+        shutting down (421), otherwise sends RSET.
+        '''
+        if code == 421:
+            self.close()
+            return
+        try:
+            await self.command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def sendmail(self, from_addr, to_addr, msg):
+        code, message = await self.command('MAIL FROM:<%s>' % from_addr)
+        if code != 250:
+            await self.reset(code)
+            raise smtplib.SMTPSenderRefused(code, message, from_addr)
+
+        code, message = await self.command('RCPT TO:<%s>' % to_addr)
+        if code not in (250, 251):
+            await self.reset(code)
+            raise smtplib.SMTPRecipientsRefused({to_addr: (code, message)})
+
+        code, message = await self.command('DATA')
+        if code != 354:
+            await self.reset(code)
+            raise smtplib.SMTPDataError(code, message)
+
+        # Same line ending normalization and dot stuffing as smtplib
+        data = re.sub(r'(?:\r\n|\n|\r(?!\n))', '\r\n', msg)
+        data = re.sub(r'(?m)^\.', '..', data)
+        if not data.endswith('\r\n'):
+            data += '\r\n'
+        code, message = await self.command(None, (data + '.\r\n').encode('ascii'))
+        if code != 250:
+            await self.reset(code)
+            raise smtplib.SMTPDataError(code, message)
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except smtplib.SMTPException:
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncEmailSender:
+    '''
+    Sends an instance from a single asyncio event loop instead of one
+    thread per SMTP connection. Selected with SEND_ENGINE = 'asyncio'.
+
+    SEND_ASYNC_CONCURRENCY SMTP sessions are driven concurrently. All
+    database work (creating recipient details, polling for termination)
+    runs in one helper thread, and outcomes are written by the
+    ResultRecorder, so a send uses two database connections regardless of
+    concurrency. Retries, error thresholds and termination behave like the
+    threaded engine in Email.send.
+    '''
+
+    _AMAZON_RECONNECT_THRESHOLD = 10
+    _ERROR_THRESHOLD            = 20
+
+    # Batches rendered ahead of the one being queued
+    _RENDER_AHEAD               = 2
+
+    def __init__(self, instance, template, factory, recipient_attributes, render_pool=None, ssl_context=None):
+        self.instance             = instance
+        self.template             = template
+        self.factory              = factory
+        self.recipient_attributes = recipient_attributes
+        self.render_pool          = render_pool
+        self.ssl_context          = ssl_context
+
+        self.concurrency    = getattr(settings, 'SEND_ASYNC_CONCURRENCY', settings.AMAZON_SMTP['rate'])
+        self.batch_size     = getattr(settings, 'SEND_BATCH_SIZE', 500)
+        self.queue_size     = getattr(settings, 'SEND_QUEUE_SIZE', 2000)
+        if render_pool is not None:
+            # Queued recipients carry their rendered message
+            self.queue_size = min(self.queue_size, self.batch_size)
+        self.local_hostname = socket.getfqdn()
+        self.limiter        = amazon_rate_limiter()
+
+    def send(self, recipients):
+        '''
+        Creates the recipient details for recipients and sends to them.
+        Blocks until the send is finished or terminated.
+        '''
+        asyncio.run(self._send(recipients))
+
+    async def _send(self, recipients):
+        from manager.models import InstanceRecipientDetails
+
+        loop     = asyncio.get_running_loop()
+        database = ThreadPoolExecutor(1)
+        queue    = asyncio.Queue(self.queue_size)
+        stop     = asyncio.Event()
+        recorder = ResultRecorder(self.instance.pk)
+        recorder.start()
+
+        watcher = asyncio.ensure_future(self._watch_termination(database, stop))
+        workers = [
+            asyncio.ensure_future(self._worker(queue, stop, recorder))
+            for i in range(self.concurrency)
+        ]
+
+        rendering = deque()
+
+        async def queue_rendered(batch, futures):
+            chunks = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+            messages = [message for chunk in chunks for message in chunk]
+            for recipient_details, message in zip(batch, messages):
+                recipient_details.message = message
+                await queue.put(recipient_details)
+
+        try:
+            for i in range(0, len(recipients), self.batch_size):
+                if recorder.error is not None:
+                    # Outcomes aren't being recorded, so stop sending
+                    stop.set()
+                if stop.is_set():
+                    break
+                batch = await loop.run_in_executor(
+                    database,
+                    InstanceRecipientDetails.objects.create_batch,
+                    self.instance,
+                    recipients[i:i + self.batch_size]
+                )
+                if self.render_pool is None:
+                    for recipient_details in batch:
+                        await queue.put(recipient_details)
+                    continue
+
+                # The workers render the next batches while this one is
+                # queued and sent
+                rendering.append((batch, self.render_pool.submit(
+                    [d.recipient for d in batch],
+                    self.recipient_attributes)))
+                if len(rendering) > self._RENDER_AHEAD:
+                    await queue_rendered(*rendering.popleft())
+
+            while rendering and not stop.is_set():
+                await queue_rendered(*rendering.popleft())
+        except:
+            stop.set()
+            raise
+        finally:
+            for batch, futures in rendering:
+                for future in futures:
+                    future.cancel()
+            # One sentinel per worker. Workers keep reading the queue after
+            # a stop, so these never block for long.
+            for worker in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            watcher.cancel()
+            recorder.stop()
+            database.shutdown()
+
+        log.debug('rate limiter: %s' % self.limiter.stats())
+
+    async def _watch_termination(self, database, stop):
+        from manager.models import Instance
+
+        def send_terminate():
+            # Flushes sql transaction so we get fresh data
+            flush_transaction()
+            return Instance.objects.filter(pk=self.instance.pk).values_list('send_terminate', flat=True)[0]
+
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            if await loop.run_in_executor(database, send_terminate):
+                stop.set()
+                self.instance.send_terminate = True
+                await loop.run_in_executor(database, self.instance.save)
+                break
+            await asyncio.sleep(1)
+
+    async def _connect(self):
+        connection = AsyncSMTPConnection(
+            settings.AMAZON_SMTP['host'],
+            settings.AMAZON_SMTP['port'],
+            self.local_hostname,
+            ssl_context=self.ssl_context
+        )
+        await connection.connect(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
+        return connection
+
+    def build_message(self, recipient_details):
+        message = getattr(recipient_details, 'message', None)
+        if message is None:
+            recipient = recipient_details.recipient
+            message = build_message(
+                self.template,
+                self.factory,
+                recipient,
+                self.recipient_attributes[recipient.pk])
+        return message
+
+    async def _worker(self, queue, stop, recorder):
+        connection        = None
+        reconnect_counter = 0
+        error_counter     = 0
+        recipient_details = None
+
+        while True:
+            if recipient_details is None:
+                recipient_details = await queue.get()
+                if recipient_details is None:
+                    break
+
+            if stop.is_set():
+                # Leave the remaining details unsent, as the threaded
+                # engine does when an instance is terminated
+                recipient_details = None
+                continue
+
+            try:
+                if connection is None:
+                    try:
+                        connection = await self._connect()
+                    except Exception:
+                        if reconnect_counter == self._AMAZON_RECONNECT_THRESHOLD:
+                            log.debug('reached reconnect threshold, exiting')
+                            raise
+                        reconnect_counter += 1
+                        continue
+
+                msg   = self.build_message(recipient_details)
+                retry = False
+                try:
+                    await asyncio.sleep(self.limiter.reserve())
+                    await connection.sendmail(
+                        self.factory.from_address,
+                        recipient_details.recipient.email_address,
+                        msg
+                    )
+                except smtplib.SMTPResponseException as e:
+                    if connection.writer is None:
+                        # Closed after a 421, the next message reconnects
+                        connection = None
+                    if e.smtp_error.find('Maximum sending rate exceeded'.encode()) >= 0:
+                        log.debug('maximum sending rate exceeded, draining the rate limiter')
+                        self.limiter.drain()
+                        retry = True
+                    else:
+                        recipient_details.exception_msg = str(e)
+                except smtplib.SMTPServerDisconnected:
+                    log.debug('connection error, sleeping for a bit')
+                    connection = None
+                    await asyncio.sleep(float(1) + random.random())
+                    retry = True
+                except Exception as e:
+                    recipient_details.exception_msg = str(e)
+                else:
+                    recipient_details.when = datetime.now()
+
+                if not retry:
+                    recorder.record(
+                        recipient_details.pk,
+                        recipient_details.when,
+                        recipient_details.exception_msg)
+                    recipient_details = None
+            except Exception:
+                recipient_details = None
+                if error_counter == self._ERROR_THRESHOLD:
+                    log.debug('reached error threshold, stopping')
+                    stop.set()
+                    continue
+                error_counter += 1
+                log.exception('async sender exception')
+
+        if connection is not None:
+            await connection.quit()
@@ -0,0 +1,186 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from manager.utilities.recipient_bitmap import (
+    RecipientBitmap,
+    disabled_recipients,
+    group_recipients,
+    unsubscribed_recipients
+)
+
+
+class Audience:
+    '''
+    A set of recipients known either exactly, as a bitmap, or only by its
+    estimated size. Combining estimates assumes the sets are independent
+    within all recipients, e.g. |A & B| = |A| * |B| / total.
+    '''
+
+    def __init__(self, total, bitmap=None, count=None):
+        self.total = total
+        self.bitmap = bitmap
+        self.count = len(bitmap) if bitmap is not None else count
+
+    @property
+    def exact(self):
+        return self.bitmap is not None
+
+    def _fraction(self):
+        return float(self.count) / self.total if self.total else 0
+
+    def _estimate(self, count):
+        return Audience(self.total, count=max(0, min(self.total, count)))
+
+    def __or__(self, other):
+        if self.exact and other.exact:
+            return Audience(self.total, self.bitmap | other.bitmap)
+        return self._estimate(self.count + other.count - self.count * other._fraction())
+
+    def __and__(self, other):
+        if self.exact and other.exact:
+            return Audience(self.total, self.bitmap & other.bitmap)
+        return self._estimate(self.count * other._fraction())
+
+    def __sub__(self, other):
+        if self.exact and other.exact:
+            return Audience(self.total, self.bitmap - other.bitmap)
+        return self._estimate(self.count * (1 - other._fraction()))
+
+
+class AudienceEstimator:
+    '''
+    Counts the recipients an email or a segment's rules reach, from the
+    cached recipient bitmaps of each group and rule.
+
+    Bitmaps that aren't cached are loaded until budget seconds have passed
+    (AUDIENCE_ESTIMATE_BUDGET). After that only the sizes of the remaining
+    groups and rules are counted, and cached, and the result is estimated.
+    Bitmaps and sizes are cached for AUDIENCE_CACHE_TIMEOUT seconds, so
+    recent opens, clicks and group changes may not be counted yet.
+    '''
+
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = getattr(settings, 'AUDIENCE_ESTIMATE_BUDGET', 0.5)
+        self.deadline = time.monotonic() + budget
+        self.timeout = getattr(settings, 'AUDIENCE_CACHE_TIMEOUT', 300)
+        self._total = None
+
+    def _cached(self, key, bitmap, count):
+        '''
+        Returns an Audience from the cached bitmap under key, or from
+        bitmap() while there is time left, or from the cached or counted
+        count().
+        '''
+        bits = cache.get('audience:bitmap:' + key)
+        if bits is None and time.monotonic() < self.deadline:
+            bits = bitmap().bits
+            cache.set('audience:bitmap:' + key, bits, self.timeout)
+        if bits is not None:
+            return Audience(self.total, RecipientBitmap(bits))
+
+        size = cache.get('audience:count:' + key)
+        if size is None:
+            size = count()
+            cache.set('audience:count:' + key, size, self.timeout)
+        return Audience(self.total, count=size)
+
+    @property
+    def total(self):
+        from manager.models import Recipient
+
+        if self._total is None:
+            self._total = cache.get('audience:total')
+            if self._total is None:
+                self._total = Recipient.objects.count()
+                cache.set('audience:total', self._total, self.timeout)
+        return self._total
+
+    def everyone(self):
+        from manager.models import Recipient
+
+        return self._cached(
+            'everyone',
+            lambda: RecipientBitmap.from_queryset(Recipient.objects.all()),
+            lambda: self.total)
+
+    def group(self, group):
+        return self._cached(
+            'group:%d' % group.pk,
+            lambda: group_recipients(group),
+            lambda: group.recipients.count())
+
+    def rule(self, rule):
+        from manager.models import Recipient
+
+        query = rule.get_query()
+        recipients = Recipient.objects.filter(query)
+        key = hashlib.sha1(repr((rule.field, rule.key, rule.value)).encode()).hexdigest()
+        return self._cached(
+            'rule:' + key,
+            lambda: RecipientBitmap.from_queryset(recipients),
+            lambda: recipients.count())
+
+    def _combine(self, rules):
+        # Folded left to right like Segment.recipients, None is everyone
+        combined = None
+        for rule in rules:
+            if rule.conditional in ['AND', None]:
+                combined = self.rule(rule) if combined is None else combined & self.rule(rule)
+            elif rule.conditional == 'OR':
+                combined = self.rule(rule) if combined is None else combined | self.rule(rule)
+        return combined
+
+    def rules(self, rules):
+        '''
+        Returns the Audience of a segment with the given, possibly unsaved,
+        SegmentRules, in index order.
+        '''
+        include = self._combine([rule for rule in rules if rule.rule_type == 'include'])
+        exclude = self._combine([rule for rule in rules if rule.rule_type == 'exclude'])
+
+        audience = self.everyone() if include is None else include
+        if exclude is not None:
+            audience = audience - exclude
+        return audience
+
+    def segment(self, segment):
+        if segment.members_fresh:
+            return self._cached(
+                'segment:%d:%s' % (segment.pk, segment.refreshed_at.isoformat()),
+                lambda: RecipientBitmap.from_queryset(segment.members),
+                lambda: segment.memberships.count())
+        return self.rules(list(segment.rules.order_by('index')))
+
+    def email(self, email):
+        '''
+        Returns the Audience of an email: like email_audience, the
+        recipients of its groups and segments that aren't disabled or
+        unsubscribed.
+        '''
+        from manager.models import Recipient
+
+        audience = Audience(self.total, RecipientBitmap())
+        for group in email.recipient_groups.all():
+            audience = audience | self.group(group)
+        for segment in email.segments.all():
+            audience = audience | self.segment(segment)
+
+        if email.subscription_category:
+            category = email.subscription_category
+            unsubscribed = self._cached(
+                'unsubscribed:%d' % category.pk,
+                lambda: unsubscribed_recipients(category),
+                lambda: category.unsubscriptions.count())
+        else:
+            # Per email, and changed by every unsubscribe, so never cached
+            unsubscribed = Audience(self.total, RecipientBitmap.from_queryset(email.unsubscriptions.all()))
+
+        disabled = self._cached(
+            'disabled',
+            disabled_recipients,
+            lambda: Recipient.objects.filter(disable=True).count())
+        return audience - unsubscribed - disabled
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+
+log = logging.getLogger(__name__)
+
+
+class Content:
+    '''
+    The status code and body of a fetched URI, with the validators used to
+    revalidate it.
+    '''
+
+    def __init__(self, status_code, body, encoding=None, etag=None, last_modified=None):
+        self.status_code   = status_code
+        self.body          = body
+        self.encoding      = encoding
+        self.etag          = etag
+        self.last_modified = last_modified
+
+    @property
+    def text(self):
+        # Decoded like requests' Response.text
+        return str(self.body, self.encoding or 'utf-8', errors='replace')
+
+    @property
+    def cacheable(self):
+        return self.status_code == requests.codes.ok and bool(self.etag or self.last_modified)
+
+
+class ContentFetcher:
+    '''
+    Fetches email content over a shared keep-alive session.
+
+    Successful responses with an ETag or Last-Modified header are cached,
+    in directory when one is given, and later fetches of the same URI only
+    ask the server whether they changed (a 304 with no body when they
+    didn't). Content fetched less than memo_seconds ago is returned without
+    a request at all, so the html, text and placeholders of an email read
+    several times while previewing, sending or verifying it cost one round
+    trip.
+    '''
+
+    def __init__(self, directory=None, memo_seconds=10):
+        self.directory    = directory
+        self.memo_seconds = memo_seconds
+        self.session      = requests.Session()
+        self.session.verify = False
+
+        self._memo = {}  # uri: (time fetched, Content)
+        self._lock = threading.Lock()
+
+    def _path(self, uri):
+        return os.path.join(self.directory, hashlib.sha1(uri.encode('utf-8')).hexdigest())
+
+    def _load(self, uri):
+        '''
+        Returns the Content cached on disk for uri, or None.
+        '''
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(uri), 'rb') as cached:
+                header, body = cached.read().split(b'\n', 1)
+            header = json.loads(header.decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.exception('Unable to read cached content for %s' % uri)
+            return None
+        if header.get('uri') != uri:
+            return None
+        return Content(requests.codes.ok, body, header['encoding'], header['etag'], header['last_modified'])
+
+    def _store(self, uri, content):
+        if self.directory is None:
+            return
+        header = json.dumps({
+            'uri': uri,
+            'encoding': content.encoding,
+            'etag': content.etag,
+            'last_modified': content.last_modified
+        }).encode('utf-8')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written aside and moved into place so readers never see part
+            # of a file
+            fd, path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as cached:
+                cached.write(header + b'\n' + content.body)
+            os.replace(path, self._path(uri))
+        except OSError:
+            log.exception('Unable to cache content for %s' % uri)
+
+    def fetch(self, uri):
+        '''
+        Returns the Content of uri. Raises requests' exceptions, which are
+        IOErrors, if it can't be fetched.
+        '''
+        with self._lock:
+            memo = self._memo.get(uri)
+        if memo is not None and time.monotonic() - memo[0] < self.memo_seconds:
+            return memo[1]
+
+        cached = memo[1] if memo is not None and memo[1].cacheable else self._load(uri)
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        response = self.session.get(uri, headers=headers)
+        if response.status_code == requests.codes.not_modified and cached is not None:
+            content = cached
+        else:
+            content = Content(
+                response.status_code,
+                response.content,
+                response.encoding or response.apparent_encoding,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+            if content.cacheable:
+                self._store(uri, content)
+
+        with self._lock:
+            self._memo[uri] = (time.monotonic(), content)
+        return content
+
+
+_content_fetcher      = None
+_content_fetcher_lock = threading.Lock()
+
+
+def content_fetcher():
+    '''
+    Returns the process wide content fetcher, caching content in
+    CONTENT_CACHE_DIR for CONTENT_MEMO_SECONDS.
+    '''
+    global _content_fetcher
+
+    with _content_fetcher_lock:
+        if _content_fetcher is None:
+            _content_fetcher = ContentFetcher(
+                directory=getattr(settings, 'CONTENT_CACHE_DIR', None),
+                memo_seconds=getattr(settings, 'CONTENT_MEMO_SECONDS', 10)
+            )
+        return _content_fetcher
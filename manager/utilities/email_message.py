@@ -1,5 +1,7 @@
 import base64
+import uuid
 from bs4 import BeautifulSoup
+from email import base64mime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -68,12 +70,20 @@ class EmailMessage:
 
         return b64_str
 
-    def attach_html(self, html):
+    def attach_html(self, html, normalized=False):
         '''
         Encodes and attaches an HTML string to the message.
+
+        If normalized is True, html is UTF-8 encoded bytes that have
+        already been through the BeautifulSoup round trip below (see
+        EmailTemplate.render_normalized) and is attached as is.
         '''
         self.html = html
 
+        if normalized:
+            self.msg.attach(MIMEText(html, 'html', _charset='utf-8'))
+            return
+
         # Convert the HTML string to soup and back again.
         # BeautifulSoup converts HTML entities to unicode chars before encoding
         # to UTF-8. While not necessary for sending HTML via SES, this step
@@ -98,3 +108,82 @@ class EmailMessage:
         Returns the email message as a ready-to-send string.
         '''
         return self.msg.as_string()
+
+
+class MessageFactory:
+    '''
+    Builds the messages of an instance from a skeleton serialized once.
+
+    Every message of an instance shares its headers, MIME boundary and
+    text/plain part, so those are generated once by EmailMessage and only
+    the To header and the base64 encoded HTML part are spliced in for each
+    recipient. The result is identical to EmailMessage.as_string() with
+    the skeleton's boundary.
+    '''
+
+    # Longest To header value that is never folded by the generator
+    _MAX_TO_LENGTH = 70
+
+    def __init__(self, subject, from_friendly_name, from_address, text=None):
+        self.subject = subject
+        self.from_friendly_name = from_friendly_name
+        self.from_address = from_address
+        self.text = text
+
+        # Serialize a message with markers in place of the recipient's
+        # address and html, then split it on them
+        marker = 'pmpart%s' % uuid.uuid4().hex
+        to_marker = marker + 'to'
+        html_marker = marker + 'html'
+
+        skeleton = EmailMessage(subject, from_friendly_name, from_address, to_address=to_marker)
+        skeleton.attach_html(b'', normalized=True)
+        skeleton.msg.get_payload(0).set_payload(html_marker)
+        if text is not None:
+            skeleton.attach_text(text)
+
+        serialized = skeleton.as_string()
+        if serialized.count(to_marker) != 1 or serialized.count(html_marker) != 1:
+            raise ValueError('message skeleton could not be split')
+        self.head, rest = serialized.split(to_marker)
+        self.middle, self.tail = rest.split(html_marker)
+        self.boundary = skeleton.msg.get_boundary()
+
+    def build(self, to_address, html, normalized=False):
+        '''
+        Returns the serialized message for to_address. html is passed to
+        EmailMessage.attach_html.
+        '''
+        if len(to_address) > self._MAX_TO_LENGTH \
+           or not to_address.isascii() \
+           or not to_address.isprintable():
+            # Addresses the generator would fold or encode
+            return self.message(to_address, html, normalized).as_string()
+
+        if not normalized:
+            html = BeautifulSoup(html, 'html.parser').encode('utf-8')
+
+        return ''.join([
+            self.head,
+            to_address,
+            self.middle,
+            base64mime.body_encode(html),
+            self.tail
+        ])
+
+    def message(self, to_address, html, normalized=False):
+        '''
+        Returns a complete EmailMessage for to_address, using the
+        skeleton's boundary.
+        '''
+        msg = EmailMessage(
+            subject=self.subject,
+            from_friendly_name=self.from_friendly_name,
+            from_address=self.from_address,
+            to_address=to_address
+        )
+        msg.msg.set_boundary(self.boundary)
+        msg.attach_html(html, normalized=normalized)
+        if self.text is not None:
+            msg.attach_text(self.text)
+        return msg
@@ -2,10 +2,10 @@ import logging
 import re
 import smtplib
 
-from django.conf import settings
-
-from manager.models import RecipientAttribute
+from manager.models import Recipient
 from manager.utilities.email_message import EmailMessage
+from manager.utilities.rate_limiter import amazon_rate_limiter
+from manager.utilities.smtp_pool import amazon_smtp_pool
 
 
 log = logging.getLogger(__name__)
@@ -32,33 +32,26 @@ class EmailSender:
         placeholders = re.findall(re.escape(delimiter) + '(.+)' + re.escape(delimiter), self.html)
         return [p for p in placeholders if p.lower() != 'unsubscribe']
 
-    def get_attributes(self, recipient):
-        attributes = {}
-        atts = RecipientAttribute.objects.filter(recipient=recipient)
-        for att in atts:
-            attributes[att.name] = att.value
-
-        return attributes
-
     def send(self):
+        placeholders = self.placeholders
+        recipient_attributes = Recipient.attributes_for(self.recipients, placeholders)
 
+        pool = amazon_smtp_pool()
         try:
-            amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'], settings.AMAZON_SMTP['port'])
-            amazon.login(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
+            pool.release(pool.acquire())
         except:
             log.exception('Unable to connect to amazon')
         else:
             for recipient in self.recipients:
-                # Get recipient attributes
-                attributes = self.get_attributes(recipient)
+                attributes = recipient_attributes[recipient.pk]
                 # Customize the email for this recipient
                 customized_html = self.html
                 # Replace template placeholders
                 delimiter = self.email.replace_delimiter
-                for placeholder in self.placeholders:
+                for placeholder in placeholders:
                     replacement = ''
                     if placeholder.lower() != 'unsubscribe':
-                        if attributes[placeholder] is None:
+                        if attributes.get(placeholder) is None:
                             log.error('Recipient %s is missing attribute %s' % (str(recipient), placeholder))
                         else:
                             replacement = attributes[placeholder]
@@ -72,7 +65,7 @@ class EmailSender:
                     html=customized_html
                 )
                 try:
-                    amazon.sendmail(self.email.from_email_address, recipient.email_address, msg.as_string())
+                    amazon_rate_limiter().acquire()
+                    pool.sendmail(self.email.from_email_address, recipient.email_address, msg.as_string())
                 except smtplib.SMTPException as e:
                     log.exception('Unable to send email.')
-            amazon.quit()
@@ -0,0 +1,507 @@
+import logging
+import re
+import string
+import urllib.parse
+import uuid
+
+from bs4 import BeautifulSoup
+
+from manager.utilities.tracking_links import TrackingLinkFactory
+from util import calc_url_mac, calc_open_mac, calc_click_token
+
+
+log = logging.getLogger(__name__)
+
+
+class EmailTemplate:
+    '''
+    A compiled, per-instance representation of an instance's sent_html.
+
+    The html is parsed once into a list of static fragments with typed
+    slots between them (placeholders, tracked hrefs, the open pixel and the
+    unsubscribe link), so personalizing the html for a recipient is a single
+    join instead of a str.replace pass over the whole document for every
+    placeholder and tracked URL.
+
+    Compilation replays the exact sequence of replacements performed by
+    render_legacy() against the static text. Whenever a replacement could
+    behave differently because of recipient-specific content (e.g. a
+    recipient attribute containing the delimiter, or a placeholder inside an
+    href that collides with another tracked link) the template falls back to
+    render_legacy() so output is always byte-identical.
+    '''
+
+    PLACEHOLDER = 'placeholder'
+    URL = 'url'
+    OPEN = 'open'
+    UNSUBSCRIBE = 'unsubscribe'
+
+    UNSUBSCRIBE_LINK = '<a href="%s" style="color:blue;text-decoration:none;">unsubscribe</a>'
+
+    # Characters that can appear in the query strings generated by
+    # urllib.parse.urlencode() for tracking links.
+    _URLENCODE_CHARS = frozenset(string.ascii_letters + string.digits + '_.-~%+&=')
+
+    # Characters in placeholder values that BeautifulSoup may not copy
+    # through to the normalized html unchanged.
+    _NORMALIZE_GUARDS = frozenset('&<>\'')
+
+    def __init__(self, instance, placeholders, tracking_urls, state=None):
+        self.instance = instance
+        self.sent_html = instance.sent_html
+        self.delimiter = instance.email.replace_delimiter
+        self.placeholders = placeholders
+        self.tracking_urls = tracking_urls
+
+        self.links = TrackingLinkFactory(instance, tracking_urls)
+        self.redirect_base = self.links.redirect_base
+        self.open_base = self.links.open_base
+
+        self.statics = None
+        self.slots = None
+        self.compiled = False
+
+        self.normalized_statics = None
+        self.normalized = False
+
+        if self.delimiter:
+            self.guards = frozenset([self.delimiter[0], '"'])
+            if state is None or not self._restore(state):
+                self.compiled = self._compile()
+                if self.compiled:
+                    self.normalized = self._compile_normalized()
+
+        if not self.compiled:
+            log.debug('instance %s html could not be compiled, using legacy rendering' % instance.pk)
+        elif not self.normalized:
+            log.debug('instance %s html could not be normalized once, normalizing per recipient' % instance.pk)
+
+    def state(self):
+        '''
+        Returns the compiled form as JSON serializable data. Passed back to
+        the constructor, with the same html, placeholders, tracked URLs and
+        tracking settings, it skips compiling the html again.
+        '''
+        return {
+            'bases': [self.redirect_base, self.open_base],
+            'compiled': self.compiled,
+            'statics': self.statics,
+            'slots': self.slots,
+            'normalized': self.normalized,
+            # Split at ASCII markers, so each fragment is valid UTF-8
+            'normalized_statics': [static.decode('utf-8') for static in self.normalized_statics] if self.normalized else None
+        }
+
+    def _restore(self, state):
+        '''
+        Restores a compiled form returned by state(). Returns False if it
+        was compiled for other tracking links.
+        '''
+        if state['bases'] != [self.redirect_base, self.open_base]:
+            return False
+
+        self.compiled = state['compiled']
+        if self.compiled:
+            self.statics = state['statics']
+            self.slots = [tuple(slot) for slot in state['slots']]
+            self.normalized = state['normalized']
+            if self.normalized:
+                self.normalized_statics = [static.encode('utf-8') for static in state['normalized_statics']]
+        return True
+
+    def _compile(self):
+        '''
+        Builds the static fragments and slots. Returns False if the
+        compiled form can not be guaranteed to match render_legacy().
+        '''
+        delimiter = self.delimiter
+
+        if delimiter[0] in self._URLENCODE_CHARS:
+            return False
+
+        # Tokens always alternate static, slot, static, ..., static
+        tokens = [self.sent_html]
+
+        # Placeholders
+        seen = set()
+        for placeholder in self.placeholders:
+            if placeholder in seen:
+                continue
+            seen.add(placeholder)
+
+            if delimiter in placeholder:
+                return False
+
+            pattern = delimiter + placeholder + delimiter
+            if self._may_straddle(tokens, pattern):
+                return False
+
+            tokens = self._split_all(tokens, pattern, [(self.PLACEHOLDER, placeholder)])
+
+        # URL tracking
+        if self.instance.urls_tracked:
+            prefix = self.redirect_base + '?'
+            for index, url in enumerate(self.tracking_urls):
+                if url.name.startswith(prefix):
+                    return False
+
+                pattern = 'href="' + url.name + '"'
+                if self._may_straddle(tokens, pattern):
+                    return False
+
+                tokens = self._split_first(tokens, pattern, [
+                    'href="' + prefix,
+                    (self.URL, index),
+                    '"'
+                ])
+
+        # Open tracking
+        if self.instance.opens_tracked:
+            tokens[-1] += '<img src="' + self.open_base + '?'
+            tokens.extend([(self.OPEN, None), '" />'])
+
+        # Unsubscribe link
+        pattern = delimiter + 'UNSUBSCRIBE' + delimiter
+        if self._may_straddle(tokens, pattern):
+            return False
+
+        link_start, link_end = self.UNSUBSCRIBE_LINK.split('%s')
+        tokens = self._split_all(tokens, pattern, [
+            link_start,
+            (self.UNSUBSCRIBE, None),
+            link_end
+        ])
+
+        self.statics = tokens[0::2]
+        self.slots = tokens[1::2]
+        return True
+
+    def _split_all(self, tokens, pattern, replacement):
+        '''
+        Replaces every occurrence of pattern in the static tokens with the
+        replacement, which is a list of static strings and slots.
+        '''
+        result = []
+        for i, token in enumerate(tokens):
+            if i % 2:
+                result.append(token)
+                continue
+
+            pieces = token.split(pattern)
+            self._append_static(result, pieces[0])
+            for piece in pieces[1:]:
+                self._append_replacement(result, replacement)
+                self._append_static(result, piece)
+        return result
+
+    def _split_first(self, tokens, pattern, replacement):
+        '''
+        Replaces the first occurrence of pattern in the static tokens with
+        the replacement.
+        '''
+        for i in range(0, len(tokens), 2):
+            token = tokens[i]
+            position = token.find(pattern)
+            if position >= 0:
+                result = tokens[:i]
+                self._append_static(result, token[:position])
+                self._append_replacement(result, replacement)
+                self._append_static(result, token[position + len(pattern):])
+                result.extend(tokens[i + 1:])
+                return result
+        return tokens
+
+    def _append_static(self, result, text):
+        if result and isinstance(result[-1], str):
+            result[-1] += text
+        else:
+            result.append(text)
+
+    def _append_replacement(self, result, replacement):
+        for part in replacement:
+            if isinstance(part, str):
+                self._append_static(result, part)
+            else:
+                if not result or not isinstance(result[-1], str):
+                    result.append('')
+                result.append(part)
+
+    def _may_straddle(self, tokens, pattern):
+        '''
+        Determines whether pattern could be matched across the boundary of
+        any slot, assuming slot values never contain a guard character.
+        '''
+        slot_count = len(tokens) // 2
+        for i in range(slot_count):
+            left = tokens[2 * i]
+            right = tokens[2 * i + 2]
+            left_open = i > 0
+            right_open = i < slot_count - 1
+            if self._straddles(left, left_open, right, right_open, pattern):
+                return True
+        return False
+
+    def _straddles(self, left, left_open, right, right_open, pattern):
+        '''
+        Checks if pattern can be written as A + g + B where A is a suffix of
+        the text before a slot, g is guard-free text produced by the slot and
+        B is a prefix of the text after it. When the text on either side is
+        itself bounded by another slot, any guard-free text is assumed to lie
+        beyond it.
+        '''
+        guards = self.guards
+        length = len(pattern)
+
+        # Length of the guard-free prefix and start of the guard-free
+        # suffix of the pattern.
+        free_prefix = 0
+        while free_prefix < length and pattern[free_prefix] not in guards:
+            free_prefix += 1
+        free_suffix = length
+        while free_suffix > 0 and pattern[free_suffix - 1] not in guards:
+            free_suffix -= 1
+
+        starts = [0]
+        if not left:
+            if left_open:
+                starts = list(range(free_prefix + 1))
+        else:
+            # Only positions following an occurrence of the last character
+            # of the left text can line up with it.
+            a = pattern.find(left[-1]) + 1
+            while a > 0:
+                head = pattern[:a]
+                if left.endswith(head):
+                    starts.append(a)
+                elif left_open and head.endswith(left) and a - len(left) <= free_prefix:
+                    starts.append(a)
+                a = pattern.find(left[-1], a) + 1
+
+        ends = [length]
+        if not right:
+            if right_open:
+                ends = list(range(free_suffix, length + 1))
+        else:
+            b = pattern.find(right[0])
+            while b >= 0:
+                tail = pattern[b:]
+                if right.startswith(tail):
+                    ends.append(b)
+                elif right_open and tail.startswith(right) and b + len(right) >= free_suffix:
+                    ends.append(b)
+                b = pattern.find(right[0], b + 1)
+
+        for a in starts:
+            for b in ends:
+                if b < a:
+                    continue
+                # Matches entirely on one side of the slot are static
+                # matches, which are handled by the replacement itself.
+                if b == a and (a == 0 or b == length):
+                    continue
+                if guards.isdisjoint(pattern[a:b]):
+                    return True
+        return False
+
+    def _compile_normalized(self):
+        '''
+        Runs the BeautifulSoup normalization done by EmailMessage.attach_html
+        once, over the static fragments with a marker in place of each
+        slot. Returns False if personalized values could change how the
+        surrounding html is parsed, in which case every recipient's html
+        is normalized separately.
+        '''
+        # A static ending in an unterminated entity reference could
+        # combine with the slot value that follows it
+        for static in self.statics[:-1]:
+            if re.search(r'&[^\s<>&;"\']*$', static):
+                return False
+
+        # Markers are lowercase alphanumerics so the parser leaves them as is
+        marker = 'pmslot%s' % uuid.uuid4().hex
+        markers = ['%s%06dx' % (marker, i) for i in range(len(self.slots))]
+
+        html = [self.statics[0]]
+        for i, static in enumerate(self.statics[1:]):
+            html.append(markers[i])
+            html.append(static)
+        normalized = self.normalize(''.join(html))
+
+        statics = []
+        position = 0
+        for m in markers:
+            m = m.encode('utf-8')
+            end = normalized.find(m, position)
+            if end < 0 or normalized.count(m) != 1:
+                return False
+            statics.append(normalized[position:end])
+            position = end + len(m)
+        statics.append(normalized[position:])
+
+        if marker.encode('utf-8') in statics[-1]:
+            return False
+        self.normalized_statics = statics
+
+        # Markers can't tell if a slot sits somewhere values are escaped,
+        # split or could end the surrounding markup (e.g. an unquoted
+        # attribute, or a placeholder inside a comment), so compare against
+        # the real normalization for a few values exercising those cases.
+        from manager.models import Recipient
+        probe = Recipient(pk=0, email_address='probe@ucf.edu')
+        for value in ['Probe value \u00e9 / 1', '', '-', '--', ']]']:
+            attributes = {placeholder: value for placeholder in self.placeholders}
+            if self._join_normalized(probe, attributes) != self.normalize(self.render(probe, attributes)):
+                self.normalized_statics = None
+                return False
+
+        return True
+
+    def normalize(self, html):
+        '''
+        The normalization EmailMessage.attach_html performs: a round trip
+        through BeautifulSoup, which converts html entities to unicode
+        characters, then UTF-8 encoding.
+        '''
+        return BeautifulSoup(html, 'html.parser').encode('utf-8')
+
+    def placeholder_value(self, recipient, attributes, placeholder):
+        value = attributes.get(placeholder)
+        if value is None:
+            log.error('Recipient %s is missing attribute %s' % (str(recipient), placeholder))
+            return ''
+        return value
+
+    def url_query(self, recipient, url):
+        if self.links.compact:
+            return urllib.parse.urlencode({
+                'token':calc_click_token(url.pk, recipient.pk, self.instance.pk)
+            })
+        return urllib.parse.urlencode({
+            'instance'  :self.instance.pk,
+            'recipient' :recipient.pk,
+            'url'       :urllib.parse.quote(url.name),
+            'position'  :url.position,
+            # The mac uniquely identifies the recipient and acts as a secure integrity check
+            'mac'       :calc_url_mac(url.name, url.position, recipient.pk, self.instance.pk)
+        })
+
+    def open_query(self, recipient):
+        return urllib.parse.urlencode({
+            'recipient':recipient.pk,
+            'instance' :self.instance.pk,
+            'mac'      :calc_open_mac(recipient.pk, self.instance.pk)
+        })
+
+    def slot_values(self, recipient, attributes):
+        '''
+        Returns a dictionary of slot to the recipient's value, or None if
+        a placeholder value contains a guard character.
+        '''
+        values = {}
+        for slot in self.slots:
+            if slot in values:
+                continue
+
+            kind, key = slot
+            if kind == self.PLACEHOLDER:
+                value = self.placeholder_value(recipient, attributes, key)
+                if not self.guards.isdisjoint(value):
+                    return None
+            elif kind == self.URL:
+                value = self.links.url_query(recipient.pk, key)
+            elif kind == self.OPEN:
+                value = self.links.open_query(recipient.pk)
+            else:
+                value = self.links.unsubscribe_url(recipient)
+            values[slot] = value
+        return values
+
+    def render(self, recipient, attributes):
+        '''
+        Returns the personalized html for the recipient. attributes maps
+        placeholder names to the recipient's attribute values (or None).
+        '''
+        if not self.compiled:
+            return self.render_legacy(recipient, attributes)
+
+        values = self.slot_values(recipient, attributes)
+        if values is None:
+            return self.render_legacy(recipient, attributes)
+
+        statics = self.statics
+        parts = [statics[0]]
+        for i, slot in enumerate(self.slots):
+            parts.append(values[slot])
+            parts.append(statics[i + 1])
+        return ''.join(parts)
+
+    def render_normalized(self, recipient, attributes):
+        '''
+        Returns normalize(render(recipient, attributes)), without parsing
+        the html for each recipient when possible.
+        '''
+        if self.normalized:
+            html = self._join_normalized(recipient, attributes)
+            if html is not None:
+                return html
+        return self.normalize(self.render(recipient, attributes))
+
+    def _join_normalized(self, recipient, attributes):
+        '''
+        Joins the normalized static fragments with the recipient's values.
+        Returns None if a value has to be parsed with the rest of the html.
+        '''
+        values = self.slot_values(recipient, attributes)
+        if values is None:
+            return None
+
+        encoded = {}
+        for slot, value in values.items():
+            if slot[0] == self.PLACEHOLDER:
+                # Values with markup or entity characters are parsed with
+                # the rest of the html
+                if not self._NORMALIZE_GUARDS.isdisjoint(value):
+                    return None
+            else:
+                # Tracking URLs are always attribute values
+                value = value.replace('&', '&amp;')
+            encoded[slot] = value.encode('utf-8')
+
+        statics = self.normalized_statics
+        parts = [statics[0]]
+        for i, slot in enumerate(self.slots):
+            parts.append(encoded[slot])
+            parts.append(statics[i + 1])
+        return b''.join(parts)
+
+    def render_legacy(self, recipient, attributes):
+        '''
+        Personalizes the html by running each replacement over the whole
+        document. This is the reference implementation render() must match.
+        '''
+        customized_html = self.sent_html
+        delimiter = self.delimiter
+        # Replace template placeholders
+        for placeholder in self.placeholders:
+            if placeholder.lower() != 'unsubscribe':
+                replacement = self.placeholder_value(recipient, attributes, placeholder)
+                customized_html = customized_html.replace(delimiter + placeholder + delimiter, replacement)
+        # URL Tracking
+        if self.instance.urls_tracked:
+            for url in self.tracking_urls:
+                tracking_url = '?'.join([self.redirect_base, self.url_query(recipient, url)])
+                customized_html = customized_html.replace(
+                    'href="' + url.name + '"',
+                    'href="' + tracking_url + '"',
+                    1
+                )
+        # Open Tracking
+        if self.instance.opens_tracked:
+            customized_html += '<img src="%s" />' % '?'.join([self.open_base, self.open_query(recipient)])
+        # Unsubscribe link
+        customized_html = re.sub(
+            re.escape(delimiter) + 'UNSUBSCRIBE' + re.escape(delimiter),
+            self.UNSUBSCRIBE_LINK % recipient.unsubscribe_url,
+            customized_html)
+
+        return customized_html
@@ -0,0 +1,116 @@
+import threading
+import time
+
+from django.conf import settings
+
+
+class TokenBucket:
+    '''
+    A thread safe token bucket. Tokens are added continuously at rate per
+    second up to capacity, and each message sent takes one. Callers that
+    find the bucket empty wait exactly as long as it takes for the next
+    token to arrive, so the combined sending rate of every thread sharing
+    the bucket stays at rate instead of bursting and being throttled.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate     = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens  = self.capacity
+        self._updated = time.monotonic()
+        self._lock    = threading.Lock()
+
+        # Instrumentation
+        self.acquired   = 0
+        self.waits      = 0
+        self.total_wait = 0.0
+        self.max_wait   = 0.0
+
+    def _refill(self, now):
+        self._tokens  = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def level(self):
+        '''
+        Number of tokens currently available. Negative when callers are
+        waiting on tokens that have already been reserved.
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    @property
+    def average_wait(self):
+        return self.total_wait / self.acquired if self.acquired else 0.0
+
+    def acquire(self):
+        '''
+        Takes a token, blocking until one is available. Returns the number
+        of seconds waited.
+        '''
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self):
+        '''
+        Takes a token without blocking. Returns the number of seconds the
+        caller must wait before using it, e.g. with asyncio.sleep().
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            # Reserve the token now so waiting callers are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+            self.acquired += 1
+            if wait:
+                self.waits      += 1
+                self.total_wait += wait
+                self.max_wait    = max(self.max_wait, wait)
+
+        return wait
+
+    def drain(self):
+        '''
+        Empties the bucket, e.g. after the server reports the sending rate
+        was exceeded, so all callers back off until tokens accumulate again.
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0)
+
+    def stats(self):
+        return {
+            'rate'        : self.rate,
+            'capacity'    : self.capacity,
+            'level'       : self.level,
+            'acquired'    : self.acquired,
+            'waits'       : self.waits,
+            'total_wait'  : self.total_wait,
+            'average_wait': self.average_wait,
+            'max_wait'    : self.max_wait,
+        }
+
+
+_amazon_limiter      = None
+_amazon_limiter_lock = threading.Lock()
+
+
+def amazon_rate_limiter():
+    '''
+    Returns the process wide limiter for sending through Amazon SES,
+    configured from AMAZON_SMTP['rate'] (messages per second) and the
+    optional AMAZON_SMTP['burst'] (bucket capacity, defaults to the rate).
+    '''
+    global _amazon_limiter
+
+    with _amazon_limiter_lock:
+        if _amazon_limiter is None:
+            _amazon_limiter = TokenBucket(
+                settings.AMAZON_SMTP['rate'],
+                settings.AMAZON_SMTP.get('burst')
+            )
+        return _amazon_limiter
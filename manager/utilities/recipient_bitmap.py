@@ -0,0 +1,194 @@
+from itertools import islice
+
+
+# The set bit positions of every byte value
+_BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if byte & (1 << bit))
+    for byte in range(256)
+)
+
+
+class RecipientBitmap:
+    '''
+    A set of recipient ids stored as the bits of a Python int, so sets of
+    hundreds of thousands of recipients take a few hundred kilobytes and
+    are combined with single big integer operations instead of joins and
+    DISTINCT or sets of model objects.
+
+    Supports | (or), & (and), - (and not), len() (cardinality), in and
+    iteration in ascending id order.
+    '''
+
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    @classmethod
+    def from_ids(cls, ids):
+        ids = ids if isinstance(ids, (list, tuple)) else list(ids)
+        if not ids:
+            return cls()
+
+        data = bytearray((max(ids) >> 3) + 1)
+        for recipient_id in ids:
+            data[recipient_id >> 3] |= 1 << (recipient_id & 7)
+        return cls(int.from_bytes(data, 'little'))
+
+    @classmethod
+    def from_queryset(cls, queryset, field='pk'):
+        '''
+        Returns the bitmap of the recipient ids in a queryset's field.
+        '''
+        return cls.from_ids(queryset.order_by().values_list(field, flat=True))
+
+    def __or__(self, other):
+        return RecipientBitmap(self.bits | other.bits)
+
+    def __and__(self, other):
+        return RecipientBitmap(self.bits & other.bits)
+
+    def __sub__(self, other):
+        return RecipientBitmap(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, RecipientBitmap) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __len__(self):
+        if hasattr(self.bits, 'bit_count'):
+            return self.bits.bit_count()
+        return bin(self.bits).count('1')
+
+    def __contains__(self, recipient_id):
+        return recipient_id >= 0 and (self.bits >> recipient_id) & 1 == 1
+
+    def __iter__(self):
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) >> 3, 'little')
+        for index, byte in enumerate(data):
+            if byte:
+                base = index << 3
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
+
+    def __repr__(self):
+        return '<RecipientBitmap: %d recipients>' % len(self)
+
+    def chunks(self, size=1000):
+        '''
+        Yields lists of at most size recipient ids, in ascending order.
+        '''
+        ids = iter(self)
+        while True:
+            chunk = list(islice(ids, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def recipients(self, chunk_size=1000):
+        '''
+        Yields the Recipient objects in the bitmap, in ascending id order,
+        loading chunk_size of them per query.
+        '''
+        from manager.models import Recipient
+
+        for chunk in self.chunks(chunk_size):
+            for recipient in Recipient.objects.filter(pk__in=chunk).order_by('pk'):
+                yield recipient
+
+
+def group_recipients(*groups):
+    '''
+    Returns the recipients in any of the given recipient groups.
+    '''
+    from manager.models import RecipientGroup
+
+    return RecipientBitmap.from_queryset(
+        RecipientGroup.recipients.through.objects.filter(recipientgroup__in=groups),
+        'recipient_id')
+
+
+def unsubscribed_recipients(category):
+    '''
+    Returns the recipients unsubscribed from a subscription category.
+    '''
+    return RecipientBitmap.from_queryset(category.unsubscriptions.all())
+
+
+def disabled_recipients():
+    from manager.models import Recipient
+
+    return RecipientBitmap.from_queryset(Recipient.objects.filter(disable=True))
+
+
+def received_recipients(instance):
+    '''
+    Returns the recipients an instance was sent to.
+    '''
+    from manager.models import InstanceRecipientDetails
+
+    return RecipientBitmap.from_queryset(
+        InstanceRecipientDetails.objects.filter(instance=instance),
+        'recipient_id')
+
+
+def clicked_recipients(instance=None, urls=None):
+    '''
+    Returns the recipients who clicked any URL of an instance, or any of
+    the given URLs.
+    '''
+    from manager.models import URLClick
+
+    clicks = URLClick.objects.all()
+    if instance is not None:
+        clicks = clicks.filter(url__instance=instance)
+    if urls is not None:
+        clicks = clicks.filter(url__in=urls)
+    return RecipientBitmap.from_queryset(clicks, 'recipient_id')
+
+
+def opened_recipients(instance, clicks=True):
+    '''
+    Returns the recipients who opened an instance. Like
+    Instance.open_recipients, recipients who clicked are included unless
+    clicks is False.
+    '''
+    from manager.models import InstanceOpen
+
+    opened = RecipientBitmap.from_queryset(InstanceOpen.objects.filter(instance=instance), 'recipient_id')
+    if clicks:
+        opened |= clicked_recipients(instance)
+    return opened
+
+
+def email_recipients(email):
+    '''
+    Returns the recipients of an email's groups and segments, including
+    unsubscribed and disabled ones.
+    '''
+    recipients = group_recipients(*email.recipient_groups.all())
+    for segment in email.segments.all():
+        recipients |= RecipientBitmap.from_queryset(segment.current_recipients)
+    return recipients
+
+
+def email_audience(email, recipients=None):
+    '''
+    Returns the recipients an email is sent to: the recipients of its
+    groups and segments that aren't disabled or unsubscribed. recipients,
+    e.g. staged before the send, are used instead of the email_recipients
+    when given.
+    '''
+    audience = email_recipients(email) if recipients is None else recipients
+
+    if email.subscription_category:
+        audience -= unsubscribed_recipients(email.subscription_category)
+    else:
+        audience -= RecipientBitmap.from_queryset(email.unsubscriptions.all())
+
+    return audience - disabled_recipients()
@@ -0,0 +1,109 @@
+import logging
+import multiprocessing
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+
+log = logging.getLogger(__name__)
+
+
+def build_message(template, factory, recipient, attributes):
+    '''
+    Personalizes the instance html for a recipient and returns the
+    serialized MIME message, ready to be passed to sendmail.
+    '''
+    return factory.build(
+        recipient.email_address,
+        template.render_normalized(recipient, attributes),
+        normalized=True)
+
+
+# Per process state of the render workers, set once by _initialize so the
+# template and message factory aren't pickled with every batch
+_worker = {}
+
+
+def _initialize(state):
+    # The state holds model instances, so it can only be unpickled once
+    # Django is set up in the worker process
+    import django
+    django.setup()
+
+    _worker.update(pickle.loads(state))
+
+
+def _render(jobs):
+    from manager.models import Recipient
+
+    # Rendering only needs the recipient's pk and address
+    return [
+        build_message(
+            _worker['template'],
+            _worker['factory'],
+            Recipient(pk=recipient_pk, email_address=email_address),
+            attributes)
+        for recipient_pk, email_address, attributes in jobs
+    ]
+
+
+class RenderPool:
+    '''
+    Renders and serializes messages in worker processes so building
+    messages is not serialized by the GIL with the sending threads.
+    '''
+
+    def __init__(self, processes, template, factory):
+        self.processes = processes
+        # Workers are spawned rather than forked since the sending threads
+        # may already be running
+        self.executor  = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize,
+            initargs=(pickle.dumps({
+                'template': template,
+                'factory' : factory
+            }),)
+        )
+
+    def submit(self, recipients, recipient_attributes):
+        '''
+        Starts rendering the messages for recipients, split evenly between
+        the worker processes, and returns the futures of the chunks in
+        order. Only the pk, address and attributes of each recipient are
+        sent to the workers.
+        '''
+        jobs = [
+            (recipient.pk, recipient.email_address, recipient_attributes[recipient.pk])
+            for recipient in recipients
+        ]
+        chunk_size = max(1, -(-len(jobs) // self.processes))
+        return [
+            self.executor.submit(_render, jobs[i:i + chunk_size])
+            for i in range(0, len(jobs), chunk_size)
+        ]
+
+    @staticmethod
+    def results(futures):
+        '''
+        Returns the messages of submitted futures, in order, waiting for
+        the ones that are still rendering.
+        '''
+        messages = []
+        for future in futures:
+            messages.extend(future.result())
+        return messages
+
+    def render(self, recipients, recipient_attributes):
+        '''
+        Returns the messages for recipients, in order.
+        '''
+        return self.results(self.submit(recipients, recipient_attributes))
+
+    @staticmethod
+    def cancel(futures):
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from queue import Queue, Empty
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+log = logging.getLogger(__name__)
+
+
+class ResultRecorder(threading.Thread):
+    '''
+    Collects the outcome of each send attempt from the sending threads and
+    writes them to InstanceRecipientDetails in batches.
+
+    Outcomes are flushed with bulk_update once batch_size of them are
+    pending or interval seconds have passed since the last flush, so the
+    recorded progress of an instance lags by at most one interval. stop()
+    flushes everything recorded before it was called. Successful sends are
+    added to the sent counter of the instance with instance_pk.
+
+    A batch that can't be written is retried once, then written one row at
+    a time. If that fails too, error is set and stop() raises it, since
+    the unrecorded recipients would look unsent and be sent to again.
+    '''
+
+    def __init__(self, instance_pk=None, batch_size=None, interval=None):
+        super(ResultRecorder, self).__init__(name='ResultRecorder')
+        self.daemon      = True
+        self.instance_pk = instance_pk
+        self.batch_size  = batch_size or getattr(settings, 'SEND_RECORD_BATCH_SIZE', 500)
+        self.interval    = interval or getattr(settings, 'SEND_RECORD_INTERVAL', 2)
+        self.results     = Queue()
+        self.error       = None
+
+    def record(self, detail_id, when, exception_msg):
+        '''
+        Queues the outcome of sending to one recipient. Safe to call from
+        any thread.
+        '''
+        self.results.put((detail_id, when, exception_msg))
+
+    def stop(self):
+        '''
+        Flushes all recorded outcomes and waits for the recorder to exit.
+        Raises the error of the first batch that couldn't be written.
+        '''
+        self.results.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        pending  = []
+        deadline = time.monotonic() + self.interval
+        stopping = False
+
+        while not stopping:
+            try:
+                result = self.results.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                result = ()
+
+            if result is None:
+                stopping = True
+            elif result:
+                pending.append(result)
+
+            if stopping or len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                self.flush(pending)
+                pending  = []
+                deadline = time.monotonic() + self.interval
+
+    def _write(self, results):
+        from manager.models import Instance, InstanceRecipientDetails
+
+        details = [
+            InstanceRecipientDetails(pk=detail_id, when=when, exception_msg=exception_msg)
+            for detail_id, when, exception_msg in results
+        ]
+        # The counter only moves if the outcomes are written, so a retry
+        # doesn't count them twice
+        with transaction.atomic():
+            InstanceRecipientDetails.objects.bulk_update(
+                details,
+                ['when', 'exception_msg'],
+                batch_size=self.batch_size
+            )
+            if self.instance_pk is not None:
+                Instance.objects.increment_counters(
+                    self.instance_pk,
+                    sent_total=sum(1 for detail in details if detail.when is not None))
+
+    def flush(self, results):
+        if not results:
+            return
+
+        for attempt in range(2):
+            try:
+                self._write(results)
+                return
+            except Exception:
+                log.exception('Unable to record %d send results' % len(results))
+                # A dropped connection is reopened by the next query
+                if not connection.in_atomic_block:
+                    connection.close()
+
+        # One row at a time, so the rows that can be written are
+        for result in results:
+            try:
+                self._write([result])
+            except Exception as e:
+                log.exception('Unable to record send result for detail %d' % result[0])
+                if self.error is None:
+                    self.error = e
@@ -2,7 +2,9 @@ import logging
 import smtplib
 
 from email.mime.text import MIMEText
-from django.conf import settings
+
+from manager.utilities.rate_limiter import amazon_rate_limiter
+from manager.utilities.smtp_pool import amazon_smtp_pool
 
 
 log = logging.getLogger(__name__)
@@ -22,9 +24,9 @@ class SimpleEmailSender:
         self.recipients = recipients
 
     def send(self):
+        pool = amazon_smtp_pool()
         try:
-            amazon = smtplib.SMTP_SSL(settings.AMAZON_SMTP['host'], settings.AMAZON_SMTP['port'])
-            amazon.login(settings.AMAZON_SMTP['username'], settings.AMAZON_SMTP['password'])
+            pool.release(pool.acquire())
         except:
             print('Unable to connect to amazon')
             log.exception('Unable to connect to amazon')
@@ -36,7 +38,7 @@ class SimpleEmailSender:
                 msg['To'] = recipient
 
                 try:
-                    amazon.sendmail(self.from_email, recipient, msg.as_string())
+                    amazon_rate_limiter().acquire()
+                    pool.sendmail(self.from_email, recipient, msg.as_string())
                 except smtplib.SMTPException as e:
                     log.exception('Unable to send email.')
-            amazon.quit()
@@ -0,0 +1,201 @@
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+log = logging.getLogger(__name__)
+
+
+class SMTPConnectionPool:
+    '''
+    A thread safe pool of logged in SMTP_SSL connections.
+
+    Opening a connection to Amazon costs a TLS handshake and an AUTH round
+    trip, so connections are handed back to the pool after use and reused
+    by later senders. At most size connections are open at once; acquire()
+    blocks until one is available.
+
+    Connections that sat idle longer than idle_timeout are closed instead of
+    reused. Connections idle for more than health_check_interval are checked
+    with NOOP before they are handed out, and replaced if the server has
+    dropped them.
+    '''
+
+    def __init__(self, host, port, username, password, size=1,
+                 idle_timeout=60, health_check_interval=5):
+        self.host                  = host
+        self.port                  = port
+        self.username              = username
+        self.password              = password
+        self.size                  = size
+        self.idle_timeout          = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle      = []  # (connection, time returned to the pool)
+        self._lock      = threading.Lock()
+        self._available = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        connection = smtplib.SMTP_SSL(self.host, self.port)
+        try:
+            connection.login(self.username, self.password)
+        except:
+            self._close(connection)
+            raise
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def _is_healthy(self, connection):
+        try:
+            status = connection.noop()[0]
+        except (smtplib.SMTPException, OSError):
+            return False
+        return status == 250
+
+    def acquire(self):
+        '''
+        Returns a logged in connection, reusing an idle one when possible.
+        Every acquired connection must be given back with release() or
+        discard().
+        '''
+        self._available.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, returned = self._idle.pop()
+
+                idle = time.monotonic() - returned
+                if idle > self.idle_timeout:
+                    self._close(connection)
+                elif idle > self.health_check_interval and not self._is_healthy(connection):
+                    log.debug('Discarding dropped SMTP connection')
+                    connection.close()
+                else:
+                    return connection
+
+            return self._connect()
+        except:
+            self._available.release()
+            raise
+
+    def release(self, connection):
+        '''
+        Returns a connection to the pool for reuse.
+        '''
+        with self._lock:
+            self._idle.append((connection, time.monotonic()))
+        self._available.release()
+
+    def discard(self, connection):
+        '''
+        Closes a connection that should not be reused (e.g. after
+        SMTPServerDisconnected) and frees its place in the pool.
+        '''
+        try:
+            connection.close()
+        finally:
+            self._available.release()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager that acquires a connection and returns it to the
+        pool afterwards. The connection is discarded if the server
+        disconnected while it was in use.
+        '''
+        connection = self.acquire()
+        try:
+            yield connection
+        except smtplib.SMTPServerDisconnected:
+            self.discard(connection)
+            raise
+        except:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        '''
+        Sends a message on a pooled connection. If the server has closed
+        the connection, the message is retried once on a new one.
+        '''
+        try:
+            with self.connection() as connection:
+                return connection.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            log.debug('SMTP connection lost, reconnecting')
+            with self.connection() as connection:
+                return connection.sendmail(from_addr, to_addrs, msg)
+
+    def warm(self, count=None):
+        '''
+        Opens connections ahead of time so the first messages of a send
+        don't pay for the handshake. Each connection joins the pool as soon
+        as it is logged in, and only free places are used, so senders
+        acquiring meanwhile are never kept waiting. Returns the number of
+        connections opened.
+        '''
+        count  = min(count or self.size, self.size)
+        opened = 0
+        for i in range(count):
+            with self._lock:
+                if len(self._idle) >= count:
+                    break
+            if not self._available.acquire(blocking=False):
+                break
+            try:
+                connection = self._connect()
+            except (smtplib.SMTPException, OSError):
+                self._available.release()
+                log.exception('Unable to warm SMTP connection pool')
+                break
+            self.release(connection)
+            opened += 1
+        return opened
+
+    def close(self):
+        '''
+        Closes all idle connections.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, returned in idle:
+            self._close(connection)
+
+
+_amazon_pool      = None
+_amazon_pool_lock = threading.Lock()
+
+
+def amazon_smtp_pool():
+    '''
+    Returns the process wide connection pool for Amazon SES, configured from
+    AMAZON_SMTP. The optional 'pool_size' (defaults to the sending rate),
+    'idle_timeout' and 'health_check_interval' keys tune the pool.
+    '''
+    global _amazon_pool
+
+    with _amazon_pool_lock:
+        if _amazon_pool is None:
+            _amazon_pool = SMTPConnectionPool(
+                settings.AMAZON_SMTP['host'],
+                settings.AMAZON_SMTP['port'],
+                settings.AMAZON_SMTP['username'],
+                settings.AMAZON_SMTP['password'],
+                size=settings.AMAZON_SMTP.get('pool_size', settings.AMAZON_SMTP['rate']),
+                idle_timeout=settings.AMAZON_SMTP.get('idle_timeout', 60),
+                health_check_interval=settings.AMAZON_SMTP.get('health_check_interval', 5)
+            )
+        return _amazon_pool
@@ -0,0 +1,109 @@
+import logging
+import urllib.parse
+from html import unescape
+
+from django.conf import settings
+from django.core import signals
+from django.urls import reverse
+from django.utils.encoding import iri_to_uri
+
+from manager.utilities.tracking_links import click_target
+from manager.utilities.tracking_spool import record_click, record_open
+from util import calc_open_mac
+
+
+log = logging.getLogger(__name__)
+
+
+class TrackingApplication:
+    '''
+    A minimal WSGI application serving only the open pixel and the click
+    redirect, without Django's middleware, URL resolution or request and
+    response objects. See tracking_wsgi.py.
+
+    It validates and records opens and compact links exactly like the
+    instance_open and redirect views. Clicks on links in the old format
+    are passed on to the full Django application.
+    '''
+
+    # Schemes HttpResponseRedirect allows
+    ALLOWED_SCHEMES = frozenset(['http', 'https', 'ftp'])
+
+    def __init__(self, fallback=None):
+        self.open_paths = self._paths(reverse('manager-email-open'))
+        self.redirect_paths = self._paths(reverse('manager-email-redirect'))
+        self.fallback = fallback
+
+    def _paths(self, path):
+        # The url patterns make the trailing slash optional
+        path = path.rstrip('/')
+        return frozenset([path, path + '/'])
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+            return self.respond(start_response, '405 Method Not Allowed')
+
+        query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+        # Like request.GET.get, the last value of a parameter wins
+        params = {name: values[-1] for name, values in query.items()}
+
+        if path in self.redirect_paths and 'token' not in params:
+            return self.django(environ, start_response)
+        if path not in self.open_paths and path not in self.redirect_paths:
+            return self.respond(start_response, '404 Not Found')
+
+        # Lets Django close database connections that are too old or
+        # broken, as it does around every request
+        signals.request_started.send(sender=self.__class__, environ=environ)
+        try:
+            if path in self.open_paths:
+                return self.open(start_response, params)
+            return self.redirect(start_response, params['token'])
+        finally:
+            signals.request_finished.send(sender=self.__class__)
+
+    def respond(self, start_response, status, headers=None, body=b''):
+        start_response(status, (headers or []) + [('Content-Length', str(len(body)))])
+        return [body]
+
+    def open(self, start_response, params):
+        try:
+            instance_id = int(params.get('instance'))
+            recipient_id = int(params.get('recipient'))
+        except (TypeError, ValueError):
+            # missing or corrupted
+            pass
+        else:
+            if params.get('mac') == calc_open_mac(recipient_id, instance_id):
+                # No matter what happens, make sure the pixel is returned
+                try:
+                    record_open(recipient_id, instance_id)
+                except Exception as e:
+                    log.error(str(e))
+
+        return self.respond(start_response, '200 OK', [('Content-Type', 'image/png')], settings.DOT)
+
+    def redirect(self, start_response, token):
+        target = click_target(token)
+        if target is None:
+            return self.respond(start_response, '404 Not Found')
+        url_id, recipient_id, url_string = target
+
+        # No matter what happens, make sure the redirection works
+        try:
+            record_click(recipient_id, url_id)
+        except Exception as e:
+            log.error(str(e))
+
+        location = iri_to_uri(unescape(url_string))
+        scheme = urllib.parse.urlparse(location).scheme
+        if scheme and scheme not in self.ALLOWED_SCHEMES:
+            return self.respond(start_response, '400 Bad Request')
+        return self.respond(start_response, '302 Found', [('Location', location)])
+
+    def django(self, environ, start_response):
+        if self.fallback is None:
+            from django.core.wsgi import get_wsgi_application
+            self.fallback = get_wsgi_application()
+        return self.fallback(environ, start_response)
@@ -0,0 +1,196 @@
+import base64
+import functools
+import hashlib
+import hmac
+import urllib.parse
+
+from django.conf import settings
+from django.urls import reverse
+
+from util import encode_varint, parse_click_token, CLICK_TOKEN_MAC_LENGTH
+
+
+@functools.lru_cache(maxsize=getattr(settings, 'TRACKING_URL_CACHE_SIZE', 10000))
+def tracked_url(url_id):
+    '''
+    Returns the instance id and name of the URL with url_id. URLs never
+    change once created, so they are cached for the life of the process.
+    Raises URL.DoesNotExist for unknown ids, which are not cached.
+    '''
+    from manager.models import URL
+    return URL.objects.values_list('instance_id', 'name').get(pk=url_id)
+
+
+def click_target(token):
+    '''
+    Returns (url_id, recipient_id, url name) for a compact tracking link's
+    token, or None if the token is invalid or the URL no longer exists.
+    '''
+    ids = parse_click_token(token)
+    if ids is None:
+        return None
+    url_id, recipient_id, instance_id = ids
+
+    from manager.models import URL
+    try:
+        url_instance_id, name = tracked_url(url_id)
+        if url_instance_id != instance_id:
+            # The cached URL was deleted and its id reused
+            url_instance_id, name = URL.objects.values_list('instance_id', 'name').get(pk=url_id)
+    except URL.DoesNotExist:
+        return None
+    if url_instance_id != instance_id:
+        return None
+    return url_id, recipient_id, name
+
+
+class TrackingLinkFactory:
+    '''
+    Generates an instance's tracking links for each recipient.
+
+    Everything that doesn't depend on the recipient is done once per
+    instance: the reverse()d prefixes are resolved, the tracked URLs are
+    quoted, and the MACs are computed from HMAC objects that already hold
+    the secret key and the leading, recipient independent part of the
+    message. A recipient's link is then an HMAC copy and a few string
+    concatenations. The output is identical to urlencode()ing the query
+    with the MACs from util.calc_url_mac, calc_open_mac and
+    calc_unsubscribe_mac.
+
+    With TRACKING_COMPACT_LINKS (the default) tracked URLs are redirected
+    with a util.calc_click_token token instead, which the redirect view
+    can validate without reading the database.
+    '''
+
+    # Recipient pk used to resolve the unsubscribe url with reverse()
+    _PK_MARKER = 918273645
+
+    def __init__(self, instance, tracking_urls):
+        self.instance_pk = instance.pk
+        self.tracking_urls = tracking_urls
+
+        self.redirect_base = settings.PROJECT_URL + reverse('manager-email-redirect')
+        self.open_base = settings.PROJECT_URL + reverse('manager-email-open')
+
+        unsubscribe = settings.PROJECT_URL + reverse(
+            'manager-recipient-subscriptions',
+            kwargs={'pk': self._PK_MARKER})
+        marker = str(self._PK_MARKER)
+        if unsubscribe.count(marker) == 1:
+            head, tail = unsubscribe.split(marker)
+            self.unsubscribe_parts = (head, tail + '?mac=')
+        else:
+            self.unsubscribe_parts = None
+
+        self.compact = getattr(settings, 'TRACKING_COMPACT_LINKS', True) \
+            and self.instance_pk is not None \
+            and all(url.pk is not None for url in tracking_urls)
+
+        instance_pk = str(self.instance_pk)
+        self.url_parts = []
+        for url in tracking_urls:
+            self.url_parts.append((
+                '&url=' + urllib.parse.quote_plus(urllib.parse.quote(url.name)) +
+                '&position=' + urllib.parse.quote_plus(str(url.position)) +
+                '&mac=',
+                (str(url.name) + str(url.position)).encode()
+            ))
+        self.url_prefix = 'instance=' + urllib.parse.quote_plus(instance_pk) + '&recipient='
+        self.open_suffix = '&instance=' + urllib.parse.quote_plus(instance_pk) + '&mac='
+        self.mac_suffix = instance_pk
+
+        self._prepare_macs()
+
+    def _prepare_macs(self):
+        self.keyed = hmac.new(settings.SECRET_KEY.encode(), digestmod=hashlib.md5)
+        self.url_macs = []
+        for _, mac_prefix in self.url_parts:
+            url_mac = self.keyed.copy()
+            url_mac.update(mac_prefix)
+            self.url_macs.append(url_mac)
+
+        if self.compact:
+            click = hmac.new(settings.SECRET_KEY.encode(), b'click', digestmod=hashlib.sha256)
+            self.click_macs = []
+            for url in self.tracking_urls:
+                url_id = encode_varint(url.pk)
+                click_mac = click.copy()
+                click_mac.update(url_id)
+                self.click_macs.append((url_id, click_mac))
+            self.click_suffix = encode_varint(self.instance_pk)
+
+    def __getstate__(self):
+        # HMAC objects can't be pickled, they are rebuilt when unpickled
+        state = self.__dict__.copy()
+        del state['keyed']
+        del state['url_macs']
+        state.pop('click_macs', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prepare_macs()
+
+    def _mac(self, keyed, message):
+        mac = keyed.copy()
+        mac.update(message.encode())
+        return mac.hexdigest()
+
+    def click_token(self, recipient_pk, index):
+        '''
+        Returns util.calc_click_token for the tracked URL at index.
+        '''
+        url_id, click_mac = self.click_macs[index]
+        ids = encode_varint(recipient_pk) + self.click_suffix
+        mac = click_mac.copy()
+        mac.update(ids)
+        return base64.urlsafe_b64encode(
+            url_id + ids + mac.digest()[:CLICK_TOKEN_MAC_LENGTH]
+        ).rstrip(b'=').decode()
+
+    def url_query(self, recipient_pk, index):
+        '''
+        Returns the redirect query string for the tracked URL at index.
+        '''
+        if self.compact:
+            return 'token=' + self.click_token(recipient_pk, index)
+
+        recipient_pk = str(recipient_pk)
+        return ''.join([
+            self.url_prefix,
+            recipient_pk,
+            self.url_parts[index][0],
+            self._mac(self.url_macs[index], recipient_pk + self.mac_suffix)
+        ])
+
+    def url(self, recipient_pk, index):
+        '''
+        Returns the redirect url for the tracked URL at index.
+        '''
+        return self.redirect_base + '?' + self.url_query(recipient_pk, index)
+
+    def open_query(self, recipient_pk):
+        '''
+        Returns the open tracking pixel's query string.
+        '''
+        recipient_pk = str(recipient_pk)
+        return ''.join([
+            'recipient=',
+            recipient_pk,
+            self.open_suffix,
+            self._mac(self.keyed, recipient_pk + self.mac_suffix)
+        ])
+
+    def open_url(self, recipient_pk):
+        return self.open_base + '?' + self.open_query(recipient_pk)
+
+    def unsubscribe_url(self, recipient):
+        '''
+        Returns the same url as recipient.unsubscribe_url.
+        '''
+        if self.unsubscribe_parts is None or recipient.pk is None:
+            return recipient.unsubscribe_url
+
+        recipient_pk = str(recipient.pk)
+        head, tail = self.unsubscribe_parts
+        return ''.join([head, recipient_pk, tail, self._mac(self.keyed, recipient_pk)])
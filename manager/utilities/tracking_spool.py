@@ -0,0 +1,336 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+
+
+log = logging.getLogger(__name__)
+
+
+class TrackingSpool:
+    '''
+    A local, append-only spool of validated open and click events.
+
+    The tracking views append one line per event to a file owned by their
+    process instead of writing to the database, so tracking requests don't
+    wait on (or pile up behind) database writes when a large send lands.
+    A new file is started every interval seconds. The ingest-tracking-events
+    command bulk inserts the events of files that are no longer being
+    written to and then removes them.
+
+    Each event is a single write() to a file opened with O_APPEND, so
+    events survive the web process exiting and are never interleaved.
+    Ingestion is at least once: if ingest is interrupted between committing
+    a file's events and removing it, its clicks are skipped as duplicates
+    the next time but its opens are recorded again as re-opens.
+    '''
+
+    OPEN = 'open'
+    CLICK = 'click'
+
+    SUFFIX = '.events'
+
+    def __init__(self, directory, interval=60):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.fd = None
+        self.slot = None
+        self.pid = None
+
+    def current_slot(self):
+        return int(time.time() // self.interval)
+
+    def record_open(self, recipient_id, instance_id):
+        self.append(self.OPEN, recipient_id, instance_id)
+
+    def record_click(self, recipient_id, url_id):
+        self.append(self.CLICK, recipient_id, url_id)
+
+    def append(self, kind, recipient_id, target_id, when=None):
+        when = when or datetime.now()
+        line = '%s\t%d\t%d\t%s\n' % (kind, recipient_id, target_id, when.isoformat())
+
+        with self.lock:
+            slot = self.current_slot()
+            # Forked workers must not share their parent's file
+            if slot != self.slot or os.getpid() != self.pid:
+                self._rotate(slot)
+            os.write(self.fd, line.encode())
+
+    def _rotate(self, slot):
+        if self.fd is not None:
+            os.close(self.fd)
+        os.makedirs(self.directory, exist_ok=True)
+        self.pid = os.getpid()
+        path = os.path.join(self.directory, '%s-%d-%d%s' % (socket.gethostname(), self.pid, slot, self.SUFFIX))
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.slot = slot
+
+    def closed_files(self):
+        '''
+        Returns the paths of spool files from every process that are no
+        longer written to, oldest first.
+        '''
+        # Files of the previous slot may still get a write that started
+        # just before the slot changed
+        current = self.current_slot() - 1
+
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return files
+
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                slot = int(name[:-len(self.SUFFIX)].rsplit('-', 1)[1])
+            except (IndexError, ValueError):
+                continue
+            if slot < current:
+                files.append((slot, name))
+
+        return [os.path.join(self.directory, name) for slot, name in sorted(files)]
+
+    def ingest(self, path, batch_size=1000):
+        '''
+        Inserts the events in the spool file at path and removes it.
+        Returns the number of opens and clicks inserted.
+        '''
+        opens = []
+        clicks = []
+        with open(path) as spool_file:
+            for number, line in enumerate(spool_file, 1):
+                try:
+                    kind, recipient_id, target_id, when = line.rstrip('\n').split('\t')
+                    event = (int(recipient_id), int(target_id), datetime.fromisoformat(when))
+                except ValueError:
+                    # e.g. a line cut short by the machine going down
+                    log.warning('%s:%d: skipping malformed tracking event %r' % (path, number, line))
+                    continue
+                if kind == self.OPEN:
+                    opens.append(event)
+                elif kind == self.CLICK:
+                    clicks.append(event)
+
+        with transaction.atomic():
+            open_count = self._ingest_opens(opens, batch_size)
+            click_count = self._ingest_clicks(clicks, batch_size)
+
+        os.remove(path)
+        return open_count, click_count
+
+    def _existing_ids(self, model, ids, chunk_size=500):
+        ids = list(set(ids))
+        existing = set()
+        for i in range(0, len(ids), chunk_size):
+            existing.update(model.objects.filter(pk__in=ids[i:i + chunk_size]).values_list('pk', flat=True))
+        return existing
+
+    def _url_instances(self, url_ids, chunk_size=500):
+        from manager.models import URL
+
+        url_ids = list(set(url_ids))
+        instances = {}
+        for i in range(0, len(url_ids), chunk_size):
+            instances.update(URL.objects.filter(pk__in=url_ids[i:i + chunk_size]).values_list('pk', 'instance_id'))
+        return instances
+
+    def _existing_pairs(self, model, target_field, events, chunk_size=500, **filters):
+        '''
+        Returns the (recipient_id, target_id) pairs of events that already
+        have a row in model.
+        '''
+        recipient_ids = list(set(event[0] for event in events))
+        target_ids = list(set(event[1] for event in events))
+        existing = set()
+        for i in range(0, len(recipient_ids), chunk_size):
+            existing.update(model.objects.filter(
+                recipient_id__in=recipient_ids[i:i + chunk_size],
+                **{target_field + '_id__in': target_ids},
+                **filters
+            ).values_list('recipient_id', target_field + '_id'))
+        return existing
+
+    def _increment_counters(self, counts):
+        from manager.models import Instance
+
+        for instance_id, instance_counts in counts.items():
+            Instance.objects.increment_counters(instance_id, **instance_counts)
+
+    def _ingest_opens(self, events, batch_size):
+        from manager.models import Instance, InstanceOpen, Recipient, URLClick
+
+        if not events:
+            return 0
+
+        # Events for deleted recipients or instances are dropped, like
+        # the tracking view does when it can't find them
+        recipients = self._existing_ids(Recipient, [event[0] for event in events])
+        instances = self._existing_ids(Instance, [event[1] for event in events])
+        events = [event for event in events if event[0] in recipients and event[1] in instances]
+
+        # The first open of an instance by a recipient is the open, any
+        # later ones are re-opens
+        opened = self._existing_pairs(InstanceOpen, 'instance', events, is_reopen=False)
+        rows = []
+        for recipient_id, instance_id, when in sorted(events, key=lambda event: event[2]):
+            pair = (recipient_id, instance_id)
+            rows.append(InstanceOpen(
+                recipient_id=recipient_id,
+                instance_id=instance_id,
+                when=when,
+                is_reopen=pair in opened
+            ))
+            opened.add(pair)
+
+        InstanceOpen.objects.bulk_create(rows, batch_size=batch_size)
+
+        # Recipients who clicked before their first open was tracked have
+        # already been counted as openers
+        clicked = self._existing_pairs(URLClick, 'url__instance', events)
+        counts = defaultdict(Counter)
+        for row in rows:
+            if row.is_reopen:
+                counts[row.instance_id]['reopen_total'] += 1
+            elif (row.recipient_id, row.instance_id) not in clicked:
+                counts[row.instance_id]['opener_total'] += 1
+        self._increment_counters(counts)
+
+        return len(rows)
+
+    def _ingest_clicks(self, events, batch_size):
+        from manager.models import InstanceOpen, Recipient, URLClick
+
+        if not events:
+            return 0
+
+        recipients = self._existing_ids(Recipient, [event[0] for event in events])
+        url_instances = self._url_instances([event[1] for event in events])
+        events = [event for event in events if event[0] in recipients and event[1] in url_instances]
+
+        # Only the first click of a URL by a recipient is recorded
+        clicked = self._existing_pairs(URLClick, 'url', events)
+        rows = []
+        for recipient_id, url_id, when in sorted(events, key=lambda event: event[2]):
+            pair = (recipient_id, url_id)
+            if pair in clicked:
+                continue
+            rows.append(URLClick(recipient_id=recipient_id, url_id=url_id, when=when))
+            clicked.add(pair)
+
+        # Counted before inserting, so only clicks of earlier files are
+        # already in the table
+        instance_events = [(row.recipient_id, url_instances[row.url_id]) for row in rows]
+        clickers = self._existing_pairs(URLClick, 'url__instance', instance_events)
+        openers = self._existing_pairs(InstanceOpen, 'instance', instance_events)
+
+        URLClick.objects.bulk_create(rows, batch_size=batch_size)
+
+        counts = defaultdict(Counter)
+        for pair in instance_events:
+            instance_id = pair[1]
+            counts[instance_id]['click_total'] += 1
+            if pair not in clickers:
+                counts[instance_id]['clicker_total'] += 1
+                if pair not in openers:
+                    counts[instance_id]['opener_total'] += 1
+                clickers.add(pair)
+        self._increment_counters(counts)
+
+        return len(rows)
+
+
+_tracking_spool = None
+_tracking_spool_lock = threading.Lock()
+
+
+def tracking_spool():
+    '''
+    Returns the process wide spool for tracking events, or None if
+    TRACKING_SPOOL_DIR isn't set and events are written to the database
+    as they happen.
+    '''
+    global _tracking_spool
+
+    directory = getattr(settings, 'TRACKING_SPOOL_DIR', None)
+    if not directory:
+        return None
+
+    with _tracking_spool_lock:
+        if _tracking_spool is None or _tracking_spool.directory != directory:
+            _tracking_spool = TrackingSpool(directory, getattr(settings, 'TRACKING_SPOOL_INTERVAL', 60))
+        return _tracking_spool
+
+
+def record_open(recipient_id, instance_id):
+    '''
+    Records an open of an instance by a recipient, whose MAC has already
+    been checked. The open is spooled if TRACKING_SPOOL_DIR is set, in which
+    case whether it is a re-open is worked out when it is ingested.
+    '''
+    spool = tracking_spool()
+    if spool is not None:
+        spool.record_open(recipient_id, instance_id)
+        return
+
+    from manager.models import Instance, InstanceOpen, Recipient, URLClick
+
+    try:
+        recipient = Recipient.objects.get(id=recipient_id)
+        instance = Instance.objects.get(id=instance_id)
+
+        instance_open, created = InstanceOpen.objects.get_or_create(recipient=recipient, instance=instance, is_reopen=False)
+        if not created:
+            instance_new = InstanceOpen(recipient=recipient, instance=instance, is_reopen=True)
+            instance_new.save()
+            Instance.objects.increment_counters(instance.pk, reopen_total=1)
+            log.debug('re-open created')
+        else:
+            # A recipient who clicked before their open was tracked has
+            # already been counted as an opener
+            clicked = URLClick.objects.filter(url__instance=instance, recipient=recipient).exists()
+            Instance.objects.increment_counters(instance.pk, opener_total=0 if clicked else 1)
+            log.debug('open created')
+    except InstanceOpen.MultipleObjectsReturned:
+        log.error('multiple InstanceOpens returned')
+    except Recipient.DoesNotExist:
+        log.error('bad recipient')
+    except Instance.DoesNotExist:
+        log.error('bad instance')
+
+
+def record_click(recipient_id, url_id):
+    '''
+    Records a recipient's click of a URL, whose MAC has already been
+    checked. Only the first click is kept.
+    '''
+    spool = tracking_spool()
+    if spool is not None:
+        spool.record_click(recipient_id, url_id)
+    else:
+        from manager.models import Instance, InstanceOpen, URLClick
+        from manager.utilities.tracking_links import tracked_url
+
+        click, created = URLClick.objects.get_or_create(recipient_id=recipient_id, url_id=url_id)
+        if created:
+            instance_id = tracked_url(url_id)[0]
+            clicked = URLClick.objects.filter(
+                url__instance_id=instance_id,
+                recipient_id=recipient_id
+            ).exclude(pk=click.pk).exists()
+            opened = clicked or InstanceOpen.objects.filter(instance_id=instance_id, recipient_id=recipient_id).exists()
+            Instance.objects.increment_counters(
+                instance_id,
+                click_total=1,
+                clicker_total=0 if clicked else 1,
+                opener_total=0 if opened else 1)
+    log.debug('url click saved')
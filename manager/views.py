@@ -13,6 +13,7 @@ import json
 import subprocess
 import sys
 import csv
+from html import unescape
 from html.parser import HTMLParser
 
 from django.conf import settings
@@ -63,7 +64,6 @@ from manager.forms import SubscriptionCategoryForm
 from manager.models import Campaign
 from manager.models import Email
 from manager.models import Instance
-from manager.models import InstanceOpen
 from manager.models import PreviewInstance
 from manager.models import RecipientAttribute
 from manager.models import Recipient
@@ -75,9 +75,12 @@ from manager.models import StaleRecord
 from manager.models import SubprocessStatus
 from manager.models import SubscriptionCategory
 from manager.models import URL
-from manager.models import URLClick
+from manager.utilities.audience import AudienceEstimator
 from manager.utilities.email_sender import EmailSender
+from manager.utilities.recipient_bitmap import clicked_recipients, opened_recipients, received_recipients
 from manager.utilities.s3_helper import AmazonS3Helper
+from manager.utilities.tracking_links import click_target
+from manager.utilities.tracking_spool import record_click, record_open
 
 
 log = logging.getLogger(__name__)
@@ -333,8 +336,15 @@ class EmailPlaceholderVerificationView(EmailsMixin, DetailView):
         context = super(EmailPlaceholderVerificationView, self).get_context_data(**kwargs)
         placeholders = self.object.placeholders
         context['attributes'] = []
+
+        recipients = list(self.object.recipients) if placeholders else []
+        recipient_attributes = RecipientAttribute.objects.pivot(
+            [r.pk for r in recipients],
+            placeholders
+        )
+
         for placeholder in placeholders:
-            emails = self.object.recipients.exclude(attributes__name=placeholder)
+            emails = [r for r in recipients if placeholder not in recipient_attributes[r.pk]]
             if len(emails) > 0:
                 context['attributes'].append((placeholder, emails[:10], len(emails)))
         return context
@@ -1218,6 +1228,10 @@ def redirect(request):
     '''
         Redirects based on URL and records URL click
     '''
+    token = request.GET.get('token', None)
+    if token is not None:
+        return token_redirect(token)
+
     instance_id = request.GET.get('instance', None)
     url_string = request.GET.get('url', None)
     position = request.GET.get('position', None)
@@ -1268,8 +1282,7 @@ def redirect(request):
                             log.error('bad instance')
                             pass
                         else:
-                            url_click, created = URLClick.objects.get_or_create(recipient=recipient, url=url)
-                            log.debug('url click saved')
+                            record_click(recipient.pk, url.pk)
                     else:
                         log.error('wrong mac')
             else:
@@ -1284,6 +1297,29 @@ def redirect(request):
         return HttpResponseRedirect(url_string)
 
 
+def token_redirect(token):
+    '''
+        Redirects a compact tracking link and records the URL click.
+        The token is validated by its MAC and the URL's name comes from
+        an in-process cache, so recording the click is the only database
+        work, and there is none when tracking events are spooled.
+    '''
+    target = click_target(token)
+    if target is None:
+        raise Http404("Poll does not exist")
+    url_id, recipient_id, url_string = target
+
+    # No matter what happens, make sure the redirection works
+    try:
+        record_click(recipient_id, url_id)
+    except Exception as e:
+        log.error(str(e))
+
+    # Decode any encoded characters to ensure things like
+    # UTM params work appropriately
+    return HttpResponseRedirect(unescape(url_string))
+
+
 def instance_open(request):
     '''
         Records an email open
@@ -1301,28 +1337,11 @@ def instance_open(request):
             pass
         else:
             if mac == calc_open_mac(recipient_id, instance_id):
+                # No matter what happens, make sure the pixel is returned
                 try:
-                    recipient = Recipient.objects.get(id=recipient_id)
-                    instance = Instance.objects.get(id=instance_id)
-
-                    instance_open, created = InstanceOpen.objects.get_or_create(recipient=recipient, instance=instance, is_reopen=False)
-                    if not created:
-                        instance_new = InstanceOpen(recipient=recipient, instance=instance, is_reopen=True)
-                        instance_new.save()
-                        log.debug('re-open created')
-                    else:
-                        log.debug('open created')
-                except InstanceOpen.MultipleObjectsReturned:
-                    log.error('multiple InstanceOpens returned');
-                    pass
-                except Recipient.DoesNotExist:
-                    # strange
-                    log.error('bad recipient')
-                    pass
-                except Instance.DoesNotExist:
-                    # also strange
-                    log.error('bad instance')
-                    pass
+                    record_open(recipient_id, instance_id)
+                except Exception as e:
+                    log.error(str(e))
     return HttpResponse(settings.DOT, content_type='image/png')
 
 
@@ -1616,6 +1635,68 @@ def objects_as_options(request):
 
     return HttpResponse(json.dumps(retval), content_type='application/json', status=ret_status)
 
+def audience_estimate(request):
+    """
+    Provides a JSON endpoint for the number of recipients
+    an email or segment reaches, or a segment with the
+    (unsaved) rules passed as a JSON list in "rules",
+    counted or estimated within AUDIENCE_ESTIMATE_BUDGET.
+    """
+    object_type = request.GET.get('type', None)
+    object_id = request.GET.get('id', None)
+
+    retval = {}
+    ret_status = 200
+    estimator = AudienceEstimator()
+
+    try:
+        if object_type == 'email':
+            audience = estimator.email(Email.objects.get(pk=int(object_id)))
+        elif object_type == 'segment':
+            audience = estimator.segment(Segment.objects.get(pk=int(object_id)))
+        elif object_type == 'rules':
+            rules = json.loads(request.POST.get('rules', request.GET.get('rules', '[]')))
+            audience = estimator.rules(audience_rules(rules))
+        else:
+            raise ValueError('You must specify an object type of "email", "segment" or "rules" by passing a "type" parameter.')
+    except (Email.DoesNotExist, Segment.DoesNotExist):
+        ret_status = 404
+        retval['error'] = 'The %s does not exist.' % object_type
+    except (TypeError, ValueError, KeyError, AttributeError) as e:
+        ret_status = 400
+        retval['error'] = str(e)
+    else:
+        retval['count'] = int(round(audience.count))
+        retval['exact'] = audience.exact
+
+    return HttpResponse(json.dumps(retval), content_type='application/json', status=ret_status)
+
+def audience_rules(rules):
+    """
+    Returns unsaved SegmentRules, in index order, for
+    a list of rule dictionaries as posted to audience_estimate.
+    """
+    fields = [field for field, name in SegmentRule.rule_fields]
+    retval = []
+    for index, rule in enumerate(rules):
+        rule = SegmentRule(
+            rule_type=rule['rule_type'],
+            field=rule['field'],
+            conditional=rule.get('conditional') or None,
+            key=rule.get('key') or None,
+            value=str(rule['value']),
+            index=int(rule.get('index', index))
+        )
+        if rule.rule_type not in ('include', 'exclude'):
+            raise ValueError('Invalid rule type "%s"' % rule.rule_type)
+        if rule.field not in fields:
+            raise ValueError('Invalid rule field "%s"' % rule.field)
+        if rule.conditional not in ('AND', 'OR', None):
+            raise ValueError('Invalid rule conditional "%s"' % rule.conditional)
+        retval.append(rule)
+
+    return sorted(retval, key=lambda rule: rule.index)
+
 ##
 # Creates a recipient group based on email opens.
 # POST only
@@ -1643,7 +1724,7 @@ def create_recipient_group_email_opens(request, email_instance):
     Creates a recipient group based on email opens.
     POST only
     '''
-    recipients = email_instance.open_recipients
+    recipients = list(opened_recipients(email_instance))
 
     recipient_group = RecipientGroup(name=email_instance.email.title + ' Recipient Group ' + datetime.now().strftime('%m-%d-%y %I:%M %p'))
     if RecipientGroup.objects.filter(name=recipient_group.name).count() > 0:
@@ -1669,10 +1750,8 @@ def create_recipient_group_email_unopens(request, email_instance):
     that did not open the email
     POST only
     '''
-    recipients_pks = InstanceOpen.objects.filter(instance=email_instance).values_list('recipient__pk', flat=True)
-
     # Remove all the opens from the sent recipients
-    recipients = email_instance.recipients.exclude(pk__in=recipients_pks)
+    recipients = list(received_recipients(email_instance) - opened_recipients(email_instance, clicks=False))
 
     recipient_group = RecipientGroup(name=email_instance.email.title + ' Recipient Group - Unopens - ' + datetime.now().strftime('%m-%d-%y %I:%M %p'))
     if RecipientGroup.objects.filter(name=recipient_group.name).count() > 0:
@@ -1698,12 +1777,7 @@ def create_recipient_group_no_clicks(request, email_instance):
     who did not click on any links for a
     particular email instance.
     '''
-    recipients = email_instance.recipients.all()
-
-    recipient_clicks = URLClick.objects.filter(url__in=email_instance.urls.all()).values('recipient__id').distinct()
-    recipient_clicks = Recipient.objects.filter(id__in=recipient_clicks)
-
-    recipients = list(set(recipients) - set(recipient_clicks))
+    recipients = list(received_recipients(email_instance) - clicked_recipients(email_instance))
 
     recipient_group = RecipientGroup(name=email_instance.email.title + ' Recipient Group - No Clicks - ' + datetime.now().strftime('%m-%d-%y %I:%M %p'))
     if RecipientGroup.objects.filter(name=recipient_group.name).count() > 0:
@@ -1730,18 +1804,11 @@ def create_recipient_group_url_clicks(request):
         POST only
     '''
     url_ids = request.POST.getlist('url-pks[]')
-    url_clicks = []
-    for url_id in url_ids:
-        url_clicks.append(URLClick.objects.filter(url=url_id))
 
     recipient_group = RecipientGroup(name='URL Click Recipient Group - ' + datetime.now().strftime('%m-%d-%y %I:%M %p'))
     recipient_group.save()
 
-    recipients = []
-
-    for url_click in url_clicks:
-        for click in url_click:
-            recipients.append(click.recipient)
+    recipients = list(clicked_recipients(urls=url_ids))
 
     recipient_group.recipients.add(*recipients)
 
@@ -72,9 +72,82 @@ AMAZON_SMTP = {
     'username': '',
     'password': '',
     'quota'   : 500000, # per 24 hours
-    'rate'    : 70 # per second
+    'rate'    : 70, # per second
+    'burst'   : 70, # messages that can be sent at once after idling, defaults to rate
+    'pool_size'   : 70, # open connections kept for reuse, defaults to rate
+    'idle_timeout': 60, # seconds before an unused connection is closed
+    'health_check_interval': 5 # seconds idle before a connection is checked with NOOP
 }
 
+# Number of recipient details created per INSERT when sending an instance
+SEND_BATCH_SIZE = 500
+
+# Maximum number of recipient details waiting to be sent. Sending starts
+# after the first batch is created and creation pauses while the queue is full
+SEND_QUEUE_SIZE = 2000
+
+# Send outcomes are written to the database in batches of this size, or
+# after this many seconds, whichever comes first. Instance progress lags
+# by at most the interval
+SEND_RECORD_BATCH_SIZE = 500
+SEND_RECORD_INTERVAL = 2
+
+# How instances are sent. 'threads' uses one thread and SMTP connection per
+# message sent per second. 'asyncio' drives SEND_ASYNC_CONCURRENCY SMTP
+# connections from a single thread with far fewer database connections
+SEND_ENGINE = 'threads'
+SEND_ASYNC_CONCURRENCY = 70
+
+# Number of worker processes that build messages during a send. 0 builds
+# them in the sending threads. Off by default: messages are copied back
+# from the workers, so only enable it on hosts with spare cores where
+# `manage.py benchmark render` shows the processes beating in process
+SEND_RENDER_PROCESSES = 0
+
+# Tracked links in new sends carry a short signed token, so clicks are
+# redirected without looking up the recipient, instance and URL. Links in
+# emails sent in the old format keep working either way
+TRACKING_COMPACT_LINKS = True
+
+# Number of tracked URL names each web process keeps in memory for
+# redirecting compact links
+TRACKING_URL_CACHE_SIZE = 10000
+
+# Directory the tracking views append open and click events to instead of
+# writing them to the database while handling the request. Run
+# `manage.py ingest-tracking-events` every minute or so to insert them.
+# None writes events to the database as they happen
+TRACKING_SPOOL_DIR = None
+# Seconds each spool file is written to before a new one is started. Files
+# are ingested once they are at least one interval old
+TRACKING_SPOOL_INTERVAL = 60
+
+# Seconds a segment's membership, as materialized by `manage.py
+# refresh-segments`, is used for sending instead of evaluating its rules.
+# 0 always evaluates the rules
+SEGMENT_MEMBERSHIP_MAX_AGE = 900
+
+# Seconds the audience size endpoint spends loading recipient sets before
+# it falls back to estimating from their sizes, and seconds the sets and
+# sizes are cached for
+AUDIENCE_ESTIMATE_BUDGET = 0.5
+AUDIENCE_CACHE_TIMEOUT = 300
+
+# Seconds before the last run that `manage.py collate-stats --since` looks
+# back from, so spooled events ingested after that run are still collated
+COLLATE_STATS_OVERLAP = 900
+
+# Directory email HTML and text are cached in, so fetching unchanged content
+# again only costs a conditional request. None only keeps it in memory.
+# Content fetched less than CONTENT_MEMO_SECONDS ago isn't requested again
+CONTENT_CACHE_DIR = os.path.join(BASE_DIR, 'content-cache')
+CONTENT_MEMO_SECONDS = 10
+
+# Whether mailer-process stages the live sends of its next run, fetching
+# their content and resolving their recipients and attributes ahead of
+# time, so they start sending as soon as that run starts
+STAGE_SENDS = True
+
 AMAZON_S3 = {
     'aws_access_key_id': '',
     'aws_secret_access_key': '',
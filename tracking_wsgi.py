@@ -0,0 +1,20 @@
+"""
+WSGI config for the open and click tracking endpoints only.
+
+It exposes a WSGI callable as a module level variable named ``application``
+that serves /email/open and /email/redirect without the Django middleware
+stack, so tracking can run on its own worker pool. Route only those paths
+to it, everything else should go to wsgi.py.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+django.setup()
+
+from manager.utilities.tracking_app import TrackingApplication
+
+application = TrackingApplication()
@@ -23,6 +23,66 @@ def calc_unsubscribe_mac_old(recipient_id, email_id):
 	mash = ''.join([str(recipient_id), str(email_id)]).encode()
 	return hmac.new(settings.SECRET_KEY.encode(), mash, hashlib.md5).hexdigest()
 
+# Length of the truncated HMAC in click tokens
+CLICK_TOKEN_MAC_LENGTH = 8
+
+def encode_varint(number):
+	'''
+	Encodes a non-negative integer in as few bytes as possible, 7 bits per
+	byte with the high bit set on every byte but the last.
+	'''
+	encoded = bytearray()
+	while number > 0x7f:
+		encoded.append((number & 0x7f) | 0x80)
+		number >>= 7
+	encoded.append(number)
+	return bytes(encoded)
+
+def decode_varints(data):
+	'''
+	Returns the list of integers encoded by encode_varint in data, or None
+	if data ends in the middle of one.
+	'''
+	numbers = []
+	number = shift = 0
+	for byte in data:
+		number |= (byte & 0x7f) << shift
+		shift += 7
+		if not byte & 0x80:
+			numbers.append(number)
+			number = shift = 0
+	if shift:
+		return None
+	return numbers
+
+def calc_click_mac(payload):
+	return hmac.new(settings.SECRET_KEY.encode(), b'click' + payload, hashlib.sha256).digest()[:CLICK_TOKEN_MAC_LENGTH]
+
+def calc_click_token(url_id, recipient_id, instance_id):
+	'''
+	Returns a url safe token identifying a click on a tracked URL by a
+	recipient, signed with a truncated HMAC.
+	'''
+	payload = encode_varint(url_id) + encode_varint(recipient_id) + encode_varint(instance_id)
+	return base64.urlsafe_b64encode(payload + calc_click_mac(payload)).rstrip(b'=').decode()
+
+def parse_click_token(token):
+	'''
+	Returns (url_id, recipient_id, instance_id) for a token made by
+	calc_click_token, or None if the token is malformed or its MAC is wrong.
+	'''
+	try:
+		data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+	except (ValueError, TypeError):
+		return None
+	payload, mac = data[:-CLICK_TOKEN_MAC_LENGTH], data[-CLICK_TOKEN_MAC_LENGTH:]
+	ids = decode_varints(payload)
+	if ids is None or len(ids) != 3:
+		return None
+	if not hmac.compare_digest(mac, calc_click_mac(payload)):
+		return None
+	return tuple(ids)
+
 def create_hash():
     return uuid.uuid4()
 